@@ -0,0 +1,395 @@
+"""
+2 Mar 2015
+
+Binary file format for ensembles of models (written by
+:func:`pytadbit.imp.structuralmodels.StructuralModels.save_models` with
+binary=True, and read by
+:func:`pytadbit.imp.structuralmodels.load_structuralmodels`).
+
+The file starts with a header (magic string, version, number of sections,
+number of particles, of models and of discarded models), followed by a
+table of sections (name, offset, size and compression flag) and by the
+sections themselves:
+
+  - meta: resolution, description, clusters, configuration, particles without
+    data, and the description of each model (everything but its coordinates,
+    objective function value and log of the objective function)
+  - coords: coordinates of the models, then of the discarded models, as
+    float32 in an array of shape (models, particles, 3)
+  - objfun: objective function value of each model, as float64
+  - log_objfun, zscores, restraints, original_data: optional sections
+
+The coords and objfun sections are never compressed and are aligned in the
+file, so that they can be memory-mapped. The other sections are pickled and
+(optionally) compressed with zlib; they are only read when requested.
+"""
+
+from pytadbit.imp.impmodel import IMPmodel
+from cPickle               import dumps, loads, load, HIGHEST_PROTOCOL
+from struct                import Struct
+from tempfile              import mkstemp
+from os                    import path, close, remove
+import zlib
+import numpy as np
+
+MAGIC   = 'TADBITEN'
+VERSION = 1
+
+_HEADER  = Struct('<8sHHIQQ')  # magic, version, sections, nloci, models, bad
+_SECTION = Struct('<16sQQB7x') # name, offset, size, compressed
+_ALIGN   = 64                  # alignment of the sections in the file
+_OPTIONAL = (('log_objfun'   , None),
+             ('zscores'      , 'zscore'),
+             ('restraints'   , 'restraints'),
+             ('original_data', 'original_data'))
+
+
+def is_ensemble_file(path_f):
+    """
+    :param path_f: path to a file
+
+    :returns: True if the file is in the binary ensemble format
+    """
+    inf = open(path_f, 'rb')
+    magic = inf.read(len(MAGIC))
+    inf.close()
+    return magic == MAGIC
+
+
+def _ordered_models(svd):
+    """
+    :returns: the keys of the models and of the discarded models, and the list
+       of all models, in the order they are stored in the file
+    """
+    keys     = sorted(svd['models'])
+    bad_keys = sorted(svd['bad_models'])
+    return keys, bad_keys, ([svd['models'][k] for k in keys] +
+                            [svd['bad_models'][k] for k in bad_keys])
+
+
+def write_ensemble(outfile, svd, compress=True):
+    """
+    Writes an ensemble of models in the binary format.
+
+    :param outfile: path to the file to write
+    :param svd: dictionary describing the ensemble, as returned by
+       StructuralModels._reduce_models
+    :param True compress: compress the pickled sections with zlib
+    """
+    keys, bad_keys, allmodels = _ordered_models(svd)
+    nloci = svd['nloci']
+    meta = {'resolution' : svd['resolution'],
+            'description': svd['description'],
+            'clusters'   : svd['clusters'],
+            'config'     : svd['config'],
+            'zeros'      : svd['zeros'],
+            'keys'       : keys,
+            'bad_keys'   : bad_keys,
+            'models'     : [_description(m) for m in allmodels]}
+    pickled = [('meta', meta)]
+    if any(m.get('log_objfun') for m in allmodels):
+        pickled.append(('log_objfun', [m.get('log_objfun')
+                                       for m in allmodels]))
+    for name, key in _OPTIONAL[1:]:
+        if svd.get(key):
+            pickled.append((name, svd[key]))
+    _write(outfile, nloci, len(keys), len(bad_keys), pickled,
+           [m['objfun'] for m in allmodels],
+           (np.column_stack((m['x'][:nloci], m['y'][:nloci], m['z'][:nloci]))
+            for m in allmodels), compress)
+
+
+def _description(model):
+    """
+    :returns: a copy of a model without coordinates, objective function value
+       and log of the objective function
+    """
+    return IMPmodel([(k, v) for k, v in model.iteritems()
+                     if not k in ('x', 'y', 'z', 'objfun', 'log_objfun')])
+
+
+def _write(outfile, nloci, nmodels, nbad, pickled, objfun, coords, compress):
+    """
+    Writes the header and the sections of an ensemble file.
+
+    :param pickled: list of names and objects of the pickled sections
+    :param objfun: list of objective function values
+    :param coords: iterable over the coordinates of each model (arrays of
+       shape (nloci, 3)), that are written one by one
+    """
+    blobs = []
+    for name, obj in pickled:
+        blob = dumps(obj, HIGHEST_PROTOCOL)
+        if compress:
+            blob = zlib.compress(blob)
+        blobs.append((name, blob, compress))
+    objfun = np.array(objfun, dtype='<f8')
+    sizes = ([('coords', (nmodels + nbad) * nloci * 3 * 4, False),
+              ('objfun', objfun.nbytes, False)] +
+             [(name, len(blob), comp) for name, blob, comp in blobs])
+    # offsets of the sections, aligned after the header and the table
+    table = []
+    offset = _HEADER.size + _SECTION.size * len(sizes)
+    for name, size, comp in sizes:
+        offset += -offset % _ALIGN
+        table.append((name, offset, size, comp))
+        offset += size
+    out = open(outfile, 'wb')
+    out.write(_HEADER.pack(MAGIC, VERSION, len(table), nloci, nmodels, nbad))
+    for name, offset, size, comp in table:
+        out.write(_SECTION.pack(name, offset, size, comp))
+    sections = dict(((name, blob) for name, blob, _ in blobs),
+                    objfun=objfun.tostring())
+    for name, offset, size, _ in table:
+        out.write('\0' * (offset - out.tell()))
+        if name == 'coords':
+            for xyz in coords:
+                out.write(np.asarray(xyz, dtype='<f4').tostring())
+        else:
+            out.write(sections[name])
+    out.close()
+
+
+def merge_ensembles(infiles, outfile, n_keep=None, keep_all=True,
+                    coords_only=False, compress=True):
+    """
+    Merges ensembles of models of the same region (e.g. generated in several
+    runs, with different ranges of random initial numbers) into a binary
+    ensemble file. Models are ranked again according to their objective
+    function value, and models with the same random initial number are only
+    kept once. Coordinates are copied model by model from the memory-mapped
+    input files.
+
+    Clusters are not kept, as the models are not the same; the description
+    and parameters of the ensemble are taken from the first file.
+
+    :param infiles: list of paths to ensembles saved with
+       :func:`pytadbit.imp.structuralmodels.StructuralModels.save_models`
+       (binary files, or pickle files that are converted one by one)
+    :param outfile: path to the binary ensemble file to write
+    :param None n_keep: number of models kept as best models, the others
+       being stored as discarded models. By default, the number of different
+       best models in the input ensembles (models with the same random
+       initial number counted once)
+    :param True keep_all: whether or not to keep the discarded models
+    :param False coords_only: do not keep the log of the objective function
+       of the discarded models
+    :param True compress: compress the pickled sections with zlib
+
+    :returns: the number of best models and of discarded models written
+    """
+    if path.abspath(outfile) in [path.abspath(f) for f in infiles]:
+        raise Exception('ERROR: output file should not be one of the input '
+                        'files\n')
+    converted = []
+    try:
+        ensembles = []
+        for infile in infiles:
+            if not is_ensemble_file(infile):
+                svd = load(open(infile, 'rb'))
+                fd, infile = mkstemp(suffix='.ens', dir=path.dirname(
+                    path.abspath(outfile)))
+                close(fd)
+                converted.append(infile)
+                write_ensemble(infile, svd, compress=False)
+                del svd
+            ensembles.append(EnsembleFile(infile))
+        if len(set(e.nloci for e in ensembles)) > 1:
+            raise Exception('ERROR: ensembles with different number of '
+                            'particles can not be merged\n')
+        # rank all models, keeping the best of those with same random number
+        ranked = []
+        best = set()
+        for num, ens in enumerate(ensembles):
+            models = ens.section('meta')['models']
+            for row, objfun in enumerate(ens.objfun()):
+                ranked.append((float(objfun), int(models[row]['rand_init']),
+                               num, row))
+                if row < len(ens):
+                    best.add(int(models[row]['rand_init']))
+        ranked.sort()
+        seen = set()
+        selected = []
+        for objfun, rand_init, num, row in ranked:
+            if rand_init in seen:
+                continue
+            seen.add(rand_init)
+            selected.append((num, row, objfun))
+        if n_keep is None:
+            n_keep = len(best)
+        if not keep_all:
+            selected = selected[:n_keep]
+        nmodels = min(n_keep, len(selected))
+        # description of the merged models
+        descriptions = []
+        logs = [None] * len(selected)
+        for num, ens in enumerate(ensembles):
+            rows = [(i, row) for i, (n, row, _) in enumerate(selected)
+                    if n == num]
+            models = ens.section('meta')['models']
+            for i, row in rows:
+                descriptions.append((i, _description(models[row])))
+            if ens.section('log_objfun'):
+                for i, row in rows:
+                    if not coords_only or i < nmodels:
+                        logs[i] = ens.section('log_objfun')[row]
+            ens._loaded.pop('log_objfun', None) # only one in memory
+        descriptions = [d for _, d in sorted(descriptions)]
+        for i, desc in enumerate(descriptions):
+            desc['index'] = i
+            desc['cluster'] = 'Singleton'
+        first = ensembles[0].section('meta')
+        meta = {'resolution' : first['resolution'],
+                'description': first['description'],
+                'clusters'   : {},
+                'config'     : first['config'],
+                'zeros'      : first['zeros'],
+                'keys'       : range(nmodels),
+                'bad_keys'   : range(nmodels, len(selected)),
+                'models'     : descriptions}
+        pickled = [('meta', meta)]
+        if any(logs):
+            pickled.append(('log_objfun', logs))
+        for name, _ in _OPTIONAL[1:]:
+            for ens in ensembles:
+                if ens.section(name):
+                    pickled.append((name, ens.section(name)))
+                    break
+        coords = [ens.coordinates() for ens in ensembles]
+        _write(outfile, ensembles[0].nloci, nmodels, len(selected) - nmodels,
+               pickled, [objfun for _, _, objfun in selected],
+               (coords[num][row] for num, row, _ in selected), compress)
+        return nmodels, len(selected) - nmodels
+    finally:
+        for infile in converted:
+            remove(infile)
+
+
+class EnsembleFile(object):
+    """
+    Reads an ensemble of models stored in the binary format. Coordinates and
+    objective function values are memory-mapped, other sections are only
+    read (and kept) when requested.
+
+    :param path_f: path to the file
+
+    """
+    def __init__(self, path_f):
+        self.path = path_f
+        inf = open(path_f, 'rb')
+        magic, version, nsections, self.nloci, self.nmodels, self.nbad = (
+            _HEADER.unpack(inf.read(_HEADER.size)))
+        if magic != MAGIC:
+            inf.close()
+            raise Exception('ERROR: %s is not an ensemble file\n' % path_f)
+        if version > VERSION:
+            inf.close()
+            raise Exception('ERROR: ensemble file version %d not supported, '
+                            'please update TADbit\n' % version)
+        self._sections = {}
+        for _ in xrange(nsections):
+            name, offset, size, compressed = _SECTION.unpack(
+                inf.read(_SECTION.size))
+            self._sections[name.rstrip('\0')] = (offset, size, compressed)
+        inf.close()
+        self._loaded = {}
+
+
+    def __len__(self):
+        return self.nmodels
+
+
+    def sections(self):
+        """
+        :returns: the names of the sections stored in the file
+        """
+        return sorted(self._sections, key=lambda s: self._sections[s][0])
+
+
+    def section(self, name):
+        """
+        :param name: name of a pickled section (meta, log_objfun, zscores,
+           restraints or original_data)
+
+        :returns: the content of the section, None if it is not in the file
+        """
+        if not name in self._sections:
+            return None
+        if not name in self._loaded:
+            offset, size, compressed = self._sections[name]
+            inf = open(self.path, 'rb')
+            inf.seek(offset)
+            blob = inf.read(size)
+            inf.close()
+            self._loaded[name] = loads(zlib.decompress(blob) if compressed
+                                       else blob)
+        return self._loaded[name]
+
+
+    def coordinates(self, mode='r'):
+        """
+        :param 'r' mode: mode of the memory map ('c' for copy-on-write, 'r+'
+           to modify the file)
+
+        :returns: a memory-mapped array of float32, of shape (number of models
+           and discarded models, number of particles, 3)
+        """
+        return np.memmap(self.path, dtype='<f4', mode=mode,
+                         offset=self._sections['coords'][0],
+                         shape=(self.nmodels + self.nbad, self.nloci, 3))
+
+
+    def objfun(self):
+        """
+        :returns: a memory-mapped array with the objective function value of
+           the models, then of the discarded models
+        """
+        return np.memmap(self.path, dtype='<f8', mode='r',
+                         offset=self._sections['objfun'][0],
+                         shape=(self.nmodels + self.nbad, ))
+
+
+    def _row(self, model):
+        """
+        :returns: the position of a model in the file, given its rank or its
+           random initial number (as string)
+        """
+        models = self.section('meta')['models']
+        if isinstance(model, str):
+            for row, desc in enumerate(models):
+                if desc['rand_init'] == model:
+                    return row
+            raise KeyError('Model %s not found\n' % (model))
+        if not 0 <= model < len(models):
+            raise KeyError('Model %s not found\n' % (model))
+        return model
+
+
+    def model(self, model, log_objfun=False):
+        """
+        :param model: rank of the model (discarded models come after the
+           models) or its random initial number (as string)
+        :param False log_objfun: also read the log of the objective function
+           (stored in the same section for all the models)
+
+        :returns: an :class:`pytadbit.imp.impmodel.IMPmodel`
+        """
+        row = self._row(model)
+        model = IMPmodel(self.section('meta')['models'][row])
+        coords = np.array(self.coordinates()[row], dtype=float)
+        model['x'] = coords[:, 0].tolist()
+        model['y'] = coords[:, 1].tolist()
+        model['z'] = coords[:, 2].tolist()
+        model['objfun'] = float(self.objfun()[row])
+        logs = self.section('log_objfun') if log_objfun else None
+        model['log_objfun'] = logs[row] if logs else None
+        return model
+
+
+    def cluster(self, cluster):
+        """
+        :param cluster: number of a cluster
+
+        :returns: the list of the random initial numbers of its models
+        """
+        return self.section('meta')['clusters'][cluster]
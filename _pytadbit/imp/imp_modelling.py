@@ -8,10 +8,13 @@ from pytadbit.imp.structuralmodels import StructuralModels
 from pytadbit.imp.impmodel         import IMPmodel
 from scipy                         import polyfit
 from math                          import fabs, pow as power
-from cPickle                       import load, dump
+from cPickle                       import load, dump, HIGHEST_PROTOCOL
+from cPickle                       import UnpicklingError
 from sys                           import stdout
 from os.path                       import exists
+from heapq                         import heappush, heappushpop
 import multiprocessing as mu
+import numpy as np
 
 import IMP.core
 import IMP.algebra
@@ -27,12 +30,19 @@ except ImportError:
 IMP.set_check_level(IMP.NONE)
 IMP.set_log_level(IMP.SILENT)
 
+# types of restraints, as suffixes of the restraint functions
+RESTRAINT_TYPES = ('a', 'l', 'u', 'n')
+
+RESTRAINTS = None
+
 
 def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
                        n_keep=1000, close_bins=1, n_cpus=1, keep_all=False,
                        verbose=0, outfile=None, config=None,
                        values=None, experiment=None, coords=None, zeros=None,
-                       first=None):
+                       first=None, engine=None, store=None,
+                       coords_only=False, tolerance=None, round_size=None,
+                       contact_cutoff=None):
     """
     This function generates three-dimensional models starting from Hi-C data. 
     The final analysis will be performed on the n_keep top models.
@@ -108,6 +118,29 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
           }
     :param None first: particle number at which model should start (0 should be
        used inside TADbit)
+    :param None engine: a :class:`ModelGenerator` already started for these
+       Z-scores (its workers are reused, and n_cpus, first and close_bins are
+       ignored). By default a new one is started, and closed at the end
+    :param None store: path to a file where each model is appended as soon as
+       it is generated. If the file already exists, the models it contains
+       (with random initial numbers between start and start + n_models) are
+       loaded instead of being generated again, so that an interrupted run
+       can be restarted with the same parameters
+    :param False coords_only: do not keep the log of the objective function
+       of the discarded models (see keep_all), nor write it into the store
+       (see store)
+    :param None tolerance: if given, models are generated in rounds (see
+       round_size), and the generation stops before reaching n_models when
+       the distribution of the objective function of the n_keep best models
+       changes, from one round to the next, by less than this fraction (the
+       mean absolute difference between the sorted values is compared to
+       their mean absolute value). e.g.: 0.001
+    :param None round_size: number of models generated in each round (by
+       default n_keep)
+    :param None contact_cutoff: distance (in nm) used to define contacts. If
+       given, together with tolerance, the generation also waits for the
+       correlation between the contact maps of the n_keep best models in two
+       successive rounds to be higher than 1 - tolerance
 
     :returns: a StructuralModels object
 
@@ -116,46 +149,17 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
     # Main config parameters
     global CONFIG
     CONFIG = config or CONFIG['dmel_01']
-    CONFIG['kforce'] = CONFIG.get('kforce', 5)
-    
-    # Particles initial radius
-    global RADIUS
-    RADIUS = float(resolution * CONFIG['scale']) / 2
-    CONFIG['lowrdist'] = RADIUS * 2.
-    
 
-    if CONFIG['lowrdist'] > CONFIG['maxdist']:
-        raise Exception(
-            ('ERROR: we must prevent you from doing this for the safe of our' +
-             'universe...\nIn this case, maxdist must be higher than %s\n' +
-             '   -> resolution times scale -- %s*%s)') % (
-                CONFIG['lowrdist'], resolution, CONFIG['scale']))
-
-    # get SLOPE and regression for all particles of the z-score data
-    global SLOPE, INTERCEPT
-    zsc_vals = [zscores[i][j] for i in zscores for j in zscores[i]
-                if abs(int(i) - int(j)) > 1] # condition is to avoid
-                                             # taking into account selfies
-                                             # and neighbors
-    SLOPE, INTERCEPT   = polyfit([min(zsc_vals), max(zsc_vals)],
-                                 [CONFIG['maxdist'], CONFIG['lowrdist']], 1)
-    # get SLOPE and regression for neighbors of the z-score data
-    global NSLOPE, NINTERCEPT
-    xarray = [zscores[i][j] for i in zscores for j in zscores[i]
-              if abs(int(i) - int(j)) <= (close_bins + 1)]
-    yarray = [RADIUS * 2 for _ in xrange(len(xarray))]
-    NSLOPE, NINTERCEPT = polyfit(xarray, yarray, 1)
-    
-    global LOCI
-    # if z-scores are generated outside TADbit they may not start at zero
-    if first == None:
-        first = min([int(j) for i in zscores for j in zscores[i]] +
-                    [int(i) for i in zscores])
-    LOCI  = range(first, nloci + first)
-    
-    # Z-scores
-    global PDIST
-    PDIST = zscores
+    # workers generating the models
+    if engine is None:
+        engine = ModelGenerator(zscores, nloci, first=first,
+                                close_bins=close_bins, n_cpus=n_cpus)
+        close_engine = True
+    else:
+        if engine.nloci != nloci:
+            raise Exception('ERROR: model generator built for %d particles, '
+                            'not %d\n' % (engine.nloci, nloci))
+        close_engine = False
     # random inital number
     global START
     START = start
@@ -163,9 +167,28 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
     global VERBOSE
     VERBOSE = verbose
 
-    models, bad_models = multi_process_model_generation(
-        n_cpus, n_models, n_keep, keep_all)
-
+    try:
+        models, bad_models = engine.generate(
+            CONFIG, resolution, n_models, n_keep, start=start,
+            keep_all=keep_all, verbose=verbose, store=store,
+            coords_only=coords_only, tolerance=tolerance,
+            round_size=round_size, contact_cutoff=contact_cutoff)
+    finally:
+        if close_engine:
+            engine.close()
+
+    return _build_structural_models(models, bad_models, zscores, resolution,
+                                    values, experiment, coords, zeros,
+                                    outfile)
+
+
+def _build_structural_models(models, bad_models, zscores, resolution, values,
+                             experiment, coords, zeros, outfile):
+    """
+    Indexes and describes the generated models, and stores them in outfile or
+    in a StructuralModels object (CONFIG and LOCI global variables have to be
+    set).
+    """
     try:
         xpr = experiment
         crm = xpr.crm
@@ -207,75 +230,555 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
             restraints=_get_restraints(),
             description=description)
 
+
 def _get_restraints():
     """
     Same function as addAllHarmonic but just to get restraints
     """
-    model = {'rk'    : IMP.FloatKey("radius"),
-             'model' : Model(),
-             'ps'    : None}
-    model['ps'] = ListSingletonContainer(IMP.core.create_xyzr_particles(
-        model['model'], len(LOCI), RADIUS, 100000))
-    model['ps'].set_name("")
-    for i in range(0, len(LOCI)):
-        p = model['ps'].get_particle(i)
-        p.set_name(str(LOCI[i]))
-        #p.set_value(model['rk'], RADIUS)
+    names = [str(l) for l in LOCI]
     restraints = {}
-    for i in range(len(LOCI)):
-        p1 = model['ps'].get_particle(i)
-        x = p1.get_name()
-        for j in range(i+1, len(LOCI)):
-            p2 = model['ps'].get_particle(j)
-            y = p2.get_name()
-            typ, dist, frc = addHarmonicPair(model, p1, p2, x, y, j, dry=True)
-            if VERBOSE >= 1:
-                stdout.write('%s\t%s\t%s\t%s\t%s\n' % (typ, x, y, dist, frc))
-            if typ[-1] == 'a':
-                typ = 'H'
-            elif typ[-1] == 'l':
-                typ = 'L'
-            elif typ[-1] == 'u':
-                typ = 'U'
-            elif typ[-1] == 'n':
-                typ = 'C'
-            else:
-                continue
-            restraints[tuple(sorted((x, y)))] = typ[-1], dist, frc
+    for i, j, typ, dist, frc in zip(*[v.tolist()
+                                      for v in _get_restraint_table()]):
+        x, y = names[i], names[j]
+        typ = RESTRAINT_TYPES[typ]
+        if VERBOSE >= 1:
+            stdout.write('%s\t%s\t%s\t%s\t%s\n' % (
+                'addH' + typ, x, y, dist, frc))
+        restraints[tuple(sorted((x, y)))] = (
+            {'a': 'H', 'l': 'L', 'u': 'U', 'n': 'C'}[typ], dist, frc)
     return restraints
 
-def multi_process_model_generation(n_cpus, n_models, n_keep, keep_all):
+
+def _get_restraint_table():
     """
-    Parallelize the
-    :func:`pytadbit.imp.imp_model.StructuralModels.generate_IMPmodel`.
+    Restraints between pairs of particles for the current set of parameters
+    (computed only once per set of parameters).
+    """
+    global RESTRAINTS
+    if RESTRAINTS is None:
+        RESTRAINTS = restraint_table(PDIST, LOCI, CONFIG, RADIUS, SLOPE,
+                                     INTERCEPT, NSLOPE, NINTERCEPT)
+    return RESTRAINTS
 
-    :param n_cpus: number of CPUs to use
-    :param n_models: number of models to generate
+
+def restraint_table(zscores, loci, config, radius, slope, intercept, nslope,
+                    nintercept):
+    """
+    Computes all the restraints between pairs of particles at once, with the
+    same rules as :func:`addHarmonicPair`.
+
+    :param zscores: the dictionary of the Z-score values calculated from the
+       Hi-C pairwise interactions
+    :param loci: list of particle numbers
+    :param config: a dictionary with the modelling parameters (upfreq,
+       lowfreq and kforce are used)
+    :param radius: radius of the particles
+    :param slope: slope of the regression from Z-scores to distances
+    :param intercept: intercept of the regression from Z-scores to distances
+    :param nslope: slope of the regression from Z-scores to distances, for
+       neighbor particles
+    :param nintercept: intercept of the regression from Z-scores to distances,
+       for neighbor particles
+
+    :returns: five arrays with, for each restraint, the index of the first
+       and second particles, the type of restraint (index in RESTRAINT_TYPES),
+       the distance and the force
+    """
+    nloci = len(loci)
+    first = loci[0] - 1
+    # Z-score matrix with one extra particle at each side, and presence of
+    # each row and cell in the dictionary of Z-scores
+    size = nloci + 2
+    zsc  = np.zeros((size, size))
+    cell = np.zeros((size, size), dtype=bool)
+    row  = np.zeros(size, dtype=bool)
+    for x in zscores:
+        k = int(x) - first
+        if not 0 <= k < size:
+            continue
+        row[k] = True
+        for y, val in zscores[x].iteritems():
+            l = int(y) - first
+            if 0 <= l < size:
+                zsc[k, l] = val
+                cell[k, l] = True
+    ii, jj = np.triu_indices(nloci, 1)
+    ki, kj = ii + 1, jj + 1
+    seqdist = jj - ii
+    nan = float('nan')
+    # LONG RANGE DISTANCE DISTANCE BETWEEN TWO NON-CONSECUTIVE LOCI
+    direct = cell[ki, kj]
+    freq = np.where(direct, zsc[ki, kj], nan)
+    # X IN PDIST BUT Y NOT IN PDIST[X]: mean of the Z-scores with previous and
+    # next particles
+    half = ~direct & row[ki]
+    freq[half] = _mean_of_available(zsc[ki, kj - 1], cell[ki, kj - 1],
+                                    zsc[ki, kj + 1], cell[ki, kj + 1])[half]
+    # X NOT IN PDIST: mean of the Z-scores of previous and next particles
+    nrow = ~row[ki]
+    prevx = np.where(row[ki - 1], ki - 1, ki + 1)
+    postx = np.where(row[ki + 1], ki + 1, prevx)
+    freq[nrow] = np.where(row[prevx] & row[postx], _mean_of_available(
+        zsc[prevx, kj], cell[prevx, kj], zsc[postx, kj], cell[postx, kj]),
+                          nan)[nrow]
+    half |= nrow
+    kforce = np.power(np.abs(freq), 0.5)
+    kforce[half] *= 0.5
+    dist = np.zeros(len(ii))
+    typ = np.zeros(len(ii), dtype=int) - 1
+    with np.errstate(invalid='ignore'):
+        # FREQUENCY > UPFREQ
+        upper = freq > config['upfreq']
+        # FREQUENCY > LOW THIS HAS TO BE THE THRESHOLD FOR
+        # "PHYSICAL INTERACTIONS"
+        lower = ~upper & (freq < config['lowfreq'])
+    typ[upper] = 0
+    typ[lower] = 1
+    dist[upper | lower] = slope * freq[upper | lower] + intercept
+    # SHORT RANGE DISTANCE BETWEEN TWO CONSECUTIVE LOCI
+    neigh = seqdist == 1
+    with np.errstate(invalid='ignore'):
+        harm = neigh & direct & (freq > config['upfreq'])
+    typ[harm] = 3
+    dist[harm] = nslope * freq[harm] + nintercept
+    typ[neigh & ~harm] = 2
+    dist[neigh & ~harm] = radius + radius
+    # SHORT RANGE DISTANCE BETWEEN TWO SEQDIST = 2
+    typ[seqdist == 2] = 2
+    dist[seqdist == 2] = radius + radius + 2.0 * radius
+    kforce[seqdist <= 2] = config['kforce']
+    keep = typ >= 0
+    return ii[keep], jj[keep], typ[keep], dist[keep], kforce[keep]
+
+
+def _mean_of_available(val1, ok1, val2, ok2):
+    """
+    Mean of two values, or only one of them if the other is not available
+    (NaN if none).
     """
+    return np.where(ok1 & ok2, (val1 + val2) / 2,
+                    np.where(ok1, val1, np.where(ok2, val2, float('nan'))))
 
-    pool = mu.Pool(n_cpus)
-    jobs = {}
-    for rand_init in xrange(START, n_models + START):
-        jobs[rand_init] = pool.apply_async(generate_IMPmodel,
-                                           args=(rand_init,))
 
-    pool.close()
-    pool.join()
+class ModelGenerator(object):
+    """
+    Long-lived pool of workers generating IMP models from one set of
+    Z-scores.
+
+    The Z-scores are passed to the workers only once, when they are started
+    (at the first generation of models).
+    Each call to :func:`ModelGenerator.generate` then only sends the
+    parameters (as a small tuple) together with batches of random initial
+    numbers, so that the same workers can be used to generate the models of
+    many different parameter sets (as in
+    :func:`pytadbit.imp.impoptimizer.IMPoptimizer.run_grid_search`).
 
-    results = []
-    for rand_init in xrange(START, n_models + START):
-        results.append((rand_init, jobs[rand_init].get()))   
+    Can be used as a context manager, otherwise
+    :func:`ModelGenerator.close` has to be called at the end.
 
-    models = {}
-    bad_models = {}
-    for i, (_, m) in enumerate(
-        sorted(results, key=lambda x: x[1]['objfun'])[:n_keep]):
-        models[i] = m
-    if keep_all:
-        for i, (_, m) in enumerate(
-        sorted(results, key=lambda x: x[1]['objfun'])[n_keep:]):
-            bad_models[i+n_keep] = m
-    return models, bad_models
+    :param zscores: the dictionary of the Z-score values calculated from the
+       Hi-C pairwise interactions
+    :param nloci: number of particles to model (may not all be present in
+       zscores)
+    :param None first: particle number at which model should start (0 should be
+       used inside TADbit)
+    :param 1 close_bins: number of particles away (i.e. the bin number
+       difference) a particle pair must be in order to be considered as
+       neighbors (e.g. 1 means consecutive particles)
+    :param 1 n_cpus: number of CPUs to use
+    :param None batch_size: number of models generated by a worker in each
+       job. By default it is chosen to give at least four jobs per CPU, with
+       a maximum of 50 models per job
+    """
+    def __init__(self, zscores, nloci, first=None, close_bins=1, n_cpus=1,
+                 batch_size=None):
+        # if z-scores are generated outside TADbit they may not start at zero
+        if first == None:
+            first = min([int(j) for i in zscores for j in zscores[i]] +
+                        [int(i) for i in zscores])
+        self.zscores    = zscores
+        self.nloci      = nloci
+        self.loci       = range(first, nloci + first)
+        self.close_bins = close_bins
+        self.n_cpus     = n_cpus
+        self.batch_size = batch_size
+        # Z-score values used to compute the regressions of distances, they do
+        # not depend on the parameters
+        zsc_vals = [zscores[i][j] for i in zscores for j in zscores[i]
+                    if abs(int(i) - int(j)) > 1] # condition is to avoid
+                                                 # taking into account selfies
+                                                 # and neighbors
+        self._zsc_range = min(zsc_vals), max(zsc_vals)
+        self._nzsc_vals = [zscores[i][j] for i in zscores for j in zscores[i]
+                           if abs(int(i) - int(j)) <= (close_bins + 1)]
+        self._pool = None
+
+    def parameters(self, config, resolution, verbose=0):
+        """
+        Computes all the values needed by the workers to generate models with
+        a given set of parameters.
+
+        :param config: a dictionary with the modelling parameters (see
+           :func:`generate_3d_models`). The keys kforce and lowrdist are set
+           in place
+        :param resolution: number of nucleotides per Hi-C bin
+        :param 0 verbose: verbosity of the model generation
+
+        :returns: a tuple with the config, the radius of the particles, the
+           slope and intercept of the regressions of distances (for
+           non-neighbor and neighbor particles) and the verbosity
+        """
+        config['kforce'] = config.get('kforce', 5)
+        # Particles initial radius
+        radius = float(resolution * config['scale']) / 2
+        config['lowrdist'] = radius * 2.
+        if config['lowrdist'] > config['maxdist']:
+            raise Exception(
+                ('ERROR: we must prevent you from doing this for the safe of our' +
+                 'universe...\nIn this case, maxdist must be higher than %s\n' +
+                 '   -> resolution times scale -- %s*%s)') % (
+                    config['lowrdist'], resolution, config['scale']))
+        # get SLOPE and regression for all particles of the z-score data
+        slope, intercept = polyfit(list(self._zsc_range),
+                                   [config['maxdist'], config['lowrdist']], 1)
+        # get SLOPE and regression for neighbors of the z-score data
+        nslope, nintercept = polyfit(
+            self._nzsc_vals, [radius * 2 for _ in self._nzsc_vals], 1)
+        return (config, radius, slope, intercept, nslope, nintercept, verbose)
+
+    def generate(self, config, resolution, n_models, n_keep, start=1,
+                 keep_all=False, verbose=0, store=None, coords_only=False,
+                 tolerance=None, round_size=None, contact_cutoff=None):
+        """
+        Generates models with a given set of parameters.
+
+        :param config: a dictionary with the modelling parameters (see
+           :func:`generate_3d_models`)
+        :param resolution: number of nucleotides per Hi-C bin
+        :param n_models: number of models to generate
+        :param n_keep: number of models to keep (the ones with the lowest
+           objective function)
+        :param 1 start: random initial number of the first model
+        :param False keep_all: whether or not to return the discarded models
+        :param 0 verbose: verbosity of the model generation
+        :param None store: path to a file where to append each model as soon
+           as it is generated (models already in this file are not generated
+           again)
+        :param False coords_only: do not keep the log of the objective
+           function of the discarded models, nor write it into the store
+        :param None tolerance: stop generating models (in rounds of
+           round_size models) when the objective functions of the n_keep best
+           models change less than this fraction between two rounds (see
+           :func:`generate_3d_models`)
+        :param None round_size: number of models per round (by default
+           n_keep)
+        :param None contact_cutoff: if given, also wait for the contact maps
+           of the n_keep best models to converge
+
+        :returns: two dictionaries of models (kept and discarded), with the
+           rank of the model as key
+        """
+        params = self.parameters(config, resolution, verbose)
+        # same values in the main process, in case restraints are needed
+        _init_worker(self.zscores, self.loci)
+        _set_params(params)
+        return self._run(params, n_models, n_keep, start, keep_all,
+                         store=store, coords_only=coords_only,
+                         tolerance=tolerance, round_size=round_size,
+                         contact_cutoff=contact_cutoff)
+
+    def _run(self, params, n_models, n_keep, start, keep_all, store=None,
+             coords_only=False, tolerance=None, round_size=None,
+             contact_cutoff=None):
+        best = _BestModels(n_keep, keep_all, coords_only)
+        todo = set(xrange(start, n_models + start))
+        out = None
+        if store:
+            # models already generated by a previous run
+            offset = 0
+            if exists(store):
+                for offset, rand_init, model in _iter_model_store(store):
+                    if rand_init in todo:
+                        todo.remove(rand_init)
+                        best.add(rand_init, model)
+            out = open(store, 'r+b' if exists(store) else 'wb')
+            # removes a record possibly truncated by an interruption
+            out.seek(offset)
+            out.truncate()
+        todo = sorted(todo)
+        if tolerance:
+            round_size = round_size or max(1, n_keep)
+        else:
+            round_size = len(todo) or 1
+        prev_objfun = prev_contacts = None
+        try:
+            for beg in xrange(0, len(todo), round_size):
+                self._dispatch(params, todo[beg:beg + round_size], best, out,
+                               coords_only)
+                if not tolerance or len(best) < n_keep:
+                    continue
+                objfun = best.objfuns()
+                contacts = (best.contacts(contact_cutoff)
+                            if contact_cutoff else None)
+                if prev_objfun is None:
+                    prev_objfun, prev_contacts = objfun, contacts
+                    continue
+                change = (np.mean(np.abs(objfun - prev_objfun)) /
+                          (np.mean(np.abs(prev_objfun)) or 1.))
+                converged = change <= tolerance
+                if contact_cutoff:
+                    corr = (1. if (contacts == prev_contacts).all() else
+                            np.corrcoef(contacts, prev_contacts)[0, 1])
+                    converged &= (1 - corr) <= tolerance
+                if params[-1]:
+                    stdout.write(('Round %d: %d models, change in objective '
+                                  'function %.5f%s\n') % (
+                                      beg / round_size + 1,
+                                      len(best) + best.discarded,
+                                      change, ', contact correlation %.5f' % (
+                                          corr) if contact_cutoff else ''))
+                if converged:
+                    break
+                prev_objfun, prev_contacts = objfun, contacts
+        finally:
+            if out:
+                out.close()
+        return best.ranked()
+
+    def _dispatch(self, params, rand_inits, best, out, coords_only):
+        """
+        Generates models for a list of random initial numbers, by batches,
+        and adds them to the best models (and to the store) as they come.
+        """
+        batch_size = self.batch_size or max(
+            1, min(50, len(rand_inits) / (4 * self.n_cpus)))
+        jobs = [(params, rand_inits[beg:beg + batch_size])
+                for beg in xrange(0, len(rand_inits), batch_size)]
+        for batch in self._get_pool().imap_unordered(_generate_batch, jobs):
+            for rand_init, model in batch:
+                if out:
+                    dump((rand_init, _light_model(model) if coords_only
+                          else model), out, HIGHEST_PROTOCOL)
+                best.add(rand_init, model)
+            if out:
+                out.flush()
+
+    def generate_many(self, params_list, n_models, n_keep, start=1,
+                      keep_all=False):
+        """
+        Generates models for several sets of parameters at once. The batches
+        of models of all the sets of parameters are sent to the same workers,
+        so that all the CPUs are kept busy until the last set is done.
+
+        :param params_list: list of sets of parameters, as returned by
+           :func:`ModelGenerator.parameters`
+        :param n_models: number of models to generate per set of parameters
+        :param n_keep: number of models to keep per set of parameters
+        :param 1 start: random initial number of the first model
+        :param False keep_all: whether or not to return the discarded models
+
+        :yields: as soon as all the models of a set of parameters are
+           generated, the index of this set in params_list, and the two
+           dictionaries of models (kept and discarded). Parameters are also
+           set in the global variables of this module (e.g. to get
+           restraints)
+        """
+        batch_size = self.batch_size or max(
+            1, min(50, n_models / (4 * self.n_cpus)))
+        jobs = [(idx, (params, range(beg, min(beg + batch_size,
+                                              n_models + start))))
+                for idx, params in enumerate(params_list)
+                for beg in xrange(start, n_models + start, batch_size)]
+        best = [_BestModels(n_keep, keep_all) for _ in params_list]
+        remaining = [n_models] * len(params_list)
+        _init_worker(self.zscores, self.loci)
+        for idx, batch in self._get_pool().imap_unordered(
+            _generate_tagged_batch, jobs):
+            for rand_init, model in batch:
+                best[idx].add(rand_init, model)
+            remaining[idx] -= len(batch)
+            if not remaining[idx]:
+                _set_params(params_list[idx])
+                yield (idx, ) + best[idx].ranked()
+                best[idx] = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = mu.Pool(self.n_cpus, initializer=_init_worker,
+                                 initargs=(self.zscores, self.loci))
+        return self._pool
+
+    def close(self):
+        """
+        Stops the workers.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def _init_worker(zscores, loci):
+    """
+    Stores the Z-scores and the names of the particles in the global variables
+    of a worker.
+    """
+    global PDIST, LOCI, RESTRAINTS
+    PDIST = zscores
+    LOCI  = loci
+    RESTRAINTS = None
+
+
+def _set_params(params):
+    """
+    Stores a set of parameters (as returned by
+    :func:`ModelGenerator.parameters`) in the global variables of a worker.
+    """
+    global CONFIG, RADIUS, SLOPE, INTERCEPT, NSLOPE, NINTERCEPT, VERBOSE
+    global RESTRAINTS
+    if RESTRAINTS is not None and params == (CONFIG, RADIUS, SLOPE, INTERCEPT,
+                                             NSLOPE, NINTERCEPT, VERBOSE):
+        return
+    (CONFIG, RADIUS, SLOPE, INTERCEPT,
+     NSLOPE, NINTERCEPT, VERBOSE) = params
+    # restraints computed again when needed
+    RESTRAINTS = None
+
+
+def _generate_batch(job):
+    """
+    Generates the models of a batch of random initial numbers.
+    """
+    params, rand_inits = job
+    _set_params(params)
+    return [(rand_init, generate_IMPmodel(rand_init))
+            for rand_init in rand_inits]
+
+
+def _generate_tagged_batch(job):
+    """
+    Generates the models of a batch of random initial numbers, returned with
+    the tag of the batch.
+    """
+    tag, job = job
+    return tag, _generate_batch(job)
+
+
+class _BestModels(object):
+    """
+    Bounded heap of the n_keep models with the lowest objective function.
+    Models pushed out of the heap are discarded, or kept apart if keep_all.
+    """
+    def __init__(self, n_keep, keep_all=False, coords_only=False):
+        self.n_keep      = n_keep
+        self.keep_all    = keep_all
+        self.coords_only = coords_only
+        self._heap       = []
+        self._bad        = []
+        self.discarded   = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def objfuns(self):
+        """
+        :returns: sorted array of the objective function of the best models
+        """
+        return np.sort([-obj for obj, _, _ in self._heap])
+
+    def contacts(self, cutoff):
+        """
+        :param cutoff: distance (nm) defining a contact
+
+        :returns: the frequencies of contact of each pair of particles among
+           the best models, as a flat array (upper triangle)
+        """
+        nloci = len(self._heap[0][2]['x'])
+        counts = np.zeros((nloci, nloci))
+        for _, _, model in self._heap:
+            coords = np.array([model['x'], model['y'], model['z']]).T
+            diff = coords[:, np.newaxis, :] - coords[np.newaxis, :, :]
+            counts += (diff ** 2).sum(axis=2) < cutoff ** 2
+        return counts[np.triu_indices(nloci, 1)] / len(self._heap)
+
+    def add(self, rand_init, model):
+        # worst model on top of the heap (ties are sorted by random initial
+        # number)
+        item = (-model['objfun'], -rand_init, model)
+        if len(self._heap) < self.n_keep:
+            heappush(self._heap, item)
+            return
+        _, rand_init, model = heappushpop(self._heap, item)
+        self.discarded += 1
+        if self.keep_all:
+            self._bad.append((-rand_init, _light_model(model)
+                              if self.coords_only else model))
+
+    def ranked(self):
+        """
+        :returns: two dictionaries of models (kept and discarded), with the
+           rank of the model as key
+        """
+        models = {}
+        bad_models = {}
+        for i, (_, _, m) in enumerate(sorted(self._heap, reverse=True)):
+            models[i] = m
+        for i, (_, m) in enumerate(sorted(
+            self._bad, key=lambda x: (x[1]['objfun'], x[0]))):
+            bad_models[i + len(models)] = m
+        return models, bad_models
+
+
+def _light_model(model):
+    """
+    Copy of a model without the log of its objective function.
+    """
+    model = IMPmodel(model)
+    model['log_objfun'] = None
+    return model
+
+
+def _iter_model_store(store):
+    """
+    Iterates over the models appended to a store file (a last record
+    truncated by an interruption is ignored).
+
+    :param store: path to the store file
+
+    :yields: the offset at the end of each record, the random initial number
+       and the model
+    """
+    inf = open(store, 'rb')
+    while True:
+        try:
+            rand_init, model = load(inf)
+        except (EOFError, UnpicklingError, ValueError, KeyError, IndexError):
+            break
+        yield inf.tell(), rand_init, model
+    inf.close()
+
+
+def multi_process_model_generation(n_cpus, n_models, n_keep, keep_all):
+    """
+    Parallelize the
+    :func:`pytadbit.imp.imp_model.StructuralModels.generate_IMPmodel`, using
+    the parameters stored in the global variables of this module.
+
+    :param n_cpus: number of CPUs to use
+    :param n_models: number of models to generate
+    """
+    engine = ModelGenerator(PDIST, len(LOCI), first=LOCI[0], n_cpus=n_cpus)
+    params = (CONFIG, RADIUS, SLOPE, INTERCEPT, NSLOPE, NINTERCEPT, VERBOSE)
+    try:
+        return engine._run(params, n_models, n_keep, START, keep_all)
+    finally:
+        engine.close()
 
 
 def generate_IMPmodel(rand_init):
@@ -439,15 +942,16 @@ def generate_IMPmodel(rand_init):
 
 def addAllHarmonics(model):
     """
-    Add harmonics to all pair of particles.
+    Add harmonics to all pair of particles (from the table of restraints
+    computed once per set of parameters).
     """
-    for i in range(len(LOCI)):
-        p1 = model['ps'].get_particle(i)
-        x = p1.get_name()
-        for j in range(i+1, len(LOCI)):
-            p2 = model['ps'].get_particle(j)
-            y = p2.get_name()
-            addHarmonicPair(model, p1, p2, x, y, j)
+    add_restraint = (addHarmonicRestraints, addHarmonicLowerBoundRestraints,
+                     addHarmonicUpperBoundRestraints,
+                     addHarmonicNeighborsRestraints)
+    particles = model['ps'].get_particles()
+    for i, j, typ, dist, kforce in zip(*[v.tolist()
+                                         for v in _get_restraint_table()]):
+        add_restraint[typ](model, particles[i], particles[j], dist, kforce)
 
 
 def addHarmonicPair(model, p1, p2, x, y, j, dry=False):
@@ -7,8 +7,7 @@
 from pytadbit.utils.extraviews      import color_residues, chimera_view
 from pytadbit.utils.extraviews      import tadbit_savefig, plot_3d_model
 from pytadbit.utils.three_dim_stats import generate_sphere_points
-from pytadbit.utils.three_dim_stats import fast_square_distance
-from pytadbit.utils.three_dim_stats import build_mesh
+from pytadbit.utils.three_dim_stats import build_mesh, mesh_occlusion
 from pytadbit.utils.extraviews      import tad_coloring
 from pytadbit.utils.extraviews      import tad_border_coloring
 from pytadbit.utils.tadmaths        import newton_raphson
@@ -189,7 +188,7 @@ class IMPmodel(dict):
                     '      X    Y    Z\n'+
                     '  %5s%5s%5s\n') % (
                 len(self['x']), self['objfun'], self['rand_init'],
-                self['x'][0], self['y'][0], self['z'][0])
+                float(self['x'][0]), float(self['y'][0]), float(self['z'][0]))
 
 
     def __len__(self):
@@ -576,51 +575,21 @@ class IMPmodel(dict):
 
         
         # calculates the number of inaccessible peaces of surface
-        if superradius:
-            radius2 = (superradius - 4)**2
-            outdot  = []
-            for x2, y2, z2 in superdots:
-                for j, (x1, y1, z1) in enumerate(points):
-                    if fast_square_distance(x1, y1, z1, x2, y2, z2) < radius2:
-                        outdot.append(False)
-                        break
-                else:
-                    outdot.append(True)
-                    continue
-                points.insert(0, points.pop(j))
-        else:
-            outdot = [False] * len(superdots)
-
-        # calculates the number of inaccessible peaces of surface
-        radius2 = (radius - 2)**2
+        outdot, inaccessible = mesh_occlusion(points, dots, superdots, radius,
+                                              superradius)
         grey    = (0.6, 0.6, 0.6)
         red     = (1, 0, 0)
         green   = (0, 1, 0)
-        colors  = []
-        for i, (x2, y2, z2) in enumerate(dots):
-            if outdot[i]:
-                colors.append(grey)
-                continue
-            for j, (x1, y1, z1) in enumerate(points):
-                if fast_square_distance(x1, y1, z1, x2, y2, z2) < radius2:
-                    colors.append(red)
-                    break
-            else:
-                colors.append(green)
-                continue
-            points.insert(0, points.pop(j))
-        possibles = colors.count(green)
+        accessible = ~(outdot | inaccessible)
+        colors  = [grey if out else red if ina else green
+                   for out, ina in zip(outdot, inaccessible)]
+        possibles = int(accessible.sum())
+        inside    = len(outdot) - int(outdot.sum())
 
         acc_parts = []
         for p in sorted(points2dots.keys()):
-            acc = 0
-            ina = 0
-            for dot in points2dots[p]:
-                if colors[dot]==green:
-                    acc += 1
-                elif colors[dot]==red:
-                    ina += 1
-            acc_parts.append((p + 1, acc, ina))
+            acc_parts.append((p + 1, int(accessible[points2dots[p]].sum()),
+                              int(inaccessible[points2dots[p]].sum())))
 
         # some stats
         dot_area = 4 * pi * (float(radius) / 1000)**2 / nump
@@ -632,9 +601,9 @@ class IMPmodel(dict):
                    '(%s accessible times %s micrometers)') % (
                 round(area, 2), possibles, dot_area)
             print '    (%s accessible dots of %s total times %s micrometers)' % (
-                possibles, outdot.count(False), round(dot_area, 5))
+                possibles, inside, round(dot_area, 5))
             print '  - %s%% of the contour mesh' % (
-                round((float(possibles)/outdot.count(False))*100, 2))
+                round((float(possibles)/inside)*100, 2))
             print '  - %s%% of a virtual straight chromatin (%s microm^2)' % (
                 round((area/total)*100, 2), round(total, 2))
 
@@ -687,7 +656,7 @@ class IMPmodel(dict):
                          chimera_bin=chimera_bin, align=False,
                          savefig=savefig, chimera_cmd=chimera_cmd)
 
-        return (possibles, outdot.count(False), area, total, acc_parts)
+        return (possibles, inside, area, total, acc_parts)
 
 
     def write_cmm(self, directory, color='index', rndname=True,
@@ -751,9 +720,10 @@ class IMPmodel(dict):
                 'radius=\"' + #str(30) +
                 str(self['radius']) +
                 '\" note=\"%s\"/>\n')
+        # coordinates may be numpy scalars, formatted as python floats
         for i in xrange(len(self['x'])):
-            out += form % (i + 1,
-                           self['x'][i], self['y'][i], self['z'][i],
+            out += form % (i + 1, float(self['x'][i]), float(self['y'][i]),
+                           float(self['z'][i]),
                            color[i][0], color[i][1], color[i][2], i + 1)
         form = ('<link id1=\"%s\" id2=\"%s\" r=\"1\" ' +
                 'g=\"1\" b=\"1\" radius=\"' + str(10) +
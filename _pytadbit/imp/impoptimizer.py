@@ -3,12 +3,15 @@
 
 
 """
-from pytadbit.imp.imp_modelling    import generate_3d_models
+from pytadbit.imp.imp_modelling    import ModelGenerator
+from pytadbit.imp.imp_modelling    import _build_structural_models
 from pytadbit.utils.extraviews     import plot_2d_optimization_result
 from pytadbit.utils.extraviews     import plot_3d_optimization_result
 from pytadbit.imp.structuralmodels import StructuralModels
 from cPickle                       import dump, load
 from sys                           import stderr
+from os.path                       import exists
+from math                          import log
 import numpy           as np
 import multiprocessing as mu
 
@@ -62,7 +65,8 @@ class IMPoptimizer(object):
                         scale_range=0.01,
                         dcutoff_range=2,
                         corr='spearman', off_diag=1,
-                        savedata=None, n_cpus=1, verbose=True):
+                        savedata=None, n_cpus=1, verbose=True,
+                        progress=None):
         """
         This function calculates the correlation between the models generated 
         by IMP and the input data for the four main IMP parameters (scale, 
@@ -89,9 +93,239 @@ class IMPoptimizer(object):
         :param None savedata: concatenate all generated models into a dictionary
            and save it into a file named by this argument
         :param True verbose: print the results to the standard output
+        :param None progress: path to a file where the result of each grid
+           point is appended as soon as it is evaluated (in the format of
+           :func:`IMPoptimizer.write_result`). If this file already exists,
+           its results are loaded and the corresponding grid points are not
+           evaluated again
+
+        Several grid points are evaluated concurrently: the models of all
+        grid points are generated by the same n_cpus workers, and the results
+        are stored (and printed) as soon as all the models of one grid point
+        are ready (the numbering of grid points follows the order of
+        completion).
         """
         if verbose:
             stderr.write('Optimizing %s particles\n' % self.nloci)
+        if progress and exists(progress):
+            self.load_from_file(progress)
+        (scale_arange, maxdist_arange, upfreq_arange, lowfreq_arange,
+         dcutoff_arange) = self._set_ranges(scale_range, maxdist_range,
+                                            upfreq_range, lowfreq_range,
+                                            dcutoff_range)
+        # grid search
+        models = {}
+        if verbose:
+            stderr.write('# %3s %6s %7s %7s %6s %7s %7s\n' % (
+                                    "num", "upfrq", "lowfrq", "maxdist",
+                                    "scale", "cutoff", "corr"))
+        # same workers (and Z-scores) for all the grid
+        engine = ModelGenerator(self.zscores, self.nloci, first=0,
+                                close_bins=self.close_bins, n_cpus=n_cpus)
+        points = [(scale, maxdist, upfreq, lowfreq)
+                  for scale in [my_round(i) for i in scale_arange]
+                  for maxdist in [my_round(i) for i in maxdist_arange]
+                  for upfreq in [my_round(i) for i in upfreq_arange]
+                  for lowfreq in [my_round(i) for i in lowfreq_arange]
+                  if not self._is_done(scale, maxdist, upfreq, lowfreq)]
+        try:
+            for count, (point, cutoff, result, tdm) in enumerate(
+                self._evaluate(engine, points, self.n_models, self.n_keep,
+                               dcutoff_arange, corr, off_diag)):
+                self._store_result(count + 1, point, cutoff, result, progress,
+                                   verbose)
+                if savedata and result:
+                    models[point + (cutoff, )] = tdm._reduce_models(
+                        minimal=True)
+        finally:
+            engine.close()
+            # models of finished grid points, even if interrupted
+            if savedata:
+                out = open(savedata, 'w')
+                dump(models, out)
+                out.close()
+        self.scale_range.sort(  key=float)
+        self.maxdist_range.sort(key=float)
+        self.lowfreq_range.sort(key=float)
+        self.upfreq_range.sort( key=float)
+        self.dcutoff_range.sort(key=float)
+
+
+    def run_adaptive_search(self,
+                            upfreq_range=(0, 1, 0.1),
+                            lowfreq_range=(-1, 0, 0.1),
+                            maxdist_range=(400, 1500, 100),
+                            scale_range=0.01,
+                            dcutoff_range=2,
+                            corr='spearman', off_diag=1,
+                            min_models=None, eta=3, refine=1,
+                            n_cpus=1, verbose=True):
+        """
+        Same search as :func:`IMPoptimizer.run_grid_search`, but with a
+        successive halving strategy: all the grid points are first evaluated
+        with few models, then only the best 1/eta of them are evaluated again
+        with eta times more models, and so on until n_models are generated
+        for the remaining grid points. Then, the region around the best grid
+        point is refined, evaluating (with n_models) the grid points in
+        between the best one and its neighbors.
+
+        All the results are stored (the last evaluation of a grid point is
+        kept, so discarded grid points have results computed with less than
+        n_models models). The best result is always computed with n_models
+        models.
+
+        :param (0,1,0.1) upfreq_range: range of upfreq values to be optimized
+           (see :func:`IMPoptimizer.run_grid_search`)
+        :param (-1,0,0.1) lowfreq_range: range of lowfreq values
+        :param (400,1400,100) maxdist_range: range of maxdist values
+        :param 0.01 scale_range: range of scale values
+        :param 2 dcutoff_range: range of distance cutoff values
+        :param spearman corr: correlation coefficient to use
+        :param 1 off_diag:
+        :param None min_models: number of models generated per grid point in
+           the first round. By default the number of rounds is the number of
+           times the number of grid points can be divided by eta
+        :param 3 eta: inverse of the fraction of grid points kept (and factor
+           of increase of the number of models) at each round, has to be an
+           integer higher than 1
+        :param 1 refine: number of refinements around the best grid point
+           (each one halves the step between values of parameters)
+        :param 1 n_cpus: number of CPUs to use
+        :param True verbose: print the results to the standard output
+        """
+        if eta < 2 or int(eta) != eta:
+            raise Exception('ERROR: eta should be an integer higher than 1\n')
+        eta = int(eta)
+        if verbose:
+            stderr.write('Optimizing %s particles\n' % self.nloci)
+        (scale_arange, maxdist_arange, upfreq_arange, lowfreq_arange,
+         dcutoff_arange) = self._set_ranges(scale_range, maxdist_range,
+                                            upfreq_range, lowfreq_range,
+                                            dcutoff_range)
+        points = [(scale, maxdist, upfreq, lowfreq)
+                  for scale in [my_round(i) for i in scale_arange]
+                  for maxdist in [my_round(i) for i in maxdist_arange]
+                  for upfreq in [my_round(i) for i in upfreq_arange]
+                  for lowfreq in [my_round(i) for i in lowfreq_arange]]
+        if min_models is None:
+            rounds = int(log(max(1, len(points))) / log(eta))
+            min_models = max(2, self.n_models / eta ** rounds)
+        n_models = min(min_models, self.n_models)
+        # number of models used to compute the result of each grid point
+        models_used = {}
+        count = [0]
+        def evaluate(points, n_models):
+            n_keep = max(1, self.n_keep * n_models / self.n_models)
+            if verbose:
+                stderr.write(('# %d grid points with %d models (keeping %d)\n'
+                              '# %3s %6s %7s %7s %6s %7s %7s\n') % (
+                                  len(points), n_models, n_keep,
+                                  "num", "upfrq", "lowfrq", "maxdist",
+                                  "scale", "cutoff", "corr"))
+            scores = {}
+            for point, cutoff, result, _ in self._evaluate(
+                engine, points, n_models, n_keep, dcutoff_arange, corr,
+                off_diag):
+                count[0] += 1
+                self._forget(point)
+                self._store_result(count[0], point, cutoff, result, None,
+                                   verbose)
+                models_used[point] = n_models
+                scores[point] = result
+            return scores
+        engine = ModelGenerator(self.zscores, self.nloci, first=0,
+                                close_bins=self.close_bins, n_cpus=n_cpus)
+        try:
+            # successive halving
+            while points:
+                scores = evaluate(points, n_models)
+                if n_models >= self.n_models:
+                    break
+                points = sorted(points, key=lambda p: -scores[p])[
+                    :max(1, len(points) / eta)]
+                n_models = (self.n_models if len(points) == 1 else
+                            min(self.n_models, n_models * eta))
+            # refinement around the best grid point
+            for _ in xrange(refine):
+                best = self._best_point(models_used)
+                if best is None:
+                    break
+                points = [p for p in self._points_around(best)
+                          if not p in models_used]
+                if not points:
+                    break
+                evaluate(points, self.n_models)
+            # the best result has to be computed with all the models
+            while self.results:
+                best = max(self.results, key=self.results.get)[:4]
+                if models_used.get(best, self.n_models) >= self.n_models:
+                    break
+                evaluate([best], self.n_models)
+        finally:
+            engine.close()
+        self.scale_range.sort(  key=float)
+        self.maxdist_range.sort(key=float)
+        self.lowfreq_range.sort(key=float)
+        self.upfreq_range.sort( key=float)
+        self.dcutoff_range.sort(key=float)
+
+
+    def _best_point(self, models_used):
+        """
+        Best grid point among the ones evaluated with n_models models.
+        """
+        best = None
+        for key, val in self.results.iteritems():
+            if models_used.get(key[:4]) < self.n_models:
+                continue
+            if best is None or val > self.results[best]:
+                best = key
+        return None if best is None else best[:4]
+
+
+    def _points_around(self, point):
+        """
+        Grid points made of the values of the given point and of the values
+        in between them and their neighbors in the ranges of the optimizer
+        (new values are added to these ranges).
+        """
+        values = []
+        for i, rng in enumerate((self.scale_range, self.maxdist_range,
+                                 self.upfreq_range, self.lowfreq_range)):
+            rng.sort(key=float)
+            pos = rng.index(point[i])
+            vals = [point[i]]
+            for nei in rng[max(0, pos - 1):pos] + rng[pos + 1:pos + 2]:
+                mid = (float(point[i]) + float(nei)) / 2
+                # maxdist is an integer
+                mid = my_round(int(round(mid)) if i == 1 else mid)
+                if not mid in rng:
+                    vals.append(mid)
+            values.append(vals)
+        points = [(scale, maxdist, upfreq, lowfreq)
+                  for scale in values[0] for maxdist in values[1]
+                  for upfreq in values[2] for lowfreq in values[3]
+                  if (scale, maxdist, upfreq, lowfreq) != point]
+        for i, rng in enumerate((self.scale_range, self.maxdist_range,
+                                 self.upfreq_range, self.lowfreq_range)):
+            rng.extend(values[i][1:])
+        return points
+
+
+    def _forget(self, point):
+        """
+        Removes the results of a grid point (with any dcutoff).
+        """
+        for cut in self.dcutoff_range:
+            self.results.pop(point + (cut, ), None)
+
+
+    def _set_ranges(self, scale_range, maxdist_range, upfreq_range,
+                    lowfreq_range, dcutoff_range):
+        """
+        Converts the ranges of parameters given to the search functions into
+        lists of values, and adds them to the ranges of the optimizer.
+        """
         if isinstance(maxdist_range, tuple):
             maxdist_step = maxdist_range[2]
             maxdist_arange = range(maxdist_range[0],
@@ -173,73 +407,102 @@ class IMPoptimizer(object):
             self.dcutoff_range = sorted([my_round(i) for i in dcutoff_arange
                                          if not my_round(i) in self.dcutoff_range] +
                                         self.dcutoff_range)
-        # grid search
-        models = {}
-        count = 0
+        return (scale_arange, maxdist_arange, upfreq_arange, lowfreq_arange,
+                dcutoff_arange)
+
+
+    def _evaluate(self, engine, points, n_models, n_keep, dcutoff_arange,
+                  corr, off_diag):
+        """
+        Generates models for a list of grid points, and correlates them with
+        the input data.
+
+        :yields: for each grid point, as soon as it is evaluated, the grid
+           point, the best dcutoff, the correlation and the StructuralModels
+           (None if the parameters are not valid)
+        """
+        good_points = []
+        params = []
+        for scale, maxdist, upfreq, lowfreq in points:
+            tmp = {'kforce'   : 5,
+                   'lowrdist' : 100,
+                   'maxdist'  : int(maxdist),
+                   'upfreq'   : float(upfreq),
+                   'lowfreq'  : float(lowfreq),
+                   'scale'    : float(scale)}
+            try:
+                params.append(engine.parameters(tmp, self.resolution))
+            except Exception, e:
+                print '  SKIPPING: %s' % e
+                yield ((scale, maxdist, upfreq, lowfreq),
+                       my_round(dcutoff_arange[0]), 0, None)
+                continue
+            good_points.append((scale, maxdist, upfreq, lowfreq))
+        # all the grid points are generated by the same workers, and
+        # evaluated as soon as their models are ready
+        for idx, good, bad in engine.generate_many(params, n_models, n_keep):
+            scale, maxdist, upfreq, lowfreq = good_points[idx]
+            tdm = None
+            try:
+                tdm = _build_structural_models(
+                    good, bad, self.zscores, self.resolution, self.values,
+                    None, None, self.zeros, None)
+                result = 0
+                cutoff = my_round(dcutoff_arange[0])
+                # distances between particles computed once for all cutoffs
+                sub_results = tdm.correlate_with_real_data_by_cutoff(
+                    [int(cut * self.resolution * float(scale))
+                     for cut in dcutoff_arange], corr=corr, off_diag=off_diag)
+                for cut, sub_result in zip(dcutoff_arange, sub_results):
+                    if result < sub_result[0]:
+                        result = sub_result[0]
+                        cutoff = my_round(cut)
+            except Exception, e:
+                print '  SKIPPING: %s' % e
+                result = 0
+                cutoff = my_round(dcutoff_arange[0])
+            yield good_points[idx], cutoff, result, tdm
+
+
+    def _is_done(self, scale, maxdist, upfreq, lowfreq):
+        """
+        True if a grid point was already evaluated (with any dcutoff).
+        """
+        return any([(scale, maxdist, upfreq, lowfreq, c) in self.results
+                    for c in self.dcutoff_range])
+
+
+    def _store_result(self, count, point, cutoff, result, progress, verbose):
+        """
+        Stores the result of one grid point, and appends it to the progress
+        file (in the format of write_result).
+        """
+        scale, maxdist, upfreq, lowfreq = point
         if verbose:
-            stderr.write('# %3s %6s %7s %7s %6s %7s %7s\n' % (
-                                    "num", "upfrq", "lowfrq", "maxdist",
-                                    "scale", "cutoff", "corr"))
-        for scale in [my_round(i) for i in scale_arange]:
-            for maxdist in [my_round(i) for i in maxdist_arange]:
-                for upfreq in [my_round(i) for i in upfreq_arange]:
-                    for lowfreq in [my_round(i) for i in lowfreq_arange]:
-                        if (scale, maxdist, upfreq, lowfreq) in self.results:
-                            continue
-                        tmp = {'kforce'   : 5,
-                               'lowrdist' : 100,
-                               'maxdist'  : int(maxdist),
-                               'upfreq'   : float(upfreq),
-                               'lowfreq'  : float(lowfreq),
-                               'scale'    : float(scale)}
-                        try:
-                            count += 1
-                            tdm = generate_3d_models(
-                                self.zscores, self.resolution,
-                                self.nloci, n_models=self.n_models,
-                                n_keep=self.n_keep, config=tmp,
-                                n_cpus=n_cpus, first=0,
-                                values=self.values,
-                                close_bins=self.close_bins, zeros=self.zeros)
-                            result = 0
-                            cutoff = my_round(dcutoff_arange[0])
-                            for cut in [i for i in dcutoff_arange]:
-                                sub_result = tdm.correlate_with_real_data(
-                                    cutoff=(int(cut * self.resolution *
-                                                float(scale))),
-                                    corr=corr,
-                                    off_diag=off_diag)[0]
-                                if result < sub_result:
-                                    result = sub_result
-                                    cutoff = my_round(cut)
-                        except Exception, e:
-                            print '  SKIPPING: %s' % e
-                            result = 0
-                            cutoff = my_round(dcutoff_arange[0])
-                        if verbose:
-                            verb = '%5s %6s %7s %7s %6s %7s  ' % (
-                                count, upfreq, lowfreq, maxdist,
-                                scale, cutoff)
-                            if verbose == 2:
-                                stderr.write(verb + str(round(result, 4))
-                                             + '\n')
-                            else:
-                                print verb + str(round(result, 4))
-                        # store
-                        self.results[(scale, maxdist,
-                                      upfreq, lowfreq, cutoff)] = result
-                        if savedata and result:
-                            models[(scale, maxdist, upfreq, lowfreq, cutoff)
-                                   ] = tdm._reduce_models(minimal=True)
-        if savedata:
-            out = open(savedata, 'w')
-            dump(models, out)
-            out.close()
-        self.scale_range.sort(  key=float)
-        self.maxdist_range.sort(key=float)
-        self.lowfreq_range.sort(key=float)
-        self.upfreq_range.sort( key=float)
-        self.dcutoff_range.sort(key=float)
+            verb = '%5s %6s %7s %7s %6s %7s  ' % (
+                count, upfreq, lowfreq, maxdist,
+                scale, cutoff)
+            if verbose == 2:
+                stderr.write(verb + str(round(result, 4))
+                             + '\n')
+            else:
+                print verb + str(round(result, 4))
+        # store
+        self.results[(scale, maxdist, upfreq, lowfreq, cutoff)] = result
+        if not progress:
+            return
+        if not exists(progress):
+            out = open(progress, 'w')
+            out.write(('## n_models: %s n_keep: %s ' +
+                       'close_bins: %s\n') % (self.n_models,
+                                              self.n_keep, self.close_bins))
+            out.write('# scale\tmax_dist\tup_freq\tlow_freq\tdcutoff\t'
+                      'correlation\n')
+        else:
+            out = open(progress, 'a')
+        out.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (
+            scale, maxdist, upfreq, lowfreq, cutoff, result))
+        out.close()
 
 
     def load_grid_search(self, filenames, corr='spearman', off_diag=1,
@@ -0,0 +1,281 @@
+"""
+10 Feb 2015
+
+Distributed generation of IMP models, through a queue of jobs stored in a
+shared directory.
+
+The coordinator (:func:`queue_3d_models`) writes the modelling parameters and
+one job file per range of random initial numbers. Workers
+(:func:`model_queue_worker`), started on any host that can see the
+directory, claim jobs by moving their files (an atomic rename), keep them
+alive by updating their modification time, and append the generated models
+to a result file per job. The coordinator (:func:`wait_model_queue`) puts
+back in the queue the jobs of workers that stopped sending signs of life,
+and :func:`collect_queued_models` merges all the results into one
+StructuralModels object.
+
+The directory contains:
+
+  - parameters.pickle: Z-scores and modelling parameters
+  - todo/: jobs waiting for a worker
+  - running/: jobs being processed (file name suffixed by host and process)
+  - done/: models generated for each job
+"""
+
+from pytadbit.imp.CONFIG        import CONFIG
+from pytadbit.imp.imp_modelling import ModelGenerator, _BestModels
+from pytadbit.imp.imp_modelling import _iter_model_store, _init_worker
+from pytadbit.imp.imp_modelling import _set_params, _build_structural_models
+from cPickle                    import load, dump
+from socket                     import gethostname
+from threading                  import Thread, Event
+from time                       import sleep
+from os                         import path, listdir, mkdir, rename, remove
+from os                         import utime, getpid, stat
+from sys                        import stdout
+
+JOB_NAME = '%010d_%010d'
+
+
+def queue_3d_models(workdir, zscores, resolution, nloci, start=1,
+                    n_models=5000, chunk_size=100, close_bins=1, config=None,
+                    first=None):
+    """
+    Creates a queue of jobs to generate IMP models. Each job consists in
+    generating the models of a range of random initial numbers.
+
+    :param workdir: directory shared by the coordinator and the workers
+    :param zscores: the dictionary of the Z-score values calculated from the
+       Hi-C pairwise interactions
+    :param resolution:  number of nucleotides per Hi-C bin
+    :param nloci: number of particles to model
+    :param 1 start: random initial number of the first model
+    :param 5000 n_models: number of models to generate
+    :param 100 chunk_size: number of models generated in each job
+    :param 1 close_bins: number of particles away (i.e. the bin number
+       difference) a particle pair must be in order to be considered as
+       neighbors (e.g. 1 means consecutive particles)
+    :param None config: a dictionary containing the standard parameters used
+       to generate the models (see
+       :func:`pytadbit.imp.imp_modelling.generate_3d_models`)
+    :param None first: particle number at which model should start (0 should
+       be used inside TADbit)
+    """
+    for dirname in ('', 'todo', 'running', 'done'):
+        if not path.exists(path.join(workdir, dirname)):
+            mkdir(path.join(workdir, dirname))
+    if path.exists(path.join(workdir, 'parameters.pickle')):
+        raise Exception('ERROR: a queue of models already exists in %s\n' % (
+            workdir))
+    config = dict(config or CONFIG['dmel_01'])
+    # check parameters before sending them to workers
+    ModelGenerator(zscores, nloci, first=first,
+                   close_bins=close_bins).parameters(dict(config), resolution)
+    tmp = path.join(workdir, 'parameters.pickle_')
+    out = open(tmp, 'w')
+    dump({'zscores'   : zscores,
+          'resolution': resolution,
+          'nloci'     : nloci,
+          'first'     : first,
+          'close_bins': close_bins,
+          'config'    : config}, out)
+    out.close()
+    for beg in xrange(start, start + n_models, chunk_size):
+        end = min(beg + chunk_size, start + n_models)
+        open(path.join(workdir, 'todo', JOB_NAME % (beg, end)), 'w').close()
+    rename(tmp, path.join(workdir, 'parameters.pickle'))
+
+
+def _load_parameters(workdir):
+    inf = open(path.join(workdir, 'parameters.pickle'))
+    params = load(inf)
+    inf.close()
+    return params
+
+
+def _claim_job(workdir):
+    """
+    Moves the first available job to the running directory.
+
+    :returns: the name of the job and the path to its running file, or None
+    """
+    suffix = '.%s.%d' % (gethostname(), getpid())
+    for job in sorted(listdir(path.join(workdir, 'todo'))):
+        running = path.join(workdir, 'running', job + suffix)
+        try:
+            rename(path.join(workdir, 'todo', job), running)
+        except OSError: # another worker was faster
+            continue
+        # rename keeps the time at which the job was queued, the coordinator
+        # would take it back before the first heartbeat
+        utime(running, None)
+        return job, running
+    return None
+
+
+def _keep_alive(fname, stop, heartbeat):
+    """
+    Updates the modification time of a file until stop is set.
+    """
+    while not stop.wait(heartbeat):
+        try:
+            utime(fname, None)
+        except OSError: # job was taken back by the coordinator
+            pass
+
+
+def model_queue_worker(workdir, n_cpus=1, heartbeat=30, verbose=0):
+    """
+    Generates models from the jobs of a queue, until it is empty. Several
+    workers can process the same queue, from the same or from different
+    hosts.
+
+    :param workdir: directory of the queue (see :func:`queue_3d_models`)
+    :param 1 n_cpus: number of CPUs to use
+    :param 30 heartbeat: time (in seconds) between two signs of life sent to
+       the coordinator (see timeout in :func:`wait_model_queue`)
+    :param 0 verbose: verbosity of the model generation
+
+    :returns: the number of jobs processed
+    """
+    params = _load_parameters(workdir)
+    engine = ModelGenerator(params['zscores'], params['nloci'],
+                            first=params['first'],
+                            close_bins=params['close_bins'], n_cpus=n_cpus)
+    count = 0
+    try:
+        while True:
+            claimed = _claim_job(workdir)
+            if not claimed:
+                break
+            job, running = claimed
+            beg, end = [int(i) for i in job.split('_')]
+            if verbose:
+                stdout.write('Generating models %d to %d\n' % (beg, end - 1))
+            stop = Event()
+            alive = Thread(target=_keep_alive, args=(running, stop, heartbeat))
+            alive.daemon = True
+            alive.start()
+            tmp = path.join(workdir, 'done', '.' + path.split(running)[1])
+            try:
+                engine.generate(dict(params['config']), params['resolution'],
+                                end - beg, 0, start=beg, verbose=verbose,
+                                store=tmp)
+            finally:
+                stop.set()
+                alive.join()
+            rename(tmp, path.join(workdir, 'done', job))
+            try:
+                remove(running)
+            except OSError: # job was taken back by the coordinator
+                pass
+            count += 1
+    finally:
+        engine.close()
+    return count
+
+
+def model_queue_status(workdir):
+    """
+    :param workdir: directory of the queue (see :func:`queue_3d_models`)
+
+    :returns: the number of jobs waiting, running and done
+    """
+    return tuple([len([f for f in listdir(path.join(workdir, dirname))
+                       if not f.startswith('.')])
+                  for dirname in ('todo', 'running', 'done')])
+
+
+def _requeue_lost_jobs(workdir, timeout):
+    """
+    Puts back in the queue the running jobs whose file was not updated during
+    timeout seconds, and removes the running files of jobs already done.
+    """
+    clock = path.join(workdir, '.clock')
+    open(clock, 'a').close()
+    utime(clock, None)
+    now = stat(clock).st_mtime
+    done = set(listdir(path.join(workdir, 'done')))
+    for running in listdir(path.join(workdir, 'running')):
+        job = running.split('.')[0]
+        fname = path.join(workdir, 'running', running)
+        try:
+            if job in done:
+                remove(fname)
+            elif now - stat(fname).st_mtime > timeout:
+                rename(fname, path.join(workdir, 'todo', job))
+        except OSError: # worker has just finished the job
+            pass
+
+
+def wait_model_queue(workdir, timeout=300, poll=10, verbose=False):
+    """
+    Waits for all the jobs of a queue to be done, putting back in the queue
+    the jobs of workers that did not send signs of life during timeout
+    seconds (the times compared are the modification times of files in
+    workdir, so that hosts do not need synchronized clocks).
+
+    :param workdir: directory of the queue (see :func:`queue_3d_models`)
+    :param 300 timeout: time (in seconds) after which a silent worker is
+       considered lost. Has to be larger than the heartbeat of the workers
+    :param 10 poll: time (in seconds) between two checks of the queue
+    :param False verbose: print the state of the queue at each check
+    """
+    while True:
+        _requeue_lost_jobs(workdir, timeout)
+        todo, running, done = model_queue_status(workdir)
+        if verbose:
+            stdout.write('%d jobs waiting, %d running, %d done\n' % (
+                todo, running, done))
+        if not todo and not running:
+            break
+        sleep(poll)
+
+
+def collect_queued_models(workdir, n_keep=1000, keep_all=False,
+                          coords_only=False, values=None, experiment=None,
+                          coords=None, zeros=None, outfile=None):
+    """
+    Merges the models generated by the workers of a queue (duplicated models,
+    from jobs processed twice, are counted once).
+
+    :param workdir: directory of the queue (see :func:`queue_3d_models`)
+    :param 1000 n_keep: number of models used in the final analysis. The
+       models are ranked according to their objective function value (the
+       lower the better)
+    :param False keep_all: whether or not to keep the discarded models
+    :param False coords_only: do not keep the log of the objective function
+       of the discarded models
+    :param None values: the normalized Hi-C data in a list of lists
+    :param None experiment: experiment from which to do the modelling (used
+       only for descriptive purpose)
+    :param None coords: a dictionary with the coordinates of the modelled
+       region (see :func:`pytadbit.imp.imp_modelling.generate_3d_models`)
+    :param None zeros: list of particles with no data
+    :param None outfile: if given, the models are stored in this file (as with
+       :func:`pytadbit.imp.imp_modelling.generate_3d_models`)
+
+    :returns: a StructuralModels object (None if outfile)
+    """
+    params = _load_parameters(workdir)
+    best = _BestModels(n_keep, keep_all, coords_only)
+    seen = set()
+    for job in sorted(listdir(path.join(workdir, 'done'))):
+        if job.startswith('.'):
+            continue
+        for _, rand_init, model in _iter_model_store(
+            path.join(workdir, 'done', job)):
+            if rand_init in seen:
+                continue
+            seen.add(rand_init)
+            best.add(rand_init, model)
+    models, bad_models = best.ranked()
+    # global variables needed to build the StructuralModels object
+    engine = ModelGenerator(params['zscores'], params['nloci'],
+                            first=params['first'],
+                            close_bins=params['close_bins'])
+    _init_worker(engine.zscores, engine.loci)
+    _set_params(engine.parameters(params['config'], params['resolution']))
+    return _build_structural_models(models, bad_models, params['zscores'],
+                                    params['resolution'], values, experiment,
+                                    coords, zeros, outfile)
@@ -1,27 +1,32 @@
 """
 19 Jul 2013
 """
-from pytadbit.utils.three_dim_stats import calc_consistency, mass_center
-from pytadbit.utils.three_dim_stats import dihedral, calc_eqv_rmsd
-from pytadbit.utils.three_dim_stats import get_center_of_mass, distance
-from pytadbit.utils.tadmaths        import calinski_harabasz, nozero_log_list
-from pytadbit.utils.tadmaths        import mean_none
+from pytadbit.utils.three_dim_stats import calc_consistencies, superimpose
+from pytadbit.utils.three_dim_stats import dihedrals, calc_eqv_rmsd
+from pytadbit.utils.three_dim_stats import particle_distances
+from pytadbit.utils.three_dim_stats import angles_from_distances
+from pytadbit.utils.three_dim_stats import eqv_rmsd_condensed
+from pytadbit.utils.tadmaths        import calinski_harabasz_linkage
+from pytadbit.utils.tadmaths        import nozero_log_list
+from pytadbit.utils.tadmaths        import markov_clustering
 from pytadbit.utils.extraviews      import plot_3d_model
 from pytadbit.utils.extraviews      import chimera_view, tadbit_savefig
 from pytadbit.utils.extraviews      import augmented_dendrogram, plot_hist_box
 from pytadbit.imp.impmodel          import IMPmodel
-from pytadbit.centroid              import centroid_wrapper
-from pytadbit.aligner3d             import aligner3d_wrapper
+from pytadbit.imp.ensemble_file     import EnsembleFile, write_ensemble
+from pytadbit.imp.ensemble_file     import is_ensemble_file
 from cPickle                        import load, dump
 from subprocess                     import Popen, PIPE
-from math                           import acos, degrees, pi, sqrt, isnan
+from math                           import degrees, pi, sqrt, isnan
 from numpy                          import median as np_median
 from numpy                          import mean as np_mean
 from numpy                          import std as np_std, log2
-from numpy                          import array, cross, dot, ma, isnan
+from numpy                          import array, cross, ma, isnan
 from numpy                          import histogram, linspace
 from numpy.linalg                   import norm
 from scipy.cluster.hierarchy        import linkage, fcluster
+from scipy.spatial.distance         import pdist, squareform
+from scipy                          import sparse
 from scipy.stats                    import spearmanr, pearsonr, chisquare
 from scipy.stats                    import linregress
 from scipy.stats                    import normaltest, norm as sc_norm
@@ -29,10 +34,13 @@ from warnings                       import warn
 from string                         import uppercase as uc, lowercase as lc
 from random                         import random
 from os.path                        import exists
+from sys                            import stdout, stderr
 from pytadbit.utils.extraviews      import tad_coloring
 from pytadbit.utils.extraviews      import tad_border_coloring
 from pytadbit.utils.extraviews      import color_residues, chimera_view
 from pytadbit                       import get_dependencies_version
+import multiprocessing as mu
+import numpy as np
 import uuid
 
 try:
@@ -42,16 +50,23 @@ except ImportError:
     warn('matplotlib not found\n')
 
 
-def load_structuralmodels(path_f):
+def load_structuralmodels(path_f, minimal=False):
     """
     Loads :class:`pytadbit.imp.structuralmodels.StructuralModels` from a file
     (generated with
     :class:`pytadbit.imp.structuralmodels.StructuralModels.save_models`).
     
-    :param path: to the pickled StructuralModels object.
+    :param path: to the pickled StructuralModels object, or to the binary
+       ensemble file (see :mod:`pytadbit.imp.ensemble_file`). In the later
+       case coordinates are memory-mapped, not read in memory.
+    :param False minimal: with binary ensemble files, do not load the log of
+       the objective function of the models, nor the Z-scores, the restraints
+       and the Hi-C data
 
     :returns: a :class:`pytadbit.imp.imp_model.StructuralModels`.
     """
+    if is_ensemble_file(path_f):
+        return _load_ensemble(path_f, minimal)
     svd = load(open(path_f))
     try:
         return StructuralModels(
@@ -67,6 +82,34 @@ def load_structuralmodels(path_f):
             clusters=svd['clusters'], config=svd['config'], zscores=svd['zscore'],
             restraints=svd['restraints'])
 
+def _load_ensemble(path_f, minimal=False):
+    """
+    Loads a StructuralModels object from a binary ensemble file, with
+    memory-mapped coordinates.
+    """
+    ens    = EnsembleFile(path_f)
+    meta   = ens.section('meta')
+    objfun = ens.objfun()
+    logs   = None if minimal else ens.section('log_objfun')
+    allmodels = []
+    for row, desc in enumerate(meta['models']):
+        model = IMPmodel(desc)
+        model['objfun'] = float(objfun[row])
+        model['log_objfun'] = logs[row] if logs else None
+        allmodels.append(model)
+    models     = dict(zip(meta['keys'], allmodels[:ens.nmodels]))
+    bad_models = dict(zip(meta['bad_keys'], allmodels[ens.nmodels:]))
+    return StructuralModels(
+        nloci=ens.nloci, models=models, bad_models=bad_models,
+        resolution=meta['resolution'], clusters=meta['clusters'],
+        config=meta['config'], zeros=meta['zeros'],
+        description=meta['description'],
+        original_data=None if minimal else ens.section('original_data'),
+        zscores=None if minimal else ens.section('zscores'),
+        restraints=None if minimal else ens.section('restraints'),
+        coordinates=ens.coordinates(mode='c'))
+
+
 class StructuralModels(object):
     """
     This class contains three-dimensional models generated from a single Hi-C
@@ -90,13 +133,21 @@ class StructuralModels(object):
        :class:`pytadbit.imp.structuralmodels.ClusterOfModels`
     :param None config: a dictionary containing the parameter to be used for the
        generation of three dimensional models.
+    :param None coordinates: an array of shape (number of models and bad models,
+       number of particles, 3) with the coordinates of the models (sorted by
+       key, the models first), to be used instead of their 'x', 'y' and 'z'
+       entries
+
+    The coordinates of all the models are stored in a single array, and the
+    'x', 'y' and 'z' coordinates of each model are views of this array (they
+    can be modified in place, or replaced by new lists).
 
     """
 
     def __init__(self, nloci, models, bad_models, resolution,
                  original_data=None, zscores=None, clusters=None,
                  config=None, experiment=None, zeros=None, restraints=None,
-                 description=None):
+                 description=None, coordinates=None):
 
         self.__models       = models
         self._bad_models    = bad_models
@@ -110,6 +161,67 @@ class StructuralModels(object):
         self.experiment     = experiment
         self._restraints    = restraints
         self.description    = description
+        self._share_coordinates(coordinates)
+
+    def _share_coordinates(self, coordinates=None):
+        """
+        Stores the coordinates of all the models (best and bad ones) in a
+        single array of shape (number of models, number of particles, 3). The
+        'x', 'y' and 'z' entries of each model become views of this array.
+        The row of each model is found from its identity (the model itself is
+        kept along with its row, so that its id can not be reused).
+
+        :param None coordinates: array to use, instead of copying the
+           coordinates of the models in a new one
+        """
+        allmodels = ([self.__models[k] for k in sorted(self.__models)] +
+                     [self._bad_models[k] for k in sorted(self._bad_models)])
+        self._rows = {}
+        if coordinates is not None:
+            self._coords = coordinates
+            for row, model in enumerate(allmodels):
+                self._rows[id(model)] = row, model
+                for k, axis in enumerate(('x', 'y', 'z')):
+                    model[axis] = self._coords[row, :, k]
+            return
+        self._coords = np.empty((len(allmodels), self.nloci, 3))
+        for row, model in enumerate(allmodels):
+            self._rows[id(model)] = row, model
+            self._link_model(model, row)
+
+
+    def _link_model(self, model, row):
+        for k, axis in enumerate(('x', 'y', 'z')):
+            self._coords[row, :, k] = model[axis]
+            model[axis] = self._coords[row, :, k]
+
+
+    def _coordinates(self, models, particles=None):
+        """
+        :param models: list of indexes of models
+        :param None particles: list of indexes of particles (starting at 0),
+           all by default
+
+        :returns: an array with the coordinates of the given models, of shape
+           (number of models, number of particles, 3)
+        """
+        rows = []
+        for m in models:
+            model = self[m]
+            if self._rows.get(id(model), (None, None))[1] is not model:
+                # models were added or replaced since the array was built
+                self._share_coordinates()
+            row = self._rows[id(model)][0]
+            # coordinates may have been replaced by new lists
+            if not all(isinstance(model[axis], np.ndarray) and
+                       model[axis].base is self._coords
+                       for axis in ('x', 'y', 'z')):
+                self._link_model(model, row)
+            rows.append(row)
+        if particles is None:
+            return np.asarray(self._coords[rows], dtype=float)
+        return np.asarray(self._coords[np.ix_(rows, particles)], dtype=float)
+
 
     def __getitem__(self, nam):
         if isinstance(nam, str):
@@ -168,38 +280,23 @@ class StructuralModels(object):
            each model
         :param None reference_model: align given model to reference model
         """
-        if models:
-            models = [m if isinstance(m, int) else self[m]['index']
-                      if isinstance(m, str) else m['index'] for m in models]
-        elif cluster > -1:
-            models = [self[str(m)]['index'] for m in self.clusters[cluster]]
-        else:
-            models = [m for m in self.__models]
+        models = self._select_models(models, cluster)
         ref_model = models[0] if reference_model is None else reference_model
-        firstx, firsty, firstz = (self[ref_model]['x'],
-                                  self[ref_model]['y'],
-                                  self[ref_model]['z'])
-        aligned = []
-        for sec in models[1 if reference_model is None else 0:]:
-            coords = aligner3d_wrapper(firstx, firsty, firstz,
-                                       self[sec]['x'],
-                                       self[sec]['y'],
-                                       self[sec]['z'],
-                                       self._zeros,
-                                       self.nloci)
-            if in_place:
-                self[sec]['x'], self[sec]['y'], self[sec]['z'] = coords
-            else:
-                aligned.append(coords)
-
+        models = models[1 if reference_model is None else 0:]
+        coords, reference = superimpose(
+            self._coordinates(models),
+            self._coordinates([ref_model])[0], self._zeros)
         if in_place:
-            mass_center(self[ref_model]['x'], self[ref_model]['y'],
-                        self[ref_model]['z'], self._zeros)
+            for sec, xyz in zip(models, coords):
+                self[sec]['x'][:] = xyz[:, 0]
+                self[sec]['y'][:] = xyz[:, 1]
+                self[sec]['z'][:] = xyz[:, 2]
+            self[ref_model]['x'][:] = reference[:, 0]
+            self[ref_model]['y'][:] = reference[:, 1]
+            self[ref_model]['z'][:] = reference[:, 2]
         else:
-            x, y, z = (self[ref_model]['x'][:], self[ref_model]['y'][:],
-                       self[ref_model]['z'][:])
-            mass_center(x, y, z, self._zeros)
-            aligned.insert(ref_model, (x, y, z))
+            aligned = [xyz.T.tolist() for xyz in coords]
+            aligned.insert(ref_model, tuple(reference.T.tolist()))
             return aligned
 
 
@@ -242,27 +339,18 @@ class StructuralModels(object):
         :returns: the centroid model of a given group of models (the most model
            representative)
         """
-        if models:
-            models = [m if isinstance(m, int) else self[m]['index']
-                      if isinstance(m, str) else m['index'] for m in models]
-        elif cluster > -1:
-            models = [self[str(m)]['index'] for m in self.clusters[cluster]]
-        else:
-            models = [m for m in self.__models]
+        models = self._select_models(models, cluster)
         # remove particles with zeros from calculation
-        x = []
-        y = []
-        z = []
-        for model in xrange(len(models)):
-            x.append([self[model]['x'][i] for i in xrange(self.nloci)
-                      if self._zeros[i]])
-            y.append([self[model]['y'][i] for i in xrange(self.nloci)
-                      if self._zeros[i]])
-            z.append([self[model]['z'][i] for i in xrange(self.nloci)
-                      if self._zeros[i]])
-        zeros = tuple([True for _ in xrange(len(x[0]))])
-        idx = centroid_wrapper(x, y, z, zeros, len(x[0]), len(models),
-                               int(verbose), 0)
+        coords = self._coordinates(models)
+        if self._zeros:
+            coords = coords[:, [i for i in xrange(self.nloci)
+                                if self._zeros[i]]]
+        coords, reference = superimpose(coords[1:], coords[0])
+        avg, dists = self._average(coords, reference)
+        if verbose:
+            for idx in sorted(xrange(len(models)), key=lambda i: dists[i]):
+                stderr.write('%s rmsd2avg %s\n' % (idx, dists[idx]))
+        idx = int(np.argmin(dists))
         return models[idx]
 
 
@@ -282,23 +370,15 @@ class StructuralModels(object):
            ARTIFICIAL model)
 
         """
-        if models:
-            models = [m if isinstance(m, int) else self[m]['index']
-                      if isinstance(m, str) else m['index'] for m in models]
-        elif cluster > -1:
-            models = [self[str(m)]['index'] for m in self.clusters[cluster]]
-        else:
-            models = [m for m in self.__models]
-        # remove particles with zeros from calculation
-        x = []
-        y = []
-        z = []
-        for model in xrange(len(models)):
-            x.append([self[model]['x'][i] for i in xrange(self.nloci)])
-            y.append([self[model]['y'][i] for i in xrange(self.nloci)])
-            z.append([self[model]['z'][i] for i in xrange(self.nloci)])
-        idx = centroid_wrapper(x, y, z, self._zeros, len(x[0]), len(models),
-                               int(verbose), 1)
+        models = self._select_models(models, cluster)
+        coords, reference = superimpose(self._coordinates(models[1:]),
+                                        self._coordinates(models[:1])[0],
+                                        self._zeros)
+        avg, dists = self._average(coords, reference)
+        if verbose:
+            for idx in sorted(xrange(len(models)), key=lambda i: dists[i]):
+                stderr.write('%s rmsd2avg %s\n' % (idx, dists[idx]))
+        idx = avg.T.tolist()
         avgmodel = IMPmodel((('x', idx[0]), ('y', idx[1]), ('z', idx[2]),
                              ('rand_init', 'avg'), ('objfun', None),
                              ('radius', float(self.resolution *
@@ -306,6 +386,22 @@ class StructuralModels(object):
         return avgmodel
 
 
+    @staticmethod
+    def _average(coords, reference):
+        """
+        :param coords: array of coordinates of models superimposed onto a
+           reference model (see
+           :func:`pytadbit.utils.three_dim_stats.superimpose`)
+        :param reference: centered coordinates of the reference model
+
+        :returns: the coordinates of the average model (reference included),
+           and the RMSD of each model (reference first) to this average
+        """
+        coords = np.concatenate((reference[None], coords))
+        avg = coords.mean(axis=0)
+        return avg, np.sqrt(((coords - avg)**2).sum(axis=2).mean(axis=1))
+
+
     def cluster_models(self, fact=0.75, dcutoff=None, method='mcl',
                        mcl_bin='mcl', tmp_file=None, verbose=True, n_cpus=1,
                        mclargs=None, external=False, what='score'):
@@ -331,18 +427,23 @@ class StructuralModels(object):
         :param None dcutoff: distance threshold (nm) to determine if two
            particles are in contact, default is 1.5 times resolution times scale
         :param 'mcl' method: clustering method to use, which can be either
-           'mcl' or 'ward'. MCL method is recommended. WARD method uses a scipy
-           implementation of this hierarchical clustering, and selects the best
-           number of clusters using the
+           'mcl', 'mcl-native' or 'ward'. MCL method is recommended, with
+           'mcl' the external mcl program is used, with 'mcl-native' the
+           clustering is done in TADbit (see
+           :func:`pytadbit.utils.tadmaths.markov_clustering`). WARD method
+           uses a scipy implementation of this hierarchical clustering, and
+           selects the best number of clusters using the
            :func:`pytadbit.utils.tadmaths.calinski_harabasz` function.
         :param 'mcl' mcl_bin: path to the mcl executable file, in case of the
            'mcl is not in the PATH' warning message
         :param None tmp_file: path to a temporary file created during
            the clustering computation. Default will be created in /tmp/ folder
         :param True verbose: same as print StructuralModels.clusters
-        :param 1 n_cpus: number of cpus to use in MCL clustering
+        :param 1 n_cpus: number of cpus to use in the comparison of models,
+           and in MCL clustering
         :param mclargs: list with any other command line argument to be passed
-           to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0'])
+           to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0']). With
+           'mcl-native', only the inflation (-I) is used
         :param False external: if True returns the cluster found instead of
            storing it as StructuralModels.clusters
         :param 'score' what: Statistic used for clustering. Can be one of
@@ -353,34 +454,44 @@ class StructuralModels(object):
             ''.join([(uc + lc)[int(random() * 52)] for _ in xrange(4)]))
         if not dcutoff:
             dcutoff = int(1.5 * self.resolution * self._config['scale'])
-        scores = calc_eqv_rmsd(self.__models, self.nloci, self._zeros, dcutoff,
-                               what=what, normed=True)
         from distutils.spawn import find_executable
-        if not find_executable(mcl_bin):
+        if method == 'mcl' and not find_executable(mcl_bin):
             print('\nWARNING: MCL not found in path using WARD clustering\n')
             method = 'ward'
+        if method == 'mcl':
+            scores = calc_eqv_rmsd(self.__models, self.nloci, self._zeros,
+                                   dcutoff, what=what, normed=True,
+                                   n_cpus=n_cpus)
+        else:
+            scores = eqv_rmsd_condensed(self._coordinates(range(len(self))),
+                                        self._zeros, dcutoff, what=what,
+                                        normed=True, n_cpus=n_cpus)
         # Initialize cluster definition of models:
         for model in self:
             model['cluster'] = 'Singleton'
+        new_singles = 0
         if method == 'ward':
-
-            matrix = [[0.0 for _ in xrange(len(self))]
-                      for _ in xrange(len(self))]
-            for (i, j), score in scores.iteritems():
-                matrix[i][j] = score if score > fact * self.nloci else 0.0
-            clust = linkage(matrix, method='ward')
-            # score each possible cut in hierarchical clustering
-            solutions = {}
-            for k in clust[:,2]:
-                clusters = ClusterOfModels()
-                _ = [clusters.setdefault(j, []).append(i) for i, j in
-                     enumerate(fcluster(clust, k, criterion='distance'))]
-                solutions[k] = {'out': clusters}
-                solutions[k]['score'] = calinski_harabasz(scores, clusters)
+            # each model is described by its scores against all the others
+            matrix = squareform(np.where(scores > fact * self.nloci,
+                                         scores, 0.0))
+            clust = linkage(pdist(matrix), method='ward')
+            # score each possible cut in hierarchical clustering (the cut at
+            # a given height includes all the merges up to this height)
+            ch_scores = calinski_harabasz_linkage(scores, clust)
+            heights = clust[:, 2]
+            cuts = np.append(heights[1:] != heights[:-1], True)
+            best = None
+            for step in np.flatnonzero(cuts & (ch_scores > 0)).tolist():
+                if best is None or ch_scores[step] > ch_scores[best]:
+                    best = step
+            if best is None:
+                raise Exception('ERROR: no clustering found, try changing ' +
+                                '"dcutoff", now: %s\n' % (dcutoff))
             # take best cluster according to calinski_harabasz score
-            clusters = [solutions[s] for s in sorted(
-                solutions, key=lambda x: solutions[x]['score'])
-                         if solutions[s]['score']>0][-1]['out']
+            clusters = ClusterOfModels()
+            _ = [clusters.setdefault(j, []).append(i) for i, j in
+                 enumerate(fcluster(clust, heights[best],
+                                    criterion='distance'))]
             # sort clusters, the more populated, the first.
             clusters = dict([(i + 1, j) for i, j in
                              enumerate(sorted(clusters.values(),
@@ -396,31 +507,23 @@ class StructuralModels(object):
                 self.clusters[cluster].sort(
                     key=lambda x: self[str(x)]['objfun'])
         else:
-            out_f = open(tmp_file, 'w')
-            uniqs = list(set([tuple(sorted((m1, m2))) for m1, m2 in scores]))
             cut = fact * (self.nloci - self._zeros.count(False))
-            for md1, md2 in uniqs:
-                score = scores[(md1, md2)]
-                if score >= cut:
-                    out_f.write('model_%s\tmodel_%s\t%s\n' % (md1, md2, score))
-            out_f.close()
-            Popen('%s %s --abc -te %s -V all -o %s.mcl %s' % (
-                mcl_bin, tmp_file, n_cpus, tmp_file, ' '.join(
-                    mclargs or [])), stdout=PIPE, stderr=PIPE,
-                  shell=True).communicate()
+            if method == 'mcl-native':
+                groups = self._native_mcl(scores, cut, mclargs, n_cpus)
+                if not groups:
+                    raise Exception('Problem with clustering, try ' +
+                                    'increasing "dcutoff", now: %s\n' % (
+                                        dcutoff))
+            else:
+                groups = self._external_mcl(scores, cut, dcutoff, mcl_bin,
+                                            tmp_file, mclargs, n_cpus)
             clusters = ClusterOfModels()
-            if not exists(tmp_file + '.mcl'):
-                raise Exception('Problem with clustering, try increasing ' +
-                                '"dcutoff", now: %s\n' % (dcutoff))
-            new_singles = 0
-            for cluster, line in enumerate(open(tmp_file + '.mcl')):
-                models = line.split()
+            for cluster, models in enumerate(groups):
                 if len(models) == 1:
                     new_singles += 1
                 else:
                     clusters[cluster + 1] = []
                     for model in models:
-                        model = int(model.split('_')[1])
                         if not external:
                             self[model]['cluster'] = cluster + 1
                         clusters[cluster + 1].append(
@@ -438,6 +541,63 @@ class StructuralModels(object):
             print self.clusters
 
 
+    def _external_mcl(self, scores, cut, dcutoff, mcl_bin, tmp_file, mclargs,
+                      n_cpus):
+        """
+        Clusters the models with the mcl program.
+
+        :returns: a list of clusters (lists of model indexes), the more
+           populated first
+        """
+        out_f = open(tmp_file, 'w')
+        uniqs = list(set([tuple(sorted((m1, m2))) for m1, m2 in scores]))
+        for md1, md2 in uniqs:
+            score = scores[(md1, md2)]
+            if score >= cut:
+                out_f.write('model_%s\tmodel_%s\t%s\n' % (md1, md2, score))
+        out_f.close()
+        Popen('%s %s --abc -te %s -V all -o %s.mcl %s' % (
+            mcl_bin, tmp_file, n_cpus, tmp_file, ' '.join(
+                mclargs or [])), stdout=PIPE, stderr=PIPE,
+              shell=True).communicate()
+        if not exists(tmp_file + '.mcl'):
+            raise Exception('Problem with clustering, try increasing ' +
+                            '"dcutoff", now: %s\n' % (dcutoff))
+        return [[int(model.split('_')[1]) for model in line.split()]
+                for line in open(tmp_file + '.mcl')]
+
+
+    def _native_mcl(self, scores, cut, mclargs, n_cpus):
+        """
+        Clusters the models with
+        :func:`pytadbit.utils.tadmaths.markov_clustering`. As with the mcl
+        program, models without any score above the cut are left out.
+
+        :param scores: condensed array of pairwise scores
+
+        :returns: a list of clusters (lists of model indexes), the more
+           populated first
+        """
+        mclargs = list(mclargs or [])
+        inflation = (float(mclargs[mclargs.index('-I') + 1])
+                     if '-I' in mclargs else 2.0)
+        nmodels = len(self)
+        rows, cols = np.triu_indices(nmodels, 1)
+        edges = scores >= cut
+        rows, cols, weights = rows[edges], cols[edges], scores[edges]
+        nodes = np.unique(np.concatenate((rows, cols)))
+        if not len(nodes):
+            return []
+        # renumber the models present in the graph
+        index = np.zeros(nmodels, dtype=int)
+        index[nodes] = np.arange(len(nodes))
+        matrix = sparse.coo_matrix((weights, (index[rows], index[cols])),
+                                   shape=(len(nodes), len(nodes)))
+        groups = markov_clustering(matrix + matrix.T, inflation=inflation,
+                                   n_cpus=n_cpus)
+        return [nodes[group].tolist() for group in groups]
+
+
     def _build_distance_matrix(self, n_best_clusters):
         """
         """
@@ -555,74 +715,46 @@ class StructuralModels(object):
             raise Exception('Sorry not enough colors to do this :)')
         colors = ['grey', 'darkgreen', 'darkblue', 'purple', 'darkorange',
                   'darkred'][-len(steps):]
-        dists = []
-        if models:
-            models = [m if isinstance(m, int) else self[m]['index']
-                      if isinstance(m, str) else m['index'] for m in models]
-        elif cluster > -1:
-            models = [self[str(m)]['index'] for m in self.clusters[cluster]]
-        else:
-            models = [m for m in self.__models]
-        for i, (part1, part2) in enumerate(zip(range(self.nloci - interval),
-                                          range(interval, self.nloci))):
-            if not self._zeros[i] or not self._zeros[i + interval]:
-                dists.append([None] * len(models))
-                continue
-            if mass_center:
-                subdists = []
-                for m in models:
-                    coord1 = get_center_of_mass(
-                        self[m]['x'][part1:part1+interval],
-                        self[m]['y'][part1:part1+interval],
-                        self[m]['z'][part1:part1+interval])
-                    coord2 = get_center_of_mass(
-                        self[m]['x'][part2:part2+interval],
-                        self[m]['y'][part2:part2+interval],
-                        self[m]['z'][part2:part2+interval])
-                    subdists.append(distance(coord1, coord2))
-                dists.append(subdists)
-            else:
-                dists.append(self.median_3d_dist(
-                    part1 + 1, part2 + 1, models,
-                    cluster, plot=False, median=False))
-        lmodels = len(dists[0])
-        distsk = {1: [None for _ in range(interval/2)] + dists}
-        for k in (steps[1:] if steps[0] == 1 else steps):
-            distsk[k] = [None for _ in range(k/2+interval/2)]
-            for i in range(self.nloci - k - interval + 1):
-                distsk[k].append(reduce(lambda x, y: x + y,
-                                        [dists[i+j] for j in range(k)]))
-                if k == 1:
-                    continue
-                # calculate the mean for steps larger than 1
-                distsk[k][-1] = [mean_none([distsk[k][-1][i+lmodels*j]
-                                                  for j in xrange(k)])
-                                 for i in xrange(lmodels)]
-        new_distsk = {}
-        errorp     = {}
-        errorn     = {}
-        for k, dists in distsk.iteritems():
-            new_distsk[k] = []
-            errorp[k] = []
-            errorn[k] = []
-            for i, part in enumerate(dists):
-                if not part:
-                    new_distsk[k].append(None)
-                    errorp[k].append(None)
-                    errorn[k].append(None)
-                    continue
-                part = [interval * self.resolution / p  if p != None
-                        else float('nan') for p in part]
-                new_distsk[k].append(np_median(part))
-                try:
-                    errorn[k].append(new_distsk[k][-1] - 2 * np_std(part))
-                    errorn[k][-1] = errorn[k][-1] if isnan(errorn[k][-1]) or errorn[k][-1] > 0 else 0.0
-                    errorp[k].append(new_distsk[k][-1] + 2 * np_std(part))
-                    errorp[k][-1] = errorp[k][-1] if isnan(errorp[k][-1]) or errorp[k][-1] > 0 else 0.0
-                except TypeError:
-                    errorn[k].append(None)
-                    errorp[k].append(None)
-        distsk = new_distsk
+        models = self._select_models(models, cluster)
+        coords = self._coordinates(models)
+        zeros  = np.array(self._zeros[:self.nloci], dtype=bool)
+        parts  = np.arange(self.nloci - interval)
+        if mass_center:
+            # centers of mass of the groups of interval particles starting at
+            # each particle
+            centers = np.zeros(coords.shape)
+            sizes   = np.zeros(self.nloci)
+            for j in xrange(interval):
+                centers[:, :self.nloci - j] += np.where(
+                    zeros[None, j:, None], coords[:, j:], 0.)
+                sizes[:self.nloci - j] += zeros[j:]
+            coords = centers / np.maximum(sizes, 1)[None, :, None]
+        # one row per particle, one column per model
+        dists = particle_distances(coords, parts, parts + interval).T.copy()
+        dists[~(zeros[parts] & zeros[parts + interval])] = np.nan
+        distsk = {}
+        errorp = {}
+        errorn = {}
+        for k in steps:
+            # mean distance of each model over k consecutive particles
+            total = np.zeros((max(0, len(parts) - k + 1), len(models)))
+            count = np.zeros(total.shape)
+            for j in xrange(k):
+                window = dists[j:j + len(total)]
+                total += np.where(np.isnan(window), 0., window)
+                count += ~np.isnan(window)
+            means = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+            part = interval * self.resolution / means
+            median = np_median(part, axis=1)
+            std = np_std(part, axis=1)
+            errn = median - 2 * std
+            errp = median + 2 * std
+            skip = [None for _ in range(k/2+interval/2)]
+            distsk[k] = skip + median.tolist()
+            errorn[k] = skip + np.where(np.isnan(errn) | (errn > 0), errn,
+                                        0.0).tolist()
+            errorp[k] = skip + np.where(np.isnan(errp) | (errp > 0), errp,
+                                        0.0).tolist()
         # write consistencies to file
         if savedata:      
             out = open(savedata, 'w')
@@ -705,29 +837,95 @@ class StructuralModels(object):
 
         :returns: matrix frequency of interaction
         """
-        if models:
-            models = [m if isinstance(m, int) else self[m]['index']
-                      if isinstance(m, str) else m['index'] for m in models]
-        elif cluster > -1:
-            models = [self[str(m)]['index'] for m in self.clusters[cluster]]
-        else:
-            models = [m for m in self.__models]
-        matrix = [[float('nan') for _ in xrange(self.nloci)]
-                  for _ in xrange(self.nloci)]
         if not cutoff:
             cutoff = int(2 * self.resolution * self._config['scale'])
-        cutoff = cutoff**2
-        for i in xrange(self.nloci):
-            if not self._zeros[i]:
-                continue
-            for j in xrange(i + 1, self.nloci):
-                if not self._zeros[i]:
-                    continue
-                val = len([k for k in self.__square_3d_dist(
-                    i + 1, j + 1, models=models)
-                           if k < cutoff])
-                matrix[i][j] = matrix[j][i] = float(val) / len(models)  # * 100
-        return matrix
+        return self.get_contact_matrices([cutoff], models=models,
+                                         cluster=cluster)[0]
+
+
+    def get_contact_matrices(self, cutoffs, models=None, cluster=None):
+        """
+        Same as :func:`StructuralModels.get_contact_matrix`, for several
+        cutoffs at once: the distances between each pair of particles are
+        computed only once, and compared to all the cutoffs.
+
+        :param cutoffs: list of distance cutoffs (nm) to define whether two
+           particles are in contact or not
+        :param None models: if None (default) the contact matrices will be
+           computed using all the models. A list of numbers corresponding to a
+           given set of models can be passed
+        :param None cluster: compute the contact matrices only for the models
+           in the cluster number 'cluster'
+
+        :returns: a list of matrices of frequency of interaction, one per
+           cutoff
+        """
+        models = self._select_models(models, cluster)
+        counts = self._contact_counts(models, cutoffs)
+        # as in previous versions, only rows of particles without data are
+        # skipped (the corresponding columns are filled by symmetry)
+        valid = np.array([bool(self._zeros[i]) for i in xrange(self.nloci)])
+        filled = np.triu(np.ones((self.nloci, self.nloci), dtype=bool), 1)
+        filled &= valid[:, None]
+        filled |= filled.T
+        matrices = []
+        for k in xrange(len(cutoffs)):
+            matrix = counts[:, :, k] / float(len(models))
+            matrix[~filled] = float('nan')
+            matrices.append(matrix.tolist())
+        return matrices
+
+
+    def _select_models(self, models=None, cluster=None):
+        """
+        :returns: the list of indexes of the models selected by number, random
+           initial number, or cluster (all the models by default)
+        """
+        if models:
+            return [m if isinstance(m, int) else self[m]['index']
+                    if isinstance(m, str) else m['index'] for m in models]
+        elif cluster > -1:
+            return [self[str(m)]['index'] for m in self.clusters[cluster]]
+        return [m for m in self.__models]
+
+
+    def _square_distances(self, models, block_size=2**22):
+        """
+        Iterates over the squared distances between all pairs of particles,
+        computed for groups of consecutive models at once.
+
+        :param models: list of indexes of models
+        :param 2**22 block_size: maximum number of distances computed at once
+           (the memory used is about three times 8 bytes per distance)
+
+        :yields: for each group of models, an array of shape (number of models
+           in the group, number of particles, number of particles)
+        """
+        step = max(1, block_size / self.nloci**2)
+        for beg in xrange(0, len(models), step):
+            coords = self._coordinates(models[beg:beg + step])
+            sqdist = np.zeros((len(coords), self.nloci, self.nloci))
+            for k in xrange(3):
+                sqdist += (coords[:, :, None, k] - coords[:, None, :, k])**2
+            yield sqdist
+
+
+    def _contact_counts(self, models, cutoffs):
+        """
+        Counts, for each pair of particles, the number of models in which the
+        particles are closer than each cutoff.
+
+        :param models: list of indexes of models
+        :param cutoffs: list of distance cutoffs (nm)
+
+        :returns: an array of shape (number of particles, number of particles,
+           number of cutoffs)
+        """
+        counts = np.zeros((self.nloci, self.nloci, len(cutoffs)), dtype=int)
+        for sqdist in self._square_distances(models):
+            for k, cutoff in enumerate(cutoffs):
+                counts[:, :, k] += (sqdist < cutoff**2).sum(axis=0)
+        return counts
 
 
     def define_best_models(self, nbest):
@@ -771,18 +969,23 @@ class StructuralModels(object):
         :param None dcutoff: distance threshold (nm) to determine if two
            particles are in contact, default is 1.5 times resolution times scale
         :param 'mcl' method: clustering method to use, which can be either
-           'mcl' or 'ward'. MCL method is recommended. WARD method uses a scipy
-           implementation of this hierarchical clustering, and selects the best
-           number of clusters using the
+           'mcl', 'mcl-native' or 'ward'. MCL method is recommended, with
+           'mcl' the external mcl program is used, with 'mcl-native' the
+           clustering is done in TADbit (see
+           :func:`pytadbit.utils.tadmaths.markov_clustering`). WARD method
+           uses a scipy implementation of this hierarchical clustering, and
+           selects the best number of clusters using the
            :func:`pytadbit.utils.tadmaths.calinski_harabasz` function.
         :param 'mcl' mcl_bin: path to the mcl executable file, in case of the
            'mcl is not in the PATH' warning message
         :param None tmp_file: path to a temporary file created during
            the clustering computation. Default will be created in /tmp/ folder
         :param True verbose: same as print StructuralModels.clusters
-        :param 1 n_cpus: number of cpus to use in MCL clustering
+        :param 1 n_cpus: number of cpus to use in the comparison of models,
+           and in MCL clustering
         :param mclargs: list with any other command line argument to be passed
-           to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0'])
+           to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0']). With
+           'mcl-native', only the inflation (-I) is used
         :param 10 n_best_clusters: number of clusters to represent
         :param None clusters: provide clusters as a dictionary with keys=cluster
            number, or name, and values list of model numbers.
@@ -1023,7 +1226,7 @@ class StructuralModels(object):
 
     def accessibility(self, radius, models=None, cluster=None, nump=100,
                       superradius=200, savefig=None, savedata=None, axe=None,
-                      plot=True, error=True):
+                      plot=True, error=True, n_cpus=1, verbose=False):
         """
         Calculates a mesh surface around the model (distance equal to input
         **radius**) and checks if each point of this mesh could be replaced by
@@ -1047,6 +1250,9 @@ class StructuralModels(object):
         :param None savefig: path where to save chimera image
         :param 200 superradius: radius of an object used to exclude outer
            surface of the model. Superradius must be higher than radius.
+        :param 1 n_cpus: number of CPUs to use, models are distributed among
+           them
+        :param False verbose: print the number of models processed
 
         This function will first define a mesh around the chromatin,
         representing all possible position of the center of the object we want
@@ -1113,14 +1319,31 @@ class StructuralModels(object):
         else:
             models = [m for m in self.__models]
         acc = [[] for _ in xrange(self.nloci)]
-        for model in models:
-            acc_vs_inacc = self[model].accessible_surface(
-                radius, nump=nump, superradius=superradius, include_edges=False)[-1]
+        if n_cpus > 1:
+            pool = mu.Pool(n_cpus)
+            jobs = [pool.apply_async(_accessible_parts,
+                                     args=(self[model], radius, nump,
+                                           superradius))
+                    for model in models]
+            pool.close()
+            results = (job.get() for job in jobs)
+        else:
+            results = (_accessible_parts(self[model], radius, nump, superradius)
+                       for model in models)
+        for done, acc_vs_inacc in enumerate(results, 1):
             for i, j, k in acc_vs_inacc:
                 try:
                     acc[i-1].append(float(j) / (j + k))
                 except ZeroDivisionError:
                     acc[i-1].append(0.0)
+            if verbose:
+                stdout.write('\r  accessibility of %d/%d models' % (
+                    done, len(models)))
+                stdout.flush()
+        if verbose:
+            stdout.write('\n')
+        if n_cpus > 1:
+            pool.join()
         errorp = []
         errorn = []
         accper = []
@@ -1221,29 +1444,16 @@ class StructuralModels(object):
             raise Exception('Sorry not enough colors to do this.\n')
         colors = ['grey', 'darkgreen', 'darkblue', 'purple', 'darkorange',
                   'darkred'][-len(steps):]
-        if models:
-            models = [m if isinstance(m, int) else self[m]['index']
-                      if isinstance(m, str) else m['index'] for m in models]
-        elif cluster > -1:
-            models = [self[str(m)]['index'] for m in self.clusters[cluster]]
-        else:
-            models = [m for m in self.__models]
-        interactions = [[] for _ in xrange(self.nloci)]
+        models = self._select_models(models, cluster)
         if not cutoff:
             cutoff = int(2 * self.resolution * self._config['scale'])
         cutoff2 = cutoff**2
-        for i in xrange(self.nloci):
-            if not self._zeros[i]:
-                interactions[i].extend([float('nan')] * len(models))
-                continue
-            for m in models:
-                val = 0
-                for j in xrange(self.nloci):
-                    if i == j:
-                        continue
-                    val += self.__square_3d_dist(i + 1, j + 1,
-                                                 models=[m])[0] < cutoff2
-                interactions[i].append(val)
+        # number of particles (other than itself) close to each particle
+        counts = np.concatenate([(sqdist < cutoff2).sum(axis=2)
+                                 for sqdist in self._square_distances(models)])
+        counts -= 0 < cutoff2
+        interactions = [[float('nan')] * len(models) if not self._zeros[i]
+                        else counts[:, i].tolist() for i in xrange(self.nloci)]
         distsk = {1: interactions}
         for k in (steps[1:] if steps[0]==1 else steps):
             distsk[k] = [None for _ in range(k/2)]
@@ -1527,27 +1737,7 @@ class StructuralModels(object):
             cutoff = int(2 * self.resolution * self._config['scale'])
         model_matrix = self.get_contact_matrix(models=models, cluster=cluster,
                                                cutoff=cutoff)
-        oridata = []
-        moddata = []
-        for i in xrange(len(self._original_data)):
-            for j in xrange(i + off_diag, len(self._original_data)):
-                if not self._original_data[i][j] > 0:
-                    continue
-                oridata.append(self._original_data[i][j])
-                moddata.append(model_matrix[i][j])
-        # corr = spearmanr(model_matrix, self._original_data, axis=None)
-        if corr == 'spearman':
-            corr = spearmanr(moddata, oridata)
-        elif corr == 'pearson':
-            corr = pearsonr(moddata, oridata)
-        elif corr == 'logpearson':
-            corr = pearsonr(nozero_log_list(moddata), nozero_log_list(oridata))
-        elif corr == 'chi2':
-            corr = chisquare(array(moddata), array(oridata))
-            corr = 1. / corr[0], corr[1]
-        else:
-            raise NotImplementedError('ERROR: %s not implemented, must be one ' +
-                                      'of spearman, pearson or frobenius\n')
+        corr, moddata, oridata = self._correlate(model_matrix, off_diag, corr)
         if not plot and not savefig:
             return corr
         if not axe:
@@ -1642,6 +1832,63 @@ class StructuralModels(object):
         return corr
 
 
+    def correlate_with_real_data_by_cutoff(self, cutoffs, models=None,
+                                           cluster=None, off_diag=1,
+                                           corr='spearman'):
+        """
+        Same as :func:`StructuralModels.correlate_with_real_data` (without
+        plot), for several cutoffs at once (the distances between particles
+        are computed only once, see
+        :func:`StructuralModels.get_contact_matrices`).
+
+        :param cutoffs: list of distance cutoffs (nm) to define whether two
+           particles are in contact or not
+        :param None models: if None (default) the correlation will be computed
+           using all the models. A list of numbers corresponding to a given set
+           of models can be passed
+        :param None cluster: compute the correlation only for the models in the
+           cluster number 'cluster'
+        :param 1 off_diag:
+        :param spearman corr: correlation coefficient to use
+
+        :returns: a list with, for each cutoff, the correlation coefficient
+           and its p-value
+        """
+        return [self._correlate(matrix, off_diag, corr)[0]
+                for matrix in self.get_contact_matrices(
+                    cutoffs, models=models, cluster=cluster)]
+
+
+    def _correlate(self, model_matrix, off_diag, corr):
+        """
+        Correlation between a contact matrix and the original Hi-C data.
+
+        :returns: the correlation, and the lists of values compared
+        """
+        oridata = []
+        moddata = []
+        for i in xrange(len(self._original_data)):
+            for j in xrange(i + off_diag, len(self._original_data)):
+                if not self._original_data[i][j] > 0:
+                    continue
+                oridata.append(self._original_data[i][j])
+                moddata.append(model_matrix[i][j])
+        # corr = spearmanr(model_matrix, self._original_data, axis=None)
+        if corr == 'spearman':
+            corr = spearmanr(moddata, oridata)
+        elif corr == 'pearson':
+            corr = pearsonr(moddata, oridata)
+        elif corr == 'logpearson':
+            corr = pearsonr(nozero_log_list(moddata), nozero_log_list(oridata))
+        elif corr == 'chi2':
+            corr = chisquare(array(moddata), array(oridata))
+            corr = 1. / corr[0], corr[1]
+        else:
+            raise NotImplementedError('ERROR: %s not implemented, must be one ' +
+                                      'of spearman, pearson or frobenius\n')
+        return corr, moddata, oridata
+
+
     def model_consistency(self, cutoffs=None, models=None,
                           cluster=None, axe=None, savefig=None, savedata=None,
                           plot=True):
@@ -1674,22 +1921,15 @@ class StructuralModels(object):
         :param True plot: e.g. only saves data. No plotting done
 
         """
-        if models:
-            models = dict([(i, self[m]) for i, m in enumerate(models)])
-        elif cluster > -1:
-            models = dict([(i, self[str(m)]) for i, m in
-                           enumerate(self.clusters[cluster])])
-        else:
-            models = self.__models  # Here it's different
-        consistencies = {}
+        models = self._select_models(models, cluster)
         if not cutoffs:
             cutoffs = (int(0.5 * self.resolution * self._config['scale']),
                        int(1.0 * self.resolution * self._config['scale']),
                        int(1.5 * self.resolution * self._config['scale']),
                        int(2.0 * self.resolution * self._config['scale']))
-        for cut in cutoffs:
-            consistencies[cut] = calc_consistency(models, self.nloci,
-                                                  self._zeros, cut)
+        # all cutoffs at once, superimposing each pair of models only once
+        consistencies = dict(zip(cutoffs, calc_consistencies(
+            self._coordinates(models), cutoffs, self._zeros).tolist()))
         # write consistencies to file
         if savedata:
             out = open(savedata, 'w')
@@ -1995,27 +2235,17 @@ class StructuralModels(object):
            returns a list of the angle g, h, i (see picture above)
 
         """
-        # WARNING: here particle numbers are +1, they will be reduced
-        # inside median_3d_dist
-        a = self.median_3d_dist(partb, partc, models=models,
-                                cluster=cluster, plot=False)
-        c = self.median_3d_dist(parta, partb, models=models,
-                                cluster=cluster, plot=False)
-        b = self.median_3d_dist(parta, partc, models=models,
-                                cluster=cluster, plot=False)
+        models = self._select_models(models, cluster)
+        coords = self._coordinates(models, [parta - 1, partb - 1, partc - 1])
+        a, c, b = np_median(particle_distances(coords, [1, 0, 0], [2, 1, 2]),
+                            axis=0)
 
-        try:
-            g = acos((a**2 - b**2 + c**2) / (2 * a * c))
-        except ValueError:
-            g = 0.
+        g = float(angles_from_distances(a, b, c))
 
         if not all_angles:
             return g if radian else degrees(g)
 
-        try:
-            h = acos((a**2 + b**2 - c**2) / (2 * a * b))
-        except ValueError:
-            h = 0.
+        h = float(angles_from_distances(a, c, b))
 
         i = pi - g - h
 
@@ -2033,27 +2263,9 @@ class StructuralModels(object):
         :param None cluster: compute the angle only for the models in the
            cluster number 'cluster'
         """
-        if models:
-            models = [m if isinstance(m, int) else self[m]['index']
-                      if isinstance(m, str) else m['index'] for m in models]
-        elif cluster > -1:
-            models = [self[str(m)]['index'] for m in self.clusters[cluster]]
-        else:
-            models = [m for m in self.__models]
-
-        part -= 1
-        xis = 0.
-        yis = 0.
-        zis = 0.
-        for mod in models:
-            xis += self[mod]['x'][part]
-            yis += self[mod]['y'][part]
-            zis += self[mod]['z'][part]
-        xis /= len(models)
-        yis /= len(models)
-        zis /= len(models)
-
-        return [xis, yis, zis]
+        models = self._select_models(models, cluster)
+        coords = self._coordinates(models, [part - 1])
+        return (coords[:, 0].sum(axis=0) / len(models)).tolist()
 
 
     def dihedral_angle(self, parta, partb, partc, partd, models=None,
@@ -2067,11 +2279,11 @@ class StructuralModels(object):
         :param None cluster: compute the angle only for the models in the
            cluster number 'cluster'
         """
-        parta = array(self.particle_coordinates(parta, models, cluster))
-        partb = array(self.particle_coordinates(partb, models, cluster))
-        partc = array(self.particle_coordinates(partc, models, cluster))
-        partd = array(self.particle_coordinates(partd, models, cluster))
-        return dihedral(parta, partb, partc, partd)
+        models = self._select_models(models, cluster)
+        coords = self._coordinates(models, [parta - 1, partb - 1, partc - 1,
+                                            partd - 1])
+        parts = coords.sum(axis=0)[:, None] / len(models)
+        return float(dihedrals(*parts)[0])
 
 
     def walking_dihedral(self, models=None, cluster=None, steps=(1,3),
@@ -2135,11 +2347,11 @@ class StructuralModels(object):
                   'darkred'][-len(steps):]
         #
         rads = {}
-        rads[1] = []
-        for res in xrange(self.nloci - 6):
-            rads[1].append(self.dihedral_angle(res + 1, res + 4,
-                                               res + 5, res + 7,
-                                               models=models, cluster=cluster))
+        models = self._select_models(models, cluster)
+        coords = self._coordinates(models).sum(axis=0) / len(models)
+        res = np.arange(self.nloci - 6)
+        rads[1] = dihedrals(coords[res], coords[res + 3], coords[res + 4],
+                            coords[res + 6]).tolist()
         lmodels = len(rads[1])
         for k in (steps[1:] if steps[0]==1 else steps):
             rads[k] = [None for _ in range(k/2)]
@@ -2225,22 +2437,21 @@ class StructuralModels(object):
         if not isinstance(steps, tuple):
             steps = (steps,)
         rads = {}
-        rads[1] = []
-        sign = 1
-        for res in xrange(self.nloci - 6):
-            rads[1].append(self.angle_between_3_particles(res + 1, res + 4,
-                                                          res + 7,
-                                                          models=models,
-                                                          cluster=cluster))
-            if signed:
-                res1 = self.particle_coordinates(res+1)
-                res2 = self.particle_coordinates(res+4)
-                res3 = self.particle_coordinates(res+7)
-                vec1 = array(res1) - array(res2) / norm(array(res1) - array(res2))
-                vec2 = array(res1) - array(res3) / norm(array(res1) - array(res3))
-                sign = dot(array([1.,1.,1.]), cross(vec1, vec2))
-                sign = -1 if sign < 0 else 1
-            rads[1][-1] *= sign
+        models = self._select_models(models, cluster)
+        res = np.arange(self.nloci - 6)
+        dists = particle_distances(self._coordinates(models),
+                                   np.concatenate((res + 3, res, res)),
+                                   np.concatenate((res + 6, res + 3, res + 6)))
+        a, c, b = np_median(dists, axis=0).reshape(3, -1)
+        rads[1] = np.degrees(angles_from_distances(a, b, c))
+        if signed:
+            coords = self._coordinates(self._select_models())
+            coords = coords.sum(axis=0) / len(coords)
+            res1, res2, res3 = coords[res], coords[res + 3], coords[res + 6]
+            vec1 = res1 - res2 / norm(res1 - res2, axis=1)[:, None]
+            vec2 = res1 - res3 / norm(res1 - res3, axis=1)[:, None]
+            rads[1] *= np.where(cross(vec1, vec2).sum(axis=1) < 0, -1, 1)
+        rads[1] = rads[1].tolist()
         for k in (steps[1:] if steps[0]==1 else steps):
             rads[k] = [None for _ in range(k/2)]
             for i in range(1, self.nloci - k - 5):
@@ -2315,15 +2526,8 @@ class StructuralModels(object):
            calculated distances or their median value distances, either the
            list of distances.
         """
-        if models:
-            models = [m if isinstance(m, int) else self[m]['index']
-                      if isinstance(m, str) else m['index'] for m in models]
-        elif cluster > -1:
-            models = [self[str(m)]['index'] for m in self.clusters[cluster]]
-        else:
-            models = self.__models
-        models = [self[mdl] for mdl in models]
-        dists = [mdl.distance(part1, part2) for mdl in models]
+        dists = np.sqrt(self.__square_3d_dist(part1, part2, models=models,
+                                              cluster=cluster)).tolist()
         if not plot:
             if median:
                 return np_median(dists)
@@ -2336,20 +2540,10 @@ class StructuralModels(object):
         """
         same as median_3d_dist, but return the square of the distance instead
         """
-        part1 -= 1
-        part2 -= 1
-        if models:
-            models = [m if isinstance(m, int) else self[m]['index']
-                      if isinstance(m, str) else m['index'] for m in models]
-        elif cluster > -1:
-            models = [self[str(m)]['index'] for m in self.clusters[cluster]]
-        else:
-            models = [m for m in self.__models]
-        models = [self[mdl] for mdl in models]
-        return [(mdl['x'][part1] - mdl['x'][part2])**2 +
-                (mdl['y'][part1] - mdl['y'][part2])**2 +
-                (mdl['z'][part1] - mdl['z'][part2])**2
-                for mdl in models]
+        models = self._select_models(models, cluster)
+        coords = self._coordinates(models, [part1 - 1, part2 - 1])
+        diff = coords[:, 0] - coords[:, 1]
+        return (diff[:, 0]**2 + diff[:, 1]**2 + diff[:, 2]**2).tolist()
 
 
     def objective_function_model(self, model, log=False, smooth=True, axe=None,
@@ -2598,13 +2792,20 @@ class StructuralModels(object):
             return path_f
 
 
-    def save_models(self, outfile):
+    def save_models(self, outfile, binary=False, compress=True):
         """
         Saves all the models in pickle format (python object written to disk).
 
         :param path_f: path where to save the pickle file
-        """
-
+        :param False binary: save the models in the binary ensemble format
+           instead (see :mod:`pytadbit.imp.ensemble_file`), with coordinates
+           stored as float32 and that can be loaded without reading them
+        :param True compress: in the binary format, compress the sections
+           other than coordinates and objective function values
+        """
+        if binary:
+            write_ensemble(outfile, self._reduce_models(), compress=compress)
+            return
         out = open(outfile, 'w')
         dump(self._reduce_models(), out)
         out.close()
@@ -2641,6 +2842,15 @@ class StructuralModels(object):
         return to_save
 
 
+def _accessible_parts(model, radius, nump, superradius):
+    """
+    :returns: the number of accessible and inaccessible dots of the mesh
+       around each particle of a model
+    """
+    return model.accessible_surface(radius, nump=nump, superradius=superradius,
+                                    include_edges=False)[-1]
+
+
 class ClusterOfModels(dict):
     def __str__(self):
         out1 = '   Cluster #%s has %s models [top model: %s]\n'
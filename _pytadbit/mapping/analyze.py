@@ -10,6 +10,7 @@ from warnings                    import warn
 from collections                 import OrderedDict
 from pytadbit.parsers.hic_parser import load_hic_data_from_reads
 from pytadbit.utils.extraviews   import nicer
+from pytadbit.parsers.binary_reads import is_binary_reads, read_binary_reads
 from scipy.stats                 import norm as sc_norm, skew, kurtosis
 from scipy.stats                 import pearsonr, spearmanr, linregress
 from numpy.linalg                import eigh
@@ -312,7 +313,16 @@ def plot_distance_vs_interactions(data, min_diff=10, max_diff=1000, show=False,
     """
     resolution = resolution or 1
     dist_intr = dict([(i, 0) for i in xrange(min_diff, max_diff)])
-    if isinstance(data, str):
+    if isinstance(data, str) and is_binary_reads(data):
+        _, reads = read_binary_reads(data)
+        cis = reads['crm1'] == reads['crm2']
+        diffs = abs((reads['pos1'][cis] / resolution).astype(np.int64) -
+                    (reads['pos2'][cis] / resolution).astype(np.int64))
+        diffs = diffs[(diffs >= min_diff) & (diffs < max_diff)]
+        for diff, cnt in enumerate(np.bincount(diffs, minlength=max_diff)):
+            if diff >= min_diff:
+                dist_intr[diff] += int(cnt)
+    elif isinstance(data, str):
         fhandler = open(data)
         line = fhandler.next()
         while line.startswith('#'):
@@ -496,22 +506,12 @@ def plot_iterative_mapping(fnam1, fnam2, total_reads=None, axe=None, savefig=Non
         _ = fig.add_subplot(111)
     colors = ['olive', 'darkcyan']
     for i, fnam in enumerate([fnam1, fnam2]):
-        fhandler = open(fnam)
-        line = fhandler.next()
-        while line.startswith('#'):
-            line = fhandler.next()
-        try:
-            count_by_len[i] = {}
-            while True:
-                _, length, _, _ = line.rsplit('\t', 3)
-                try:
-                    count_by_len[i][int(length)] += 1
-                except KeyError:
-                    count_by_len[i][int(length)] = 1
-                line = fhandler.next()
-        except StopIteration:
-            pass
-        fhandler.close()
+        if is_binary_reads(fnam):
+            _, reads = read_binary_reads(fnam)
+            lengths, counts = np.unique(reads['len1'], return_counts=True)
+            count_by_len[i] = dict(zip(lengths.tolist(), counts.tolist()))
+        else:
+            count_by_len[i] = _count_by_len(fnam)
         lengths = sorted(count_by_len[i].keys())
         for k in lengths[::-1]:
             count_by_len[i][k] += sum([count_by_len[i][j]
@@ -532,6 +532,29 @@ def plot_iterative_mapping(fnam1, fnam2, total_reads=None, axe=None, savefig=Non
     return count_by_len
 
 
+def _count_by_len(fnam):
+    """
+    count reads by mapped length in a tab separated file of reads
+    """
+    count_by_len = {}
+    fhandler = open(fnam)
+    line = fhandler.next()
+    while line.startswith('#'):
+        line = fhandler.next()
+    try:
+        while True:
+            _, length, _, _ = line.rsplit('\t', 3)
+            try:
+                count_by_len[int(length)] += 1
+            except KeyError:
+                count_by_len[int(length)] = 1
+            line = fhandler.next()
+    except StopIteration:
+        pass
+    fhandler.close()
+    return count_by_len
+
+
 def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
                               axe=None, ylim=None, savefig=None):
     """
@@ -548,6 +571,48 @@ def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
     """
 
     distr = {}
+    if is_binary_reads(fnam):
+        genome_seq, reads = read_binary_reads(fnam)
+        end = 1 if first_read else 2
+        for num, crm in enumerate(genome_seq):
+            pos = reads['pos%d' % end][reads['crm%d' % end] == num]
+            if not len(pos):
+                continue
+            counts = np.bincount(pos / resolution)
+            distr[crm] = dict([(p, int(counts[p]))
+                               for p in np.nonzero(counts)[0].tolist()])
+    else:
+        genome_seq = _genomic_distribution(fnam, first_read, resolution,
+                                           distr)
+    if not axe:
+        _ = plt.figure(figsize=(15, 3 * len(distr.keys())))
+
+    max_y = max([max(distr[c].values()) for c in distr])
+    max_x = max([len(distr[c].values()) for c in distr])
+    for i, crm in enumerate(genome_seq if genome_seq else distr):
+        plt.subplot(len(distr.keys()), 1, i + 1)
+        plt.plot(range(max(distr[crm])),
+                 [distr[crm].get(j, 0) for j in xrange(max(distr[crm]))],
+                 color='red', lw=1.5, alpha=0.7)
+        if ylim:
+            plt.vlines(genome_seq[crm] / resolution, ylim[0], ylim[1])
+        else:
+            plt.vlines(genome_seq[crm] / resolution, 0, max_y)
+        plt.xlim((0, max_x))
+        plt.ylim(ylim or (0, max_y))
+        plt.title(crm)
+
+    if savefig:
+        tadbit_savefig(savefig)
+    elif not axe:
+        plt.show()
+
+
+def _genomic_distribution(fnam, first_read, resolution, distr):
+    """
+    count reads by genomic bin in a tab separated file of reads, fills the
+    distr dictionary and returns the chromosome lengths found in the header
+    """
     idx1, idx2 = (1, 3) if first_read else (7, 9)
     genome_seq = OrderedDict()
     fhandler = open(fnam)
@@ -572,28 +637,7 @@ def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
     except StopIteration:
         pass
     fhandler.close()
-    if not axe:
-        _ = plt.figure(figsize=(15, 3 * len(distr.keys())))
-
-    max_y = max([max(distr[c].values()) for c in distr])
-    max_x = max([len(distr[c].values()) for c in distr])
-    for i, crm in enumerate(genome_seq if genome_seq else distr):
-        plt.subplot(len(distr.keys()), 1, i + 1)
-        plt.plot(range(max(distr[crm])),
-                 [distr[crm].get(j, 0) for j in xrange(max(distr[crm]))],
-                 color='red', lw=1.5, alpha=0.7)
-        if ylim:
-            plt.vlines(genome_seq[crm] / resolution, ylim[0], ylim[1])
-        else:
-            plt.vlines(genome_seq[crm] / resolution, 0, max_y)
-        plt.xlim((0, max_x))
-        plt.ylim(ylim or (0, max_y))
-        plt.title(crm)
-
-    if savefig:
-        tadbit_savefig(savefig)
-    elif not axe:
-        plt.show()
+    return genome_seq
 
 
 def correlate_matrices(hic_data1, hic_data2, max_dist=10,
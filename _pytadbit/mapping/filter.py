@@ -4,6 +4,11 @@
 
 """
 from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from pytadbit.mapping.restriction_enzymes import _re_fragment_keys
+from pytadbit.parsers.binary_reads        import is_binary_reads
+from pytadbit.parsers.binary_reads        import read_binary_reads
+from pytadbit.parsers.binary_reads        import write_binary_reads
+import numpy as np
 
 
 def apply_filter(fnam, outfile, masked, filters=None):
@@ -22,6 +27,12 @@ def apply_filter(fnam, outfile, masked, filters=None):
     filters = filters or masked.keys()
     for filt in filters:
         masked_reads.update(masked[filt]['reads'])
+    if is_binary_reads(fnam):
+        chromosomes, reads = read_binary_reads(fnam)
+        keep = ~np.in1d(reads['name'], np.array(list(masked_reads),
+                                                dtype=reads.dtype['name']))
+        write_binary_reads(outfile, chromosomes, reads[keep])
+        return
     out = open(outfile, 'w')
     for line in open(fnam):
         read = line.split('\t', 1)[0]
@@ -57,8 +68,9 @@ def filter_reads(fnam, max_molecule_length=500,
        9- duplicated         : the combination of the start positions of the
           reads is repeated -> PCR artifact (only keep one copy)
     
-    :param fnam: path to file containing the pair of reads in tsv format, file
-       generated by :func:`pytadbit.mapping.mapper.get_intersection`
+    :param fnam: path to file containing the pair of reads in tsv (or binary)
+       format, file generated by
+       :func:`pytadbit.mapping.mapper.get_intersection`
     :param 500 max_molecule_length: facing reads that are within
        max_molecule_length, will be classified as 'extra dangling-ends'
     :param 0.005 over_represented:
@@ -78,6 +90,15 @@ def filter_reads(fnam, max_molecule_length=500,
               7: {'name': 'too large'         , 'reads': set()},
               8: {'name': 'over-represented'  , 'reads': set()},
               9: {'name': 'duplicated'        , 'reads': set()}}
+    if is_binary_reads(fnam):
+        _filter_binary_reads(fnam, masked, max_molecule_length,
+                             over_represented, max_frag_size, min_frag_size,
+                             re_proximity)
+        if verbose:
+            for k in xrange(1, len(masked) + 1):
+                print '%d- %-25s : %d' %(k, masked[k]['name'],
+                                         len(masked[k]['reads']))
+        return masked
     uniq_check = set()
     # uniq_check = {}
     frag_count = count_re_fragments(fnam)
@@ -156,3 +177,60 @@ def filter_reads(fnam, max_molecule_length=500,
         for k in xrange(1, len(masked) + 1):
             print '%d- %-25s : %d' %(k, masked[k]['name'], len(masked[k]['reads']))
     return masked
+
+
+def _filter_binary_reads(fnam, masked, max_molecule_length, over_represented,
+                         max_frag_size, min_frag_size, re_proximity):
+    """
+    Same filters as :func:`filter_reads`, applied to all reads at once on the
+    columns of a binary file of reads. Fills the sets of read IDs of the
+    masked dictionary.
+    """
+    _, reads = read_binary_reads(fnam)
+    cr1, cr2 = reads['crm1'], reads['crm2']
+    ps1, ps2 = reads['pos1'].astype(np.int64), reads['pos2'].astype(np.int64)
+    sd1, sd2 = reads['sd1'].astype(np.int64), reads['sd2'].astype(np.int64)
+    rs1, rs2 = reads['rs1'].astype(np.int64), reads['rs2'].astype(np.int64)
+    re1, re2 = reads['re1'].astype(np.int64), reads['re2'].astype(np.int64)
+    masks = {}
+    same_frag = (cr1 == cr2) & (re1 == re2)
+    circle = (ps2 > ps1) == sd2
+    masks[1] = same_frag & (sd1 != sd2) & circle
+    masks[2] = same_frag & (sd1 != sd2) & ~circle
+    masks[3] = same_frag & (sd1 == sd2)
+    masks[4] = ((cr1 == cr2) & ~same_frag &
+                (abs(ps1 - ps2) < max_molecule_length) &
+                (sd2 != sd1) & (ps2 > ps1) & (ps1 != sd2))
+    left = ~(same_frag | masks[4])
+    masks[5] = left & ((abs(re1 - ps1) < re_proximity) |
+                       (abs(rs1 - ps1) < re_proximity) |
+                       (abs(re2 - ps2) < re_proximity) |
+                       (abs(rs2 - ps2) < re_proximity))
+    left &= ~masks[5]
+    masks[6] = left & (((re1 - rs1) < min_frag_size) |
+                       ((re2 - rs2) < min_frag_size))
+    left &= ~masks[6]
+    masks[7] = left & (((re1 - rs1) > max_frag_size) |
+                       ((re2 - rs2) > max_frag_size))
+    left &= ~masks[7]
+    # over-represented fragments, counted over all reads
+    _, frag_idx, counts = np.unique(_re_fragment_keys(reads),
+                                    return_inverse=True, return_counts=True)
+    cut = int((1 - over_represented) * len(counts) + 0.5)
+    cut = np.sort(counts)[cut]
+    over = counts[frag_idx] > cut
+    masks[8] = left & (over[:len(reads)] | over[len(reads):])
+    left &= ~masks[8]
+    # duplicates: keep only the first occurrence of each pair of positions
+    end1 = (cr1.astype(np.uint64) << np.uint64(32)) | reads['pos1']
+    end2 = (cr2.astype(np.uint64) << np.uint64(32)) | reads['pos2']
+    pairs = np.empty(len(reads), dtype=[('a', np.uint64), ('b', np.uint64)])
+    pairs['a'] = np.minimum(end1, end2)
+    pairs['b'] = np.maximum(end1, end2)
+    left_idx = np.where(left)[0]
+    _, first = np.unique(pairs[left_idx], return_index=True)
+    masks[9] = left.copy()
+    masks[9][left_idx[first]] = False
+    names = reads['name']
+    for k in masks:
+        masked[k]['reads'] = set(names[masks[k]].tolist())
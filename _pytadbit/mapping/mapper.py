@@ -7,10 +7,15 @@ iterative mapping copied from hiclib
 
 import os
 import tempfile
-import gzip
 import pysam
 import gem
+import numpy as np
 from warnings import warn
+from threading import Thread
+from Queue import Queue
+from pytadbit.parsers.gzopen       import gzip_reader
+from pytadbit.parsers.binary_reads import is_binary_reads, read_binary_reads
+from pytadbit.parsers.binary_reads import write_binary_reads, reads_dtype
 
 def get_intersection(fname1, fname2, out_path, verbose=False):
     """
@@ -22,8 +27,12 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
     :param fname2: path to a tab separated file generated by the function
        :func:`pytadbit.parsers.sam_parser.parse_sam`
     :param out_path: path to an outfile. It will written in a similar format as
-       the inputs
+       the inputs (binary inputs, as generated by
+       :func:`pytadbit.parsers.sam_parser.parse_sam` with binary=True, give a
+       binary output)
     """
+    if is_binary_reads(fname1):
+        return _get_binary_intersection(fname1, fname2, out_path, verbose)
     reads_fh = open(out_path, 'w')
     reads1 = open(fname1)
     line1 = reads1.next()
@@ -69,6 +78,39 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
         print 'Found %d pair of reads mapping uniquely' % count
 
 
+def _get_binary_intersection(fname1, fname2, out_path, verbose=False):
+    """
+    Same as :func:`get_intersection` for inputs in binary format. Both files
+       are sorted by read ID, reads found in both are searched by bisection
+       over the memory-mapped IDs.
+    """
+    chromosomes1, reads1 = read_binary_reads(fname1)
+    chromosomes2, reads2 = read_binary_reads(fname2)
+    if chromosomes1 != chromosomes2:
+        raise Exception('seems to be mapped onover different chromosomes\n')
+    names1 = reads1['name']
+    names2 = reads2['name']
+    idx = np.searchsorted(names2, names1)
+    common = idx < len(names2)
+    common[common] = names2[idx[common]] == names1[common]
+    idx = idx[common]
+    flags = 'flags' in reads1.dtype.names or 'flags' in reads2.dtype.names
+    width = max(reads1.dtype['name'].itemsize, reads2.dtype['name'].itemsize)
+    pairs = np.zeros(len(idx), dtype=reads_dtype(2, width, flags))
+    pairs['name'] = names1[common]
+    for fld in reads1.dtype.names:
+        if fld in ('name', 'flags'):
+            continue
+        pairs[fld] = reads1[fld][common]
+        pairs[fld[:-1] + '2'] = reads2[fld][idx]
+    for reads, sel in ((reads1, common), (reads2, idx)):
+        if 'flags' in reads.dtype.names:
+            pairs['flags'] |= reads['flags'][sel]
+    write_binary_reads(out_path, chromosomes1, pairs)
+    if verbose:
+        print 'Found %d pair of reads mapping uniquely' % len(pairs)
+
+
 def trimming(raw_seq_len, seq_start, min_seq_len):
     return seq_start, raw_seq_len - seq_start - min_seq_len
 
@@ -139,10 +181,7 @@ def iterative_mapping(gem_index_path, fastq_path, out_sam_path,
                 raise error
 
     #get the length of a read
-    if fastq_path.endswith('.gz'):
-        fastqh = gzip.open(fastq_path)
-    else:
-        fastqh = open(fastq_path)
+    fastqh = _gzopen(fastq_path)
     # get the length from the length of the second line, which is the sequence
     # can not use the "length" keyword, as it is not always present
     try:
@@ -157,22 +196,19 @@ def iterative_mapping(gem_index_path, fastq_path, out_sam_path,
     if max_reads_per_chunk > 0:
         kwargs['max_reads_per_chunk'] = -1
         print 'Split input file %s into chunks' % fastq_path
-        chunked_files = _chunk_file(
+        # chunks are mapped as soon as they are written
+        for i, fastq_chunk_path in enumerate(_chunk_file(
             fastq_path,
             os.path.join(temp_dir, os.path.split(fastq_path)[1]),
-            max_reads_per_chunk * 4)
-        print '%d chunks obtained' % len(chunked_files)
-        for i, fastq_chunk_path in enumerate(chunked_files):
+            max_reads_per_chunk * 4)):
             print 'Run iterative_mapping recursively on %s' % fastq_chunk_path
             out_files.extend(iterative_mapping(
                 gem_index_path, fastq_chunk_path,
                 out_sam_path + '.%d' % (i + 1), range_start[:], range_stop[:],
                 **kwargs))
-
-        for i, fastq_chunk_path in enumerate(chunked_files):
             # Delete chunks only if the file was really chunked.
-            if len(chunked_files) > 1:
-                print 'Remove the chunks: %s' % ' '.join(chunked_files)
+            if fastq_chunk_path != fastq_path:
+                print 'Remove the chunk: %s' % fastq_chunk_path
                 os.remove(fastq_chunk_path)
         return out_files
 
@@ -229,41 +265,133 @@ def iterative_mapping(gem_index_path, fastq_path, out_sam_path,
     os.remove(unmapped_fastq_path)
     return out_files
 
-def _line_count(path):
-    '''Count the number of lines in a file. The function was posted by
-    Mikola Kharechko on Stackoverflow.
-    '''
+def _chunk_file(in_path, out_basename, max_num_lines, skip=()):
+    '''Slice a FASTQ file in chunks of max_num_lines lines.
 
-    f = _gzopen(path)
-    lines = 0
-    buf_size = 1024 * 1024
-    read_f = f.read  # loop optimization
+    Chunks are written by a producer thread, one chunk ahead of the consumer,
+    and their paths are yielded as soon as they are complete. If the file
+    does not need to be sliced, its own path is yielded. Chunks whose number
+    (starting at 1) is in skip are not written, and None is yielded instead
+    of their path.
 
-    buf = read_f(buf_size)
-    while buf:
-        lines += buf.count('\n')
-        buf = read_f(buf_size)
+    Uncompressed files are sliced at byte offsets found by counting lines by
+    blocks, and each chunk is copied by blocks. Compressed files are read
+    line by line, in one pass.
+    '''
+    queue = Queue(1)
+    writer = Thread(target=_write_chunks,
+                    args=(in_path, out_basename, max_num_lines, queue, skip))
+    writer.daemon = True
+    writer.start()
+    while True:
+        out_path = queue.get()
+        if out_path is None:
+            break
+        if isinstance(out_path, Exception):
+            raise out_path
+        yield out_path or None
+    writer.join()
 
-    return lines
 
-def _chunk_file(in_path, out_basename, max_num_lines):
-    '''Slice lines from a large file.
-    The line numbering is as in Python slicing notation.
+def _write_chunks(in_path, out_basename, max_num_lines, queue, skip=()):
+    '''Producer of _chunk_file, puts the path of each chunk in the queue
+    (False for skipped chunks), and None at the end.
     '''
-    num_lines = _line_count(in_path)
-    if num_lines <= max_num_lines:
-        return [in_path, ]
-
+    try:
+        if in_path.endswith('.gz'):
+            _write_gz_chunks(in_path, out_basename, max_num_lines, queue,
+                             skip)
+        else:
+            offsets = _chunk_offsets(in_path, max_num_lines)
+            if len(offsets) == 1:
+                queue.put(in_path)
+            for i, (beg, end) in enumerate(offsets if len(offsets) > 1
+                                           else []):
+                if i + 1 in skip:
+                    queue.put(False)
+                    continue
+                out_path = out_basename + '.%d' % (i + 1)
+                _copy_range(in_path, out_path, beg, end)
+                queue.put(out_path)
+    except Exception, e:
+        queue.put(e)
+    queue.put(None)
+
+
+def _write_gz_chunks(in_path, out_basename, max_num_lines, queue, skip=()):
     out_paths = []
-
+    out_file = None
     for i, line in enumerate(_gzopen(in_path)):
         if i % max_num_lines == 0:
-            out_path = out_basename + '.%d' % (i // max_num_lines + 1)
-            out_paths.append(out_path)
-            out_file = file(out_path, 'w')
-        out_file.write(line)
+            if out_file:
+                out_file.close()
+            if out_paths:
+                # previous chunk is complete, and the file is really chunked
+                queue.put(out_paths[-1])
+            num = i // max_num_lines + 1
+            if num in skip:
+                # lines still have to be read to find the next chunks
+                out_paths.append(False)
+                out_file = None
+            else:
+                out_paths.append(out_basename + '.%d' % num)
+                out_file = open(out_paths[-1], 'w')
+        if out_file:
+            out_file.write(line)
+    if out_file:
+        out_file.close()
+    if len(out_paths) == 1:
+        if out_paths[0]:
+            os.remove(out_paths[0])
+        out_paths[0] = in_path
+    if out_paths:
+        queue.put(out_paths[-1])
+
+
+def _chunk_offsets(in_path, max_num_lines, buf_size=1024 * 1024):
+    '''Byte offsets of the chunks of max_num_lines lines of an uncompressed
+    file, found by counting the lines of large blocks.
+    '''
+    fhandler = open(in_path, 'rb')
+    offsets = [0]
+    pos = 0     # offset of the current block in the file
+    start = 0   # beginning of the lines not counted yet in the block
+    left = max_num_lines
+    buf = fhandler.read(buf_size)
+    while buf:
+        nlines = buf.count('\n', start)
+        if nlines < left:
+            left -= nlines
+            pos += len(buf)
+            buf = fhandler.read(buf_size)
+            start = 0
+            continue
+        end = start - 1
+        for _ in xrange(left):
+            end = buf.index('\n', end + 1)
+        start = end + 1
+        offsets.append(pos + start)
+        left = max_num_lines
+    fhandler.close()
+    if pos > offsets[-1]:
+        offsets.append(pos)
+    return zip(offsets[:-1], offsets[1:])
+
+
+def _copy_range(in_path, out_path, beg, end, buf_size=1024 * 1024):
+    '''Copy a range of bytes from a file to another'''
+    in_file = open(in_path, 'rb')
+    in_file.seek(beg)
+    out_file = open(out_path, 'wb')
+    while beg < end:
+        buf = in_file.read(min(buf_size, end - beg))
+        if not buf:
+            break
+        out_file.write(buf)
+        beg += len(buf)
+    out_file.close()
+    in_file.close()
 
-    return out_paths
 
 def _filter_fastq(ids, in_fastq, out_fastq):
     '''Filter FASTQ sequences by their IDs.
@@ -318,6 +446,6 @@ def _filter_unmapped_fastq(in_fastq, in_sam, nonunique_fastq):
 
 def _gzopen(path):
     if path.endswith('.gz'):
-        return gzip.open(path)
+        return gzip_reader(path)
     else:
         return open(path)
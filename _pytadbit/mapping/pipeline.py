@@ -0,0 +1,175 @@
+"""
+09 Feb 2015
+
+Resumable pipeline from FASTQ to Hi-C matrix.
+
+Each stage (mapping of each chunk of reads, parsing of SAM files,
+intersection, filtering and binning) is run through
+:class:`pytadbit.utils.checkpoints.Checkpoints`, that keys its outputs by
+the checksums of its inputs and by its parameters. When the pipeline is run
+again (e.g. after the job was killed), stages with valid outputs are
+skipped.
+"""
+
+import os
+
+from pytadbit.utils.checkpoints  import Checkpoints, genome_checksum
+from pytadbit.mapping.mapper     import iterative_mapping, get_intersection
+from pytadbit.mapping.mapper     import _chunk_file
+from pytadbit.mapping.filter     import filter_reads, apply_filter
+from pytadbit.parsers.sam_parser import parse_sam
+from pytadbit.parsers.hic_parser import load_hic_data_from_reads
+
+
+def checkpointed_mapping(checkpoints, name, gem_index_path, fastq_path,
+                         out_sam_path, range_start, range_stop, **kwargs):
+    """
+    Same as :func:`pytadbit.mapping.mapper.iterative_mapping`, but each
+    chunk of reads (see max_reads_per_chunk) is recorded as a separate stage,
+    so that an interrupted mapping resumes from the first chunk not
+    completed (chunks already mapped are not written again). The whole
+    mapping is also recorded as a stage (its usage of resources includes the
+    one of its chunks), so that the FASTQ file is not read at all once all
+    its chunks are mapped.
+
+    :param checkpoints: a :class:`pytadbit.utils.checkpoints.Checkpoints`
+       object
+    :param name: name of the stage (the number of the chunk is appended)
+
+    :returns: a list of paths to generated SAM/BAM files
+    """
+    max_reads_per_chunk = kwargs.pop('max_reads_per_chunk', -1)
+    params = dict(kwargs, gem_index_path=gem_index_path,
+                  range_start=range_start, range_stop=range_stop,
+                  max_reads_per_chunk=max_reads_per_chunk)
+    return checkpoints.run(name, _map_chunks,
+                           args=(checkpoints, name, gem_index_path,
+                                 fastq_path, out_sam_path, range_start,
+                                 range_stop, max_reads_per_chunk, params,
+                                 kwargs),
+                           inputs=[fastq_path], params=params)
+
+
+def _map_chunks(checkpoints, name, gem_index_path, fastq_path, out_sam_path,
+                range_start, range_stop, max_reads_per_chunk, params, kwargs):
+    """
+    Maps the chunks of a FASTQ file, each one as a stage of checkpoints.
+    """
+    stage = lambda num: ('%s.chunk%d' % (name, num),
+                         checkpoints.stage_key(name + '.chunk%d' % num,
+                                               [fastq_path],
+                                               dict(params, chunk=num)))
+    # chunks already mapped
+    done = set()
+    num = 1
+    while '%s.chunk%d' % (name, num) in checkpoints.journal:
+        if checkpoints.is_done(*stage(num)):
+            done.add(num)
+        num += 1
+    if max_reads_per_chunk > 0:
+        temp_dir = kwargs.get('temp_dir', checkpoints.workdir)
+        chunks = _chunk_file(fastq_path,
+                             os.path.join(temp_dir,
+                                          os.path.split(fastq_path)[1]),
+                             max_reads_per_chunk * 4, skip=done)
+    else:
+        chunks = [fastq_path]
+    out_files = []
+    for i, chunk_path in enumerate(chunks):
+        out_files.extend(checkpoints.run(
+            stage(i + 1)[0], iterative_mapping,
+            args=(gem_index_path, chunk_path, out_sam_path + '.%d' % (i + 1),
+                  range_start[:], range_stop[:]),
+            kwargs=dict(kwargs, out_files=[]),
+            inputs=[fastq_path], params=dict(params, chunk=i + 1)))
+        if chunk_path and chunk_path != fastq_path:
+            os.remove(chunk_path)
+    return out_files
+
+
+def mapping_pipeline(workdir, gem_index_path, fastq_path, genome_seq, re_name,
+                     range_start1, range_stop1, range_start2, range_stop2,
+                     resolution, fastq_path2=None, binary=True, filters=None,
+                     filter_kwargs=None, full_checksum=False, verbose=True,
+                     **kwargs):
+    """
+    Runs the whole pipeline from FASTQ to Hi-C matrix, skipping stages already
+    completed in the working directory:
+       * :func:`pytadbit.mapping.mapper.iterative_mapping` of read1 and read2
+         (chunk by chunk)
+       * :func:`pytadbit.parsers.sam_parser.parse_sam`
+       * :func:`pytadbit.mapping.mapper.get_intersection`
+       * :func:`pytadbit.mapping.filter.filter_reads` and
+         :func:`pytadbit.mapping.filter.apply_filter`
+       * :func:`pytadbit.parsers.hic_parser.load_hic_data_from_reads`
+
+    :param workdir: directory where all intermediate files are stored
+    :param gem_index_path: path to index file created from a reference genome
+       using gem-index tool
+    :param fastq_path: path to the FASTQ file (containing both ends, unless
+       fastq_path2 is given)
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param re_name: name of the restriction enzyme used
+    :param range_start1: list of start positions of the read1 windows
+    :param range_stop1: list of end positions of the read1 windows
+    :param range_start2: list of start positions of the read2 windows
+    :param range_stop2: list of end positions of the read2 windows
+    :param resolution: resolution of the Hi-C matrix
+    :param None fastq_path2: path to the FASTQ file of the read2
+    :param True binary: use binary files for intermediate reads
+    :param None filters: list of filters to apply (see
+       :func:`pytadbit.mapping.filter.apply_filter`)
+    :param None filter_kwargs: parameters to pass to
+       :func:`pytadbit.mapping.filter.filter_reads`
+    :param False full_checksum: use md5 of whole files to identify inputs
+    :param kwargs: parameters to pass to
+       :func:`pytadbit.mapping.mapper.iterative_mapping`
+
+    :returns: a :class:`pytadbit.parsers.hic_parser.HiC_data` object, and the
+       :class:`pytadbit.utils.checkpoints.Checkpoints` object (see
+       :func:`pytadbit.utils.checkpoints.Checkpoints.stats`)
+    """
+    checkpoints = Checkpoints(workdir, full_checksum=full_checksum)
+    path = lambda fnam: os.path.join(checkpoints.workdir, fnam)
+    ext = 'bin' if binary else 'tsv'
+    sams = []
+    for num, (fastq, start, stop) in enumerate(
+        ((fastq_path, range_start1, range_stop1),
+         (fastq_path2 or fastq_path, range_start2, range_stop2))):
+        sams.append(checkpointed_mapping(
+            checkpoints, 'map_read%d' % (num + 1), gem_index_path, fastq,
+            path('read%d.sam' % (num + 1)), start, stop, **kwargs))
+    reads1, reads2 = path('reads1.' + ext), path('reads2.' + ext)
+    genome = {'genome': genome_checksum(genome_seq), 're_name': re_name,
+              'binary': binary}
+    checkpoints.run('parse_sam', parse_sam,
+                    args=(sams[0], sams[1], reads1, reads2, genome_seq,
+                          re_name),
+                    kwargs={'verbose': verbose, 'binary': binary},
+                    inputs=sams[0] + sams[1], outputs=(reads1, reads2),
+                    params=genome)
+    reads = path('reads12.' + ext)
+    checkpoints.run('get_intersection', get_intersection,
+                    args=(reads1, reads2, reads),
+                    kwargs={'verbose': verbose},
+                    inputs=(reads1, reads2), outputs=(reads,), params={})
+    filter_kwargs = filter_kwargs or {}
+    masked = checkpoints.run('filter_reads', filter_reads, args=(reads, ),
+                             kwargs=dict(filter_kwargs, verbose=verbose),
+                             inputs=(reads, ), outputs=(),
+                             params=filter_kwargs, store_result=True)
+    filtered = path('reads12_filtered.' + ext)
+    checkpoints.run('apply_filter', apply_filter,
+                    args=(reads, filtered, masked),
+                    kwargs={'filters': filters},
+                    inputs=(reads, path('filter_reads.pickle')),
+                    outputs=(filtered, ))
+    hic_data = checkpoints.run('load_hic_data', load_hic_data_from_reads,
+                               args=(filtered, resolution),
+                               inputs=(filtered, ), outputs=(),
+                               params={'resolution': resolution},
+                               store_result=True)
+    if verbose:
+        print checkpoints.stats()
+    return hic_data, checkpoints
@@ -5,9 +5,25 @@ Definition and mapping of restriction enymes
 """
 
 from re import compile
+from pytadbit.parsers.binary_reads import is_binary_reads, read_binary_reads
+import numpy as np
 
 
 def count_re_fragments(fnam):
+    """
+    Counts the number of read-ends falling in each RE fragment.
+
+    :param fnam: path to a file of pairs of reads (tab separated or binary)
+
+    :returns: a dictionary with (chromosome, position of the upstream RE
+       site) as keys, and the number of read-ends as values
+    """
+    if is_binary_reads(fnam):
+        chromosomes, reads = read_binary_reads(fnam)
+        crm_names = chromosomes.keys()
+        frags, counts = np.unique(_re_fragment_keys(reads), return_counts=True)
+        return dict([((crm_names[frag >> 32], int(frag & 0xffffffff)), cnt)
+                     for frag, cnt in zip(frags.tolist(), counts.tolist())])
     frag_count = {}
     fhandler = open(fnam)
     line = fhandler.next()
@@ -30,6 +46,19 @@ def count_re_fragments(fnam):
     return frag_count
 
 
+def _re_fragment_keys(reads):
+    """
+    :param reads: numpy array of pairs of reads in binary format
+
+    :returns: an array of RE fragment identifiers (chromosome index in the
+       higher 32 bits, upstream RE site in the lower) of the first read-ends,
+       followed by the ones of the second read-ends
+    """
+    return np.concatenate([
+        (reads['crm%d' % end].astype(np.uint64) << np.uint64(32)) |
+        reads['rs%d' % end].astype(np.uint64) for end in (1, 2)])
+
+
 def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
     """
     map all restriction enzyme (RE) sites of a given enzyme in a genome.
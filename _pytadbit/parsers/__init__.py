@@ -5,6 +5,7 @@
 """
 
 import bz2, gzip, zipfile, tarfile
+from pytadbit.parsers.gzopen import gzip_reader
 
 def magic_open(filename, verbose=False):
     """
@@ -48,6 +49,9 @@ def magic_open(filename, verbose=False):
     if start_of_file.startswith('\x1f\x8b\x08'):
         if verbose:
             print 'gz'
+        if inputpath:
+            fhandler.close()
+            return gzip_reader(filename)
         return gzip.GzipFile(fileobj=fhandler)
     if verbose:
         print 'text'
@@ -0,0 +1,205 @@
+"""
+02 Feb 2015
+
+Fixed-width binary format for the intermediate files of mapped reads, written
+by :func:`pytadbit.parsers.sam_parser.parse_sam` and
+:func:`pytadbit.mapping.mapper.get_intersection`.
+
+The file starts with a magic string, followed by the length of a text header
+(little-endian unsigned 32 bits integer) and by the header itself. The header
+contains the number of read-ends stored per record, the width of the read ID
+field, whether a flag field is present and the chromosome dictionary (in the
+same '# CRM name\\tlength' form used in the tab-separated files). Records
+start at the first 8 bytes aligned offset after the header, and can be
+memory-mapped directly with numpy.
+
+Each record contains the read ID and, for each read-end, the index of the
+chromosome in the header dictionary, the position, the strand, the mapped
+length, and the positions of the closest upstream and downstream RE sites.
+"""
+
+from collections import OrderedDict
+from struct      import pack, unpack
+import numpy as np
+
+MAGIC = '\x93TADREAD'
+
+END_FIELDS = (('crm', '<u2'), ('pos', '<u4'), ('sd', 'u1'),
+              ('len', '<u2'), ('rs', '<u4'), ('re', '<u4'))
+
+
+def reads_dtype(ends, name_width, flags=False):
+    """
+    Builds the numpy dtype of a record of the binary format of reads.
+
+    :param ends: number of read-ends per record (1 for the output of
+       :func:`pytadbit.parsers.sam_parser.parse_sam`, 2 for the output of
+       :func:`pytadbit.mapping.mapper.get_intersection`)
+    :param name_width: number of characters reserved for the read ID
+    :param False flags: add a 16 bits integer field named 'flags'
+
+    :returns: a numpy dtype. Fields of each read-end are suffixed with the
+       number of the end (e.g.: 'crm1', 'pos1', 'sd1', 'len1', 'rs1', 're1')
+    """
+    fields = [('name', 'S%d' % max(1, name_width))]
+    for end in xrange(1, ends + 1):
+        fields.extend([(fld + str(end), typ) for fld, typ in END_FIELDS])
+    if flags:
+        fields.append(('flags', '<u2'))
+    return np.dtype(fields)
+
+
+def is_binary_reads(fnam):
+    """
+    :param fnam: path to a file of reads
+
+    :returns: True if the file is in the binary format of reads
+    """
+    fhandler = open(fnam, 'rb')
+    magic = fhandler.read(len(MAGIC))
+    fhandler.close()
+    return magic == MAGIC
+
+
+def _read_header(fnam):
+    fhandler = open(fnam, 'rb')
+    if fhandler.read(len(MAGIC)) != MAGIC:
+        raise IOError('ERROR: %s is not a binary file of reads\n' % fnam)
+    hlen = unpack('<I', fhandler.read(4))[0]
+    header = fhandler.read(hlen)
+    fhandler.close()
+    ends = name_width = flags = None
+    chromosomes = OrderedDict()
+    for line in header.split('\n'):
+        if line.startswith('# CRM '):
+            crm, clen = line[6:].split('\t')
+            chromosomes[crm] = int(clen)
+        elif line.startswith('ends\t'):
+            ends = int(line.split('\t')[1])
+        elif line.startswith('name\t'):
+            name_width = int(line.split('\t')[1])
+        elif line.startswith('flags\t'):
+            flags = line.split('\t')[1] == '1'
+    offset = len(MAGIC) + 4 + hlen
+    offset += -offset % 8
+    return chromosomes, reads_dtype(ends, name_width, flags), offset
+
+
+def read_binary_reads(fnam, mode='r'):
+    """
+    Loads a binary file of reads.
+
+    :param fnam: path to a binary file of reads
+    :param 'r' mode: mode of the numpy memory-map ('r' for read only, 'c' for
+       copy-on-write)
+
+    :returns: a dictionary of chromosome lengths (in the order of the genome)
+       and a numpy structured array (memory-mapped) with one record per read
+    """
+    chromosomes, dtype, offset = _read_header(fnam)
+    fhandler = open(fnam, 'rb')
+    fhandler.seek(0, 2)
+    nrec = (fhandler.tell() - offset) / dtype.itemsize
+    fhandler.close()
+    if not nrec:
+        return chromosomes, np.zeros(0, dtype=dtype)
+    return chromosomes, np.memmap(fnam, dtype=dtype, mode=mode,
+                                  offset=offset, shape=(nrec,))
+
+
+def write_binary_reads(fnam, chromosomes, reads):
+    """
+    Writes reads in the binary format.
+
+    :param fnam: path to the output file
+    :param chromosomes: a dictionary of chromosome lengths, or a dictionary
+       containing the genomic sequence by chromosome (order matters, it gives
+       the index stored in the 'crm' fields)
+    :param reads: numpy structured array, with a dtype generated by
+       :func:`reads_dtype`
+    """
+    names = reads.dtype.names
+    ends = len([n for n in names if n.startswith('crm')])
+    header = 'ends\t%d\nname\t%d\nflags\t%d\n' % (
+        ends, reads.dtype['name'].itemsize, int('flags' in names))
+    header += '## Chromosome lengths (order matters):\n'
+    for crm in chromosomes:
+        clen = chromosomes[crm]
+        header += '# CRM %s\t%d\n' % (crm, len(clen) if isinstance(
+            clen, basestring) else clen)
+    offset = len(MAGIC) + 4 + len(header)
+    out = open(fnam, 'wb')
+    out.write(MAGIC)
+    out.write(pack('<I', len(header)))
+    out.write(header)
+    out.write('\0' * (-offset % 8))
+    out.write(np.ascontiguousarray(reads).tostring())
+    out.close()
+
+
+def chromosome_index(chromosomes):
+    """
+    :param chromosomes: a dictionary of chromosome lengths (order matters)
+
+    :returns: a dictionary with chromosome names as keys, and their index in
+       the binary records as values
+    """
+    return dict([(crm, i) for i, crm in enumerate(chromosomes)])
+
+
+def tsv_to_binary_reads(fnam, outfile, flags=False):
+    """
+    Converts a tab-separated file of reads (generated by
+    :func:`pytadbit.parsers.sam_parser.parse_sam` or
+    :func:`pytadbit.mapping.mapper.get_intersection`) to the binary format.
+
+    :param fnam: path to the tab-separated file of reads
+    :param outfile: path to the binary output file
+    :param False flags: add a field of flags to each record
+    """
+    chromosomes = OrderedDict()
+    reads = []
+    for line in open(fnam):
+        if line.startswith('#'):
+            if line.startswith('# CRM '):
+                crm, clen = line[6:].split()
+                chromosomes[crm] = int(clen)
+            continue
+        reads.append(line.rstrip('\n').split('\t'))
+    crm_idx = chromosome_index(chromosomes)
+    ends = (len(reads[0]) - 1) / 6 if reads else 1
+    width = max([len(r[0]) for r in reads] or [1])
+    records = np.zeros(len(reads), dtype=reads_dtype(ends, width, flags))
+    records['name'] = [r[0] for r in reads]
+    for end in xrange(ends):
+        beg = 1 + end * 6
+        records['crm%d' % (end + 1)] = [crm_idx[r[beg]] for r in reads]
+        for i, (fld, _) in enumerate(END_FIELDS[1:]):
+            records['%s%d' % (fld, end + 1)] = [int(r[beg + 1 + i])
+                                                for r in reads]
+    write_binary_reads(outfile, chromosomes, records)
+
+
+def binary_to_tsv_reads(fnam, outfile):
+    """
+    Converts a binary file of reads to the tab-separated format.
+
+    :param fnam: path to the binary file of reads
+    :param outfile: path to the tab-separated output file
+    """
+    chromosomes, reads = read_binary_reads(fnam)
+    crm_names = chromosomes.keys()
+    ends = len([n for n in reads.dtype.names if n.startswith('crm')])
+    out = open(outfile, 'w')
+    out.write('## Chromosome lengths (order matters):\n')
+    for crm in chromosomes:
+        out.write('# CRM %s\t%d\n' % (crm, chromosomes[crm]))
+    for read in reads:
+        line = read['name']
+        for end in xrange(1, ends + 1):
+            line += '\t%s\t%d\t%d\t%d\t%d\t%d' % (
+                crm_names[read['crm%d' % end]], read['pos%d' % end],
+                read['sd%d' % end], read['len%d' % end],
+                read['rs%d' % end], read['re%d' % end])
+        out.write(line + '\n')
+    out.close()
@@ -1,6 +1,12 @@
 # -*- coding:utf-8 -*-
 
 import gzip
+import zlib
+from struct          import unpack
+from multiprocessing import Process, Queue, current_process, cpu_count
+from multiprocessing.pool import ThreadPool
+
+BLOCK_SIZE = 4 * 1024 * 1024
 
 class gzopen(object):
    def __init__(self, fname):
@@ -8,7 +14,8 @@ class gzopen(object):
       magic_number = f.read(2)
       f.seek(0)
       if magic_number == '\x1f\x8b':
-         self.f = gzip.GzipFile(fileobj=f)
+         f.close()
+         self.f = gzip_reader(fname)
       else:
          self.f = f
    def __exit__(self, type, value, traceback):
@@ -24,3 +31,213 @@ class gzopen(object):
       return getattr(self.f, name)
    def __iter__(self):
       return iter(self.f)
+
+
+def gzip_reader(fname, nthreads=None):
+   """
+   Opens a gzipped file, decompressing ahead in a helper process when
+   possible (processes started by multiprocessing pools are not allowed to
+   have children, in this case a regular gzip.GzipFile is returned).
+
+   :param fname: path to a gzipped file
+   :param None nthreads: number of threads used to decompress BGZF blocks
+
+   :returns: an object to be iterated (line by line) or read
+   """
+   if current_process().daemon:
+      return gzip.GzipFile(fname)
+   return ReadAheadGzipFile(fname, nthreads=nthreads)
+
+
+def is_bgzf(fname):
+   """
+   :param fname: path to a file
+
+   :returns: True if the file is compressed in BGZF (blocked GNU Zip Format,
+      as generated by bgzip), made of independent gzip blocks
+   """
+   fhandler = open(fname, 'rb')
+   head = fhandler.read(12)
+   if len(head) < 12 or not head.startswith('\x1f\x8b\x08\x04'):
+      fhandler.close()
+      return False
+   extra = fhandler.read(unpack('<H', head[10:12])[0])
+   fhandler.close()
+   return _bgzf_block_size(extra) is not None
+
+
+def _bgzf_block_size(extra):
+   """
+   Search for the BC subfield of the gzip extra field, containing the total
+   size of the block minus one.
+   """
+   pos = 0
+   while pos + 4 <= len(extra):
+      slen = unpack('<H', extra[pos + 2:pos + 4])[0]
+      if extra[pos:pos + 2] == 'BC' and slen == 2:
+         return unpack('<H', extra[pos + 4:pos + 6])[0]
+      pos += 4 + slen
+   return None
+
+
+def _bgzf_blocks(fhandler):
+   """
+   Iterates over the raw (compressed) blocks of a BGZF file.
+   """
+   while True:
+      head = fhandler.read(12)
+      if len(head) < 12:
+         break
+      xlen = unpack('<H', head[10:12])[0]
+      extra = fhandler.read(xlen)
+      bsize = _bgzf_block_size(extra)
+      if bsize is None:
+         raise IOError('ERROR: not a BGZF block\n')
+      yield head + extra + fhandler.read(bsize - xlen - 11)
+
+
+def _inflate_bgzf_block(block):
+   """
+   Decompresses one BGZF block (zlib releases the GIL while inflating, so
+   blocks can be decompressed in parallel by threads).
+   """
+   xlen = unpack('<H', block[10:12])[0]
+   data = zlib.decompress(block[12 + xlen:-8], -zlib.MAX_WBITS)
+   if zlib.crc32(data) & 0xffffffff != unpack('<I', block[-8:-4])[0]:
+      raise IOError('ERROR: CRC check failed in BGZF block\n')
+   return data
+
+
+def _decompress_ahead(fname, queue, block_size, nthreads):
+   """
+   Helper process: decompresses a gzipped file into blocks of about
+   block_size bytes, and puts them into a bounded queue (None marks the end
+   of the file).
+   """
+   try:
+      fhandler = open(fname, 'rb')
+      chunk = []
+      size = 0
+      if nthreads > 1 and is_bgzf(fname):
+         pool = ThreadPool(nthreads)
+         inflated = pool.imap(_inflate_bgzf_block, _bgzf_blocks(fhandler),
+                              chunksize=16)
+      else:
+         inflated = _inflate_gzip_members(fhandler, block_size)
+      for data in inflated:
+         chunk.append(data)
+         size += len(data)
+         if size >= block_size:
+            queue.put(''.join(chunk))
+            chunk = []
+            size = 0
+      if chunk:
+         queue.put(''.join(chunk))
+      fhandler.close()
+      queue.put(None)
+   except Exception, e:
+      queue.put(IOError('ERROR: decompressing %s: %s\n' % (fname, e)))
+
+
+def _inflate_gzip_members(fhandler, block_size):
+   """
+   Iterates over the decompressed data of a gzipped file, that may contain
+   several concatenated gzip members.
+   """
+   dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+   while True:
+      raw = fhandler.read(block_size)
+      if not raw:
+         break
+      while raw:
+         yield dobj.decompress(raw)
+         raw = dobj.unused_data
+         if raw:
+            dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+   yield dobj.flush()
+
+
+class ReadAheadGzipFile(object):
+   """
+   Read-only gzipped file, decompressed by a helper process ahead of the
+   consumer, into a bounded buffer of large blocks. BGZF files are
+   decompressed block by block in parallel.
+
+   Can be iterated line by line, or read with read and readline, as a
+   gzip.GzipFile.
+
+   :param fname: path to a gzipped file
+   :param 4Mb block_size: size of the blocks of decompressed data
+   :param 4 max_blocks: maximum number of blocks decompressed ahead
+   :param None nthreads: number of threads used to decompress BGZF blocks
+      (by default, the number of CPUs, with a maximum of 4)
+   """
+   def __init__(self, fname, block_size=BLOCK_SIZE, max_blocks=4,
+                nthreads=None):
+      self.name = fname
+      nthreads = nthreads or min(4, cpu_count())
+      self._queue = Queue(max_blocks)
+      self._proc = Process(target=_decompress_ahead,
+                           args=(fname, self._queue, block_size, nthreads))
+      self._proc.daemon = True
+      self._proc.start()
+      self._buf = ''
+      self._pos = 0
+      self._done = False
+
+   def _fill(self):
+      block = self._queue.get()
+      if block is None:
+         self._done = True
+         self._proc.join()
+         return
+      if isinstance(block, Exception):
+         self._done = True
+         raise block
+      self._buf = self._buf[self._pos:] + block
+      self._pos = 0
+
+   def read(self, size=-1):
+      while not self._done and (size < 0 or
+                                len(self._buf) - self._pos < size):
+         self._fill()
+      if size < 0:
+         size = len(self._buf) - self._pos
+      data = self._buf[self._pos:self._pos + size]
+      self._pos += len(data)
+      return data
+
+   def readline(self):
+      end = self._buf.find('\n', self._pos)
+      while end < 0 and not self._done:
+         # only the new data has to be searched (nothing new at the end)
+         tail = len(self._buf) - self._pos
+         self._fill()
+         end = self._buf.find('\n', self._pos + tail)
+      end = len(self._buf) if end < 0 else end + 1
+      line = self._buf[self._pos:end]
+      self._pos = end
+      return line
+
+   def __iter__(self):
+      return self
+
+   def next(self):
+      line = self.readline()
+      if not line:
+         raise StopIteration
+      return line
+
+   def close(self):
+      if self._proc.is_alive():
+         self._proc.terminate()
+      self._proc.join()
+      self._done = True
+      self._buf = ''
+      self._pos = 0
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, type, value, traceback):
+      self.close()
@@ -9,6 +9,8 @@ from pytadbit.parsers.gzopen import gzopen
 from pytadbit.utils.hic_filtering   import filter_by_mean
 from collections import OrderedDict
 from pytadbit.utils.normalize_hic  import iterative
+from pytadbit.parsers.binary_reads import is_binary_reads, read_binary_reads
+import numpy as np
 
 HIC_DATA = True
 
@@ -212,7 +214,7 @@ def read_matrix(things, parser=None, hic=True, **kwargs):
 
 def load_hic_data_from_reads(fnam, resolution, **kwargs):
     """
-    :param fnam: tsv file with reads1 and reads2
+    :param fnam: tsv (or binary) file with reads1 and reads2
     :param resolution: the resolution of the experiment (size of a bin in
        bases)
     :param genome_seq: a dictionary containing the genomic sequence by
@@ -220,6 +222,8 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
     :param False get_sections: for very very high resolution, when the column
        index does not fit in memory
     """
+    if is_binary_reads(fnam):
+        return _load_hic_data_from_binary_reads(fnam, resolution, **kwargs)
     sections = []
     genome_seq = OrderedDict()
     fhandler = open(fnam)
@@ -256,6 +260,40 @@ def load_hic_data_from_reads(fnam, resolution, **kwargs):
     return imx
 
 
+def _load_hic_data_from_binary_reads(fnam, resolution, **kwargs):
+    """
+    Same as :func:`load_hic_data_from_reads` for binary files of reads. Bins
+    are computed for all reads at once, and interactions counted with numpy.
+    """
+    chromosomes, reads = read_binary_reads(fnam)
+    genome_seq = OrderedDict()
+    size = 0
+    for crm in chromosomes:
+        genome_seq[crm] = chromosomes[crm] / resolution + 1
+        size += genome_seq[crm]
+    dict_sec = {}
+    if kwargs.get('get_sections', False):
+        sections = [(crm, i) for crm in genome_seq
+                    for i in xrange(genome_seq[crm])]
+        dict_sec = dict([(j, i) for i, j in enumerate(sections)])
+    imx = HiC_data((), size, genome_seq, dict_sec)
+    bins = []
+    for end in (1, 2):
+        pos = (reads['pos%d' % end] / resolution).astype(np.int64)
+        if dict_sec:
+            # section index, if position falls inside the chromosome
+            lens = np.array(genome_seq.values())
+            crm = reads['crm%d' % end]
+            offs = np.concatenate(([0], np.cumsum(lens)[:-1]))
+            pos = np.where(pos < lens[crm], pos + offs[crm], pos)
+        bins.append(pos)
+    cells, counts = np.unique(np.concatenate((bins[0] * size + bins[1],
+                                              bins[1] * size + bins[0])),
+                              return_counts=True)
+    imx.update(zip(cells.tolist(), counts.tolist()))
+    return imx
+
+
 class HiC_data(dict):
     """
     This may also hold the print/write-to-file matrix functions
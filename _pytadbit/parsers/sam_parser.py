@@ -6,11 +6,15 @@
 from bisect import bisect_left as bisect
 from pysam import Samfile
 from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.parsers.binary_reads        import reads_dtype
+from pytadbit.parsers.binary_reads        import write_binary_reads
+from pytadbit.parsers.binary_reads        import chromosome_index
 from warnings import warn
+import numpy as np
 
 def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, mapper=None,
-              **kwargs):
+              binary=False, **kwargs):
     """
     Parse sam/bam file using pysam tools.
 
@@ -32,6 +36,8 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param re_name: name of the restriction enzyme used
     :param None mapper: software used to map (supported are GEM and BOWTIE2).
        Guessed from file by default.
+    :param False binary: write outfiles in the fixed-width binary format of
+       :mod:`pytadbit.parsers.binary_reads` instead of tab separated text
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -60,6 +66,7 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
     else:
         fnames = (f_names1,)
         outfiles = (out_file1, )
+    crm_idx = chromosome_index(genome_seq)
 
     for read in range(len(fnames)):
         if verbose:
@@ -125,8 +132,18 @@ def parse_sam(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 prev_re    = frag_piece[idx - 1]
                 name       = r.qname
 
+                if binary:
+                    reads.append((name, crm_idx[crm], pos, positive, len_seq,
+                                  prev_re, next_re))
+                    continue
                 reads.append('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
                     name, crm, pos, positive, len_seq, prev_re, next_re))
+        if binary:
+            width = max([len(r[0]) for r in reads] or [1])
+            reads = np.array(reads, dtype=reads_dtype(1, width))
+            reads.sort(order='name', kind='mergesort')
+            write_binary_reads(outfiles[read], genome_seq, reads)
+            continue
         reads_fh = open(outfiles[read], 'w')
         ## write file header
         # chromosome sizes (in order)
@@ -0,0 +1,194 @@
+"""
+09 Feb 2015
+
+Checkpoints of a resumable pipeline (see
+:func:`pytadbit.mapping.pipeline.mapping_pipeline`): stages are keyed by the
+checksums of their inputs and by their parameters, and skipped when run again
+with valid outputs.
+"""
+
+import os
+from cPickle  import load, dump
+from hashlib  import md5
+from time     import time
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+
+
+def file_checksum(fnam, full=False, buf_size=1024 * 1024):
+    """
+    :param fnam: path to a file
+    :param False full: compute the md5 of the whole file. By default only the
+       size of the file, and its first and last megabytes are used
+
+    :returns: an hexadecimal md5 digest
+    """
+    size = os.path.getsize(fnam)
+    check = md5(str(size))
+    fhandler = open(fnam, 'rb')
+    if full:
+        buf = fhandler.read(buf_size)
+        while buf:
+            check.update(buf)
+            buf = fhandler.read(buf_size)
+    else:
+        check.update(fhandler.read(buf_size))
+        fhandler.seek(max(0, size - buf_size))
+        check.update(fhandler.read(buf_size))
+    fhandler.close()
+    return check.hexdigest()
+
+
+def genome_checksum(genome_seq):
+    """
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+
+    :returns: an hexadecimal md5 digest of chromosome names and lengths
+    """
+    return md5(''.join(['%s\t%d\n' % (crm, len(genome_seq[crm]))
+                        for crm in genome_seq])).hexdigest()
+
+
+class Checkpoints(object):
+    """
+    Keeps track of the stages already completed in a working directory.
+
+    The journal (file 'checkpoints.pickle' in the working directory) stores,
+    for each stage, a key computed from its parameters and from the checksums
+    of its inputs, the checksums of its outputs and its usage of resources:
+    wall time and CPU time (including children processes, like the mapper).
+    The peak resident memory of the process and of its children (in kb) is
+    also recorded at the end of each stage. It is the peak since the
+    process started, not the memory used by the stage itself: a stage using
+    less memory than the previous ones repeats their peak.
+
+    :param workdir: path to the working directory
+    :param False full_checksum: use md5 of whole files, instead of their size
+       first and last megabytes
+    """
+    def __init__(self, workdir, full_checksum=False):
+        self.workdir = os.path.abspath(os.path.expanduser(workdir))
+        if not os.path.exists(self.workdir):
+            os.makedirs(self.workdir)
+        self.full_checksum = full_checksum
+        self._checksums = {}
+        self.journal_path = os.path.join(self.workdir, 'checkpoints.pickle')
+        try:
+            self.journal = load(open(self.journal_path))
+        except IOError:
+            self.journal = {}
+
+    def _save(self):
+        tmp_path = self.journal_path + '.tmp'
+        out = open(tmp_path, 'w')
+        dump(self.journal, out)
+        out.close()
+        os.rename(tmp_path, self.journal_path)
+
+    def _checksum(self, fnam):
+        stat = os.stat(fnam)
+        ident = (os.path.abspath(fnam), stat.st_size, stat.st_mtime)
+        if not ident in self._checksums:
+            self._checksums[ident] = file_checksum(fnam,
+                                                   full=self.full_checksum)
+        return self._checksums[ident]
+
+    def stage_key(self, name, inputs=(), params=None):
+        """
+        :returns: the key identifying a stage run over a list of input files
+           with a given set of parameters
+        """
+        key = md5(name)
+        for fnam in inputs:
+            key.update(self._checksum(fnam))
+        key.update(repr(sorted((params or {}).items())))
+        return key.hexdigest()
+
+    def is_done(self, name, key):
+        """
+        :returns: True if the stage was completed with the same key, and if
+           all its outputs are still present and unchanged
+        """
+        entry = self.journal.get(name)
+        if not entry or entry['key'] != key:
+            return False
+        for fnam, check in entry['outputs'].iteritems():
+            if not os.path.exists(fnam) or self._checksum(fnam) != check:
+                return False
+        return True
+
+    def run(self, name, func, args=(), kwargs=None, inputs=(), outputs=None,
+            params=None, store_result=False, verbose=True):
+        """
+        Runs a stage of the pipeline, unless it was already completed.
+
+        :param name: unique name of the stage
+        :param func: function to call
+        :param () args: arguments to pass to the function
+        :param None kwargs: keyword arguments to pass to the function
+        :param () inputs: list of input files
+        :param None outputs: list of output files. If None, the function
+           should return the list of files it generated
+        :param None params: dictionary of parameters identifying the stage
+           (by default, kwargs)
+        :param False store_result: pickle the result of the function in the
+           working directory, in order to return it when the stage is skipped
+
+        :returns: the result of the function (or the stored one, if
+           store_result is True and the stage was skipped)
+        """
+        kwargs = kwargs or {}
+        key = self.stage_key(name, inputs, kwargs if params is None else params)
+        result_path = os.path.join(self.workdir, name + '.pickle')
+        if self.is_done(name, key):
+            if verbose:
+                print 'Skipping %s (already done)' % name
+            if store_result:
+                return load(open(result_path))
+            return self.journal[name].get('result')
+        if verbose:
+            print 'Running %s' % name
+        t0 = time()
+        cpu0 = _cpu_time()
+        result = func(*args, **kwargs)
+        entry = {'key'              : key,
+                 'date'             : t0,
+                 'time'             : time() - t0,
+                 'cpu'              : _cpu_time() - cpu0,
+                 'peak_rss'         : getrusage(RUSAGE_SELF).ru_maxrss,
+                 'peak_rss_children': getrusage(RUSAGE_CHILDREN).ru_maxrss}
+        if outputs is None:
+            outputs = result
+            entry['result'] = result
+        outputs = list(outputs)
+        if store_result:
+            out = open(result_path, 'w')
+            dump(result, out)
+            out.close()
+            outputs.append(result_path)
+        entry['outputs'] = dict([(fnam, self._checksum(fnam))
+                                 for fnam in outputs])
+        self.journal[name] = entry
+        self._save()
+        return result
+
+    def stats(self):
+        """
+        :returns: a string with the usage of resources of each stage (peak
+           memory of the process and of its children since the process
+           started, see :class:`Checkpoints`)
+        """
+        out = '%-30s %12s %12s %12s %12s\n' % (
+            'stage', 'wall (s)', 'cpu (s)', 'peak (kb)', 'children (kb)')
+        for name in sorted(self.journal, key=lambda x: self.journal[x]['date']):
+            entry = self.journal[name]
+            out += '%-30s %12.1f %12.1f %12d %12d\n' % (
+                name, entry['time'], entry['cpu'], entry['peak_rss'],
+                entry['peak_rss_children'])
+        return out
+
+
+def _cpu_time():
+    slf = getrusage(RUSAGE_SELF)
+    chl = getrusage(RUSAGE_CHILDREN)
+    return slf.ru_utime + slf.ru_stime + chl.ru_utime + chl.ru_stime
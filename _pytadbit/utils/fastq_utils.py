@@ -3,7 +3,11 @@
 """
 
 from warnings import warn
-from gzip import open as gopen
+from pytadbit.parsers.gzopen import gzip_reader
+from multiprocessing import Pool
+from random import Random
+from itertools import islice
+import os
 import numpy as np
 from pytadbit.utils.extraviews import tadbit_savefig
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES, religated, repaired
@@ -14,8 +18,12 @@ try:
 except ImportError:
     warn('matplotlib not found\n')
 
+NQUALS = 94 # number of PHRED scores encoded from '!' to '~'
+BATCH  = 10000
 
-def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=False):
+
+def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None,
+                 paired=False, sampling=None, stride=1, nprocs=1):
     """
     Plots the sequencing quality of a given FASTQ file. If a restrinction enzyme
     (RE) name is provided, can also represent the distribution of digested and
@@ -25,102 +33,77 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
     dangling-end site, is found at the beginning of any of the reads (divided by
     the number of reads).
 
+    Reads are processed by batches, and only per-position counts are kept in
+    memory (histogram of PHRED scores, number of "N" and of RE sites).
+
     :param fnam: path to FASTQ file
     :param None nreads: max number of reads to read, not necesary to read all
     :param None savefig: path to a file where to save the image generated;
        if None, the image will be shown using matplotlib GUI (the extension
        of the file name will determine the desired format).
     :param False paired: is input FASTQ contains both ends
+    :param None sampling: if 'reservoir', nreads are sampled uniformly over
+       the whole FASTQ file, instead of taking the first ones
+    :param 1 stride: keep one read every stride reads
+    :param 1 nprocs: number of processes used to compute statistics over the
+       FASTQ (not used when nreads is given). Uncompressed FASTQ files are
+       divided in chunks read by each process, reads of compressed files are
+       sent by batches.
     """
-    phred = dict([(c, i) for i, c in enumerate(
-        '!"#$%&\'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\]^_`abcdefghijklmnopqrstuvwxyz{|}~')])
-    quals = []
-    henes = []
-    sites = []
-    fixes = []
-    liges = []
     tkw = dict(size=4, width=1.5)
-    if fnam.endswith('.gz'):
-        fhandler = gopen(fnam)
-    else:
-        fhandler = open(fnam)
-    if not r_enz:
-        if nreads:
-            while True:
-                try:
-                    next(fhandler)
-                except EOFError:
-                    break
-                seq = next(fhandler)
-                if 'N' in seq:
-                    henes.extend([i for i, s in enumerate(seq) if s == 'N'])
-                next(fhandler)
-                line = next(fhandler)
-                quals.append([phred[i] for i in line.strip()])
-                if len(quals) > nreads:
-                    break
-        else: # do this because it's faster
-            while True:
-                try:
-                    next(fhandler)
-                except EOFError:
-                    break
-                seq = next(fhandler)
-                if 'N' in seq:
-                    henes.extend([i for i, s in enumerate(seq) if s == 'N'])
-                next(fhandler)
-                line = next(fhandler)
-                quals.append([phred[i] for i in line.strip()])
-    else:
+    if r_enz:
         r_site = RESTRICTION_ENZYMES[r_enz].replace('|', '')
         l_site = religated(r_enz)
         d_site = repaired(r_enz)
         if r_site*2 == l_site:
             # in case the religated site equals 2 restriction sites (like DnpII)
-            site = re.compile('(?<!%s)' % r_site + r_site + '(?!%s)' % r_site)
-            fixe = re.compile('(?<!%s)' % d_site + d_site + '(?!%s)' % d_site)
+            patterns = ['(?<!%s)' % r_site + r_site + '(?!%s)' % r_site,
+                        '(?<!%s)' % d_site + d_site + '(?!%s)' % d_site]
         else:
-            site = re.compile(r_site)
-            fixe = re.compile(d_site)
-        lige = re.compile(l_site)
-        if nreads:
-            while True:
-                try:
-                    next(fhandler)
-                except StopIteration:
-                    break
-                seq = next(fhandler)
-                sites.extend([m.start() for m in site.finditer(seq)])
-                fixes.extend([m.start() for m in fixe.finditer(seq)])
-                liges.extend([m.start() for m in lige.finditer(seq)])
-                if 'N' in seq:
-                    henes.extend([i for i, s in enumerate(seq) if s == 'N'])
-                next(fhandler)
-                line = next(fhandler)
-                quals.append([phred[i] for i in line.strip()])
-                if len(quals) > nreads:
-                    break
-        else: # do this because it's faster
+            patterns = [r_site, d_site]
+        patterns.append(l_site)
+    else:
+        patterns = []
+    if sampling == 'reservoir' and not nreads:
+        raise Exception('ERROR: nreads needed for reservoir sampling\n')
+    if nreads or nprocs < 2:
+        stats = _FastqStats(patterns)
+        fhandler = _fastq_open(fnam)
+        if sampling == 'reservoir':
+            stats.add_batch(*_reservoir(fhandler, nreads, stride))
+        else:
+            for seqs, quals in _fastq_batches(fhandler, nreads=nreads,
+                                              stride=stride):
+                stats.add_batch(seqs, quals)
+        fhandler.close()
+    else:
+        pool = Pool(nprocs)
+        stats = _FastqStats(patterns)
+        if fnam.endswith('.gz'):
+            # send batches by groups, to keep a bounded number in memory
+            fhandler = _fastq_open(fnam)
+            batches = _fastq_batches(fhandler, stride=stride)
             while True:
-                try:
-                    next(fhandler)
-                except StopIteration:
+                jobs = [(patterns, seqs, quals)
+                        for seqs, quals in islice(batches, nprocs * 2)]
+                if not jobs:
                     break
-                seq = next(fhandler)
-                sites.extend([m.start() for m in site.finditer(seq)])
-                fixes.extend([m.start() for m in fixe.finditer(seq)])
-                liges.extend([m.start() for m in lige.finditer(seq)])
-                if 'N' in seq:
-                    henes.extend([i for i, s in enumerate(seq) if s == 'N'])
-                next(fhandler)
-                line = next(fhandler)
-                quals.append([phred[i] for i in line.strip()])
-    fhandler.close()
-    if not nreads:
-        nreads = len(quals)
-    quals = zip(*quals)
-    meanquals = [np.mean(q) for q in quals]
-    errorquals = [np.std(q) for q in quals]
+                for other in pool.map(_batch_stats, jobs):
+                    stats.merge(other)
+            fhandler.close()
+        else:
+            for other in pool.imap(_chunk_stats, [
+                (patterns, fnam, beg, end, stride)
+                for beg, end in fastq_chunk_offsets(fnam, nprocs * 4)]):
+                stats.merge(other)
+        pool.close()
+        pool.join()
+    if not stats.nreads:
+        raise IOError('ERROR: no reads found in %s\n' % fnam)
+    nreads = stats.nreads
+    len_line = stats.len_line
+    meanquals, errorquals = stats.quality_mean_std()
+    henes = list(stats.henes[:len_line]) + [0] * (len_line - len(stats.henes))
 
     if axe:
         ax = axe
@@ -141,18 +124,18 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
                        left=False, bottom=False)
         ax.tick_params(axis='both', direction='out', top=False, right=False,
                        left=False, bottom=False, which='minor')
-    ax.errorbar(range(len(line.strip())), meanquals,
+    ax.errorbar(range(len(meanquals)), meanquals,
                 linewidth=1, elinewidth=1, color='darkblue',
                 yerr=errorquals, ecolor='orange')
 
-    ax.set_xlim((0, len(line)))
+    ax.set_xlim((0, len_line))
     ax.set_xlabel('Nucleotidic position')
     ax.set_ylabel('PHRED score')
     ax.set_title('Sequencing Quality (%d reads)' % (nreads))
     ax.yaxis.label.set_color('darkblue')
     ax.tick_params(axis='y', colors='darkblue', **tkw)
     axb = ax.twinx()
-    axb.plot([henes.count(i) for i in xrange(len(line))], linewidth=1,
+    axb.plot(henes, linewidth=1,
              color='black', linestyle='--')
     axb.yaxis.label.set_color('black')
     axb.tick_params(axis='y', colors='black', **tkw)
@@ -163,7 +146,7 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
     except ValueError:
         axb.set_yscale('linear')
     ax.set_ylim((0, ax.get_ylim()[1]))
-    ax.set_xlim((0, len(line)))
+    ax.set_xlim((0, len_line))
 
     if r_enz:
         ax.set_title('Sequencing Quality and deconvolution (%s %d reads)' % (
@@ -176,10 +159,10 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
         ax2.grid(ls='-', color='w', lw=1, alpha=0.3, which='minor')
         ax2.set_axisbelow(True)
         ax2.set_xlabel('Nucleotidic position')
-        seq_len = len(line) - max((len(r_site), len(l_site), len(d_site)))
-        sites = [sites.count(k) for k in xrange(seq_len)] # Undigested
-        liges = [liges.count(k) for k in xrange(seq_len)] # OK
-        fixes = [fixes.count(k) for k in xrange(seq_len)] # DE
+        seq_len = len_line - max((len(r_site), len(l_site), len(d_site)))
+        sites, fixes, liges = [stats.site_counts(k, seq_len)
+                               for k in xrange(3)]
+        # sites: Undigested, liges: OK, fixes: DE
         if d_site in r_site:
             pos = r_site.find(d_site)
             fixes = (fixes[:pos] +
@@ -190,12 +173,12 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
                      [fixes[k] - liges[k-pos] for k in xrange(pos, seq_len)])
         site_len = max((len(r_site), len(l_site), len(d_site)))
         if paired:
-            sites[len(line) / 2 - site_len:
-                  len(line) / 2] = [float('nan')] * site_len
-            liges[len(line) / 2 - site_len:
-                  len(line) / 2] = [float('nan')] * site_len
-            fixes[len(line) / 2 - site_len:
-                  len(line) / 2] = [float('nan')] * site_len
+            sites[len_line / 2 - site_len:
+                  len_line / 2] = [float('nan')] * site_len
+            liges[len_line / 2 - site_len:
+                  len_line / 2] = [float('nan')] * site_len
+            fixes[len_line / 2 - site_len:
+                  len_line / 2] = [float('nan')] * site_len
         ax2.plot(sites, linewidth=2, color='darkred')
         ax2.set_ylabel('Undigested RE site (%s)' % r_site)
         ax2.yaxis.label.set_color('darkred')
@@ -216,17 +199,17 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
             ax4.set_ylabel('Dangling-ends (%s)' % d_site)
         else:
             ax2.set_ylabel('RE site & Dangling-ends  (%s)' % r_site)
-        ax2.set_xlim((0, len(line)))
-        lig_cnt = (np.nansum(liges) - liges[0] - liges[len(line) / 2])
-        sit_cnt = (np.nansum(sites) - sites[0] - sites[len(line) / 2])
+        ax2.set_xlim((0, len_line))
+        lig_cnt = (np.nansum(liges) - liges[0] - liges[len_line / 2])
+        sit_cnt = (np.nansum(sites) - sites[0] - sites[len_line / 2])
         plt.title(('Proportion of digested sites: %.0f%%\n' +
                    'Proportion of dangling-ends: %.0f%%') %(
                       (100. * lig_cnt) / (lig_cnt + sit_cnt),
-                      ((100. * (fixes[0] + (fixes[(len(line) / 2)]
+                      ((100. * (fixes[0] + (fixes[(len_line / 2)]
                                             if paired else 0)))
                        / nreads)
                       if any([f > 0 for f in fixes])
-                      else (100. * (sites[0] + (sites[(len(line) / 2)]
+                      else (100. * (sites[0] + (sites[(len_line / 2)]
                                                 if paired else 0))) / nreads))
         plt.subplots_adjust(right=0.85)
     if savefig:
@@ -241,3 +224,232 @@ def make_patch_spines_invisible(ax):
     ax.patch.set_visible(False)
     for sp in ax.spines.itervalues():
         sp.set_visible(False)
+
+
+class _FastqStats(object):
+    """
+    Per-position statistics over the reads of a FASTQ file: histogram of
+    PHRED scores, count of "N", and count of matches of a list of regular
+    expressions (start positions).
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.hist     = np.zeros((0, NQUALS), dtype=np.int64)
+        self.henes    = np.zeros(0, dtype=np.int64)
+        self.sites    = [np.zeros(0, dtype=np.int64) for _ in patterns]
+        self.nreads   = 0
+        self.min_len  = None
+        self.len_line = 0
+
+    def _add(self, name, counts):
+        arr = getattr(self, name)
+        if len(arr) < len(counts):
+            arr = np.concatenate((arr, np.zeros((len(counts) - len(arr),) +
+                                                arr.shape[1:], dtype=arr.dtype)))
+        arr[:len(counts)] += counts
+        setattr(self, name, arr)
+
+    def add_batch(self, seqs, quals):
+        """
+        :param seqs: list of sequences (with end of line)
+        :param quals: list of quality lines (with end of line)
+        """
+        if not quals:
+            return
+        self.nreads  += len(quals)
+        self.len_line = len(quals[-1])
+        for size in set([len(q) for q in quals]):
+            qls = [q for q in quals if len(q) == size]
+            sqs = [s for s, q in zip(seqs, quals) if len(q) == size]
+            # remove end of line (the last character of all lines but,
+            # maybe, the last one of the file)
+            size = len(qls[0].rstrip())
+            qls = [q[:size] for q in qls]
+            if self.min_len is None or size < self.min_len:
+                self.min_len = size
+            qarr = np.fromstring(''.join(qls), dtype=np.uint8).reshape(
+                len(qls), size).astype(np.int64) - ord('!')
+            qarr += np.arange(size) * NQUALS
+            self._add('hist', np.bincount(qarr.ravel(),
+                                          minlength=size * NQUALS).reshape(
+                                              size, NQUALS))
+            for slen in set([len(s) for s in sqs]):
+                same = ''.join([s for s in sqs if len(s) == slen])
+                sarr = np.fromstring(same, dtype=np.uint8).reshape(-1, slen)
+                self._add('henes', (sarr == ord('N')).sum(axis=0))
+                for k, pattern in enumerate(self.patterns):
+                    starts = [m.start() % slen
+                              for m in re.finditer(pattern, same)]
+                    if starts:
+                        self.sites[k] = _padd_add(
+                            self.sites[k], np.bincount(starts))
+
+    def merge(self, other):
+        """
+        adds the statistics of an other _FastqStats object
+        """
+        if not other.nreads:
+            return self
+        self.nreads  += other.nreads
+        self.len_line = other.len_line
+        if self.min_len is None or other.min_len < self.min_len:
+            self.min_len = other.min_len
+        self._add('hist', other.hist)
+        self._add('henes', other.henes)
+        self.sites = [_padd_add(s, o) for s, o in zip(self.sites, other.sites)]
+        return self
+
+    def quality_mean_std(self):
+        """
+        :returns: mean and standard deviation of PHRED scores per position (up
+           to the length of the shortest read)
+        """
+        hist = self.hist[:self.min_len].astype(float)
+        nums = hist.sum(axis=1)
+        scores = np.arange(NQUALS)
+        means = (hist * scores).sum(axis=1) / nums
+        stds = np.sqrt(np.maximum(
+            (hist * scores**2).sum(axis=1) / nums - means**2, 0))
+        return list(means), list(stds)
+
+    def site_counts(self, k, size):
+        """
+        :returns: number of matches of the pattern k per position, as a list
+           of the given size
+        """
+        counts = [int(c) for c in self.sites[k][:size]]
+        return counts + [0] * (size - len(counts))
+
+
+def _padd_add(arr1, arr2):
+    if len(arr1) < len(arr2):
+        arr1, arr2 = arr2, arr1
+    arr1 = arr1.copy()
+    arr1[:len(arr2)] += arr2
+    return arr1
+
+
+def _fastq_open(fnam):
+    if fnam.endswith('.gz'):
+        return gzip_reader(fnam)
+    return open(fnam)
+
+
+def _fastq_batches(fhandler, nreads=None, stride=1, end=None):
+    """
+    Iterates over batches of reads of a FASTQ file.
+
+    :param fhandler: opened FASTQ
+    :param None nreads: maximum number of reads to yield
+    :param 1 stride: yield one read every stride reads
+    :param None end: stop at this byte offset (only for uncompressed files)
+
+    :returns: lists of sequences and of quality lines
+    """
+    seqs  = []
+    quals = []
+    count = 0
+    readline = fhandler.readline
+    while True:
+        if end is not None and fhandler.tell() >= end:
+            break
+        if not readline():
+            break
+        seq = readline()
+        readline()
+        qual = readline()
+        count += 1
+        if count % stride:
+            continue
+        seqs.append(seq)
+        quals.append(qual)
+        if nreads and count >= nreads * stride:
+            break
+        if len(quals) == BATCH:
+            yield seqs, quals
+            seqs  = []
+            quals = []
+    if quals:
+        yield seqs, quals
+
+
+def _reservoir(fhandler, nreads, stride=1):
+    """
+    Uniform sampling of nreads reads over the whole FASTQ file.
+    """
+    rand  = Random(1)
+    seqs  = []
+    quals = []
+    count = 0
+    for bseqs, bquals in _fastq_batches(fhandler, stride=stride):
+        for seq, qual in zip(bseqs, bquals):
+            if count < nreads:
+                seqs.append(seq)
+                quals.append(qual)
+            else:
+                pos = rand.randint(0, count)
+                if pos < nreads:
+                    seqs[pos]  = seq
+                    quals[pos] = qual
+            count += 1
+    return seqs, quals
+
+
+def _batch_stats(args):
+    patterns, seqs, quals = args
+    stats = _FastqStats(patterns)
+    stats.add_batch(seqs, quals)
+    return stats
+
+
+def _chunk_stats(args):
+    patterns, fnam, beg, end, stride = args
+    stats = _FastqStats(patterns)
+    fhandler = open(fnam)
+    fhandler.seek(beg)
+    for seqs, quals in _fastq_batches(fhandler, stride=stride, end=end):
+        stats.add_batch(seqs, quals)
+    fhandler.close()
+    return stats
+
+
+def fastq_chunk_offsets(fnam, nchunks):
+    """
+    Divides an uncompressed FASTQ file in chunks of (about) the same size,
+    with boundaries aligned to the beginning of FASTQ records.
+
+    :param fnam: path to an uncompressed FASTQ file
+    :param nchunks: number of chunks
+
+    :returns: a list of (start, end) byte offsets
+    """
+    size = os.path.getsize(fnam)
+    fhandler = open(fnam)
+    offsets = [0]
+    for i in xrange(1, nchunks):
+        pos = _record_start(fhandler, size * i / nchunks)
+        if pos > offsets[-1]:
+            offsets.append(pos)
+    fhandler.close()
+    offsets.append(size)
+    return [(offsets[i], offsets[i + 1]) for i in xrange(len(offsets) - 1)
+            if offsets[i] < offsets[i + 1]]
+
+
+def _record_start(fhandler, pos):
+    """
+    search the beginning of the first FASTQ record after a given byte offset.
+    A record header starts with '@' and is followed, two lines after, by a line
+    starting with '+' (quality lines may start with '@', but are followed,
+    two lines after, by a sequence).
+    """
+    fhandler.seek(pos)
+    if pos:
+        pos += len(fhandler.readline())
+    lines = [fhandler.readline() for _ in xrange(3)]
+    while lines[0]:
+        if lines[0].startswith('@') and lines[2].startswith('+'):
+            return pos
+        pos += len(lines[0])
+        lines = lines[1:] + [fhandler.readline()]
+    return pos
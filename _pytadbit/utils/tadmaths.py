@@ -8,6 +8,10 @@ from bisect    import bisect_left
 from itertools import combinations
 from math      import log10, exp
 from warnings  import warn
+from multiprocessing.pool import ThreadPool
+from scipy     import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial.distance import squareform
 import numpy as np
 
 
@@ -190,6 +194,139 @@ def calinski_harabasz(scores, clusters):
 
 
 
+def calinski_harabasz_linkage(scores, clust):
+    """
+    Computes the CH score (see :func:`calinski_harabasz`) of each of the
+    clusterings found while walking up a hierarchical clustering. The sums
+    of squared distances between and within clusters are updated at each
+    merge, instead of being recomputed for each clustering.
+
+    :param scores: condensed array of the distances between elements (as
+       used by scipy.cluster.hierarchy.linkage)
+    :param clust: linkage matrix of these elements (as returned by
+       scipy.cluster.hierarchy.linkage)
+
+    :returns: an array with the CH score of the clustering obtained after
+       each merge of the linkage matrix
+    """
+    # sums of squared distances between clusters, one row per cluster
+    cross = squareform(np.asarray(scores, dtype=float)**2)
+    nelem = len(cross)
+    size = np.ones(nelem)
+    within = np.zeros(nelem) # sums of squared distances inside clusters
+    grouped = np.zeros(nelem, dtype=bool) # clusters with more than 1 element
+    # row of each cluster (merged clusters take the row of their first half)
+    rows = range(nelem)
+    between_mean = 0. # sum over pairs of clusters of mean squared distances
+    within_mean = 0.  # sum over clusters of mean squared distances
+    ngroups = nelems = 0
+    result = np.zeros(len(clust))
+
+    def _between(row):
+        others = grouped.copy()
+        others[row] = False
+        return (cross[row, others] / size[others]).sum() / size[row]
+
+    for step, (cl1, cl2) in enumerate(clust[:, :2].astype(int).tolist()):
+        row1, row2 = rows[cl1], rows[cl2]
+        # remove the two clusters
+        for row in (row1, row2):
+            if grouped[row]:
+                between_mean -= _between(row)
+                within_mean  -= within[row] / (size[row] * (size[row] - 1) / 2)
+                ngroups -= 1
+                nelems  -= size[row]
+        if grouped[row1] and grouped[row2]: # removed twice
+            between_mean += cross[row1, row2] / (size[row1] * size[row2])
+        # add the merged one
+        within[row1] += within[row2] + cross[row1, row2]
+        size[row1]   += size[row2]
+        cross[row1]    += cross[row2]
+        cross[:, row1] += cross[:, row2]
+        grouped[row1] = True
+        grouped[row2] = False
+        rows.append(row1)
+        between_mean += _between(row1)
+        within_mean  += within[row1] / (size[row1] * (size[row1] - 1) / 2)
+        ngroups += 1
+        nelems  += size[row1]
+        if ngroups > 1:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result[step] = ((between_mean / ((ngroups - 1.0) / 2)
+                                 / (ngroups - 1))
+                                /
+                                (within_mean / (nelems - ngroups)))
+    return result
+
+
+def markov_clustering(matrix, inflation=2.0, prune=1e-4, max_iter=100,
+                      n_cpus=1):
+    """
+    Markov clustering (MCL) [VanDongen2000]_ of a weighted graph, on sparse
+    matrices. As in the mcl program, a loop weighted as its heaviest edge is
+    added to each node; the expanded matrix is then inflated, and the
+    smallest transition probabilities are pruned, until convergence.
+
+    :param matrix: scipy.sparse square and symmetric matrix with the weights
+       of the edges between nodes
+    :param 2.0 inflation: inflation exponent (the higher, the more clusters)
+    :param 1e-4 prune: transition probabilities below this value are removed
+       after each iteration
+    :param 100 max_iter: maximum number of iterations
+    :param 1 n_cpus: number of threads used to compute matrix products
+
+    :returns: a list of clusters (lists of node indexes), the more populated
+       first
+    """
+    matrix = sparse.csc_matrix(matrix, dtype=float)
+    size = matrix.shape[0]
+    loops = matrix.max(axis=0).toarray().ravel()
+    loops[loops == 0] = 1
+    matrix = _normalize_columns(matrix + sparse.diags(loops, format='csc'))
+    pool = ThreadPool(n_cpus) if n_cpus > 1 and size >= 2 * n_cpus else None
+    bounds = np.linspace(0, size, n_cpus + 1).astype(int).tolist()
+    try:
+        for _ in xrange(max_iter):
+            last = matrix
+            # expansion, with columns divided between threads
+            if pool:
+                matrix = sparse.hstack(pool.map(
+                    lambda (beg, end): last * last[:, beg:end],
+                    zip(bounds[:-1], bounds[1:])), format='csc')
+            else:
+                matrix = last * last
+            # inflation
+            matrix.data **= inflation
+            matrix = _normalize_columns(matrix)
+            # pruning
+            matrix.data[matrix.data < prune] = 0
+            matrix.eliminate_zeros()
+            matrix = _normalize_columns(matrix)
+            if abs(matrix - last).max() < 1e-6:
+                break
+    finally:
+        if pool:
+            pool.close()
+    # nodes attracted to the same node belong to the same cluster
+    _, labels = connected_components(matrix, directed=True,
+                                     connection='weak')
+    clusters = {}
+    for node, label in enumerate(labels.tolist()):
+        clusters.setdefault(label, []).append(node)
+    return sorted(clusters.values(), key=lambda x: (-len(x), x[0]))
+
+
+def _normalize_columns(matrix):
+    """
+    Divides each column of a scipy.sparse.csc_matrix by its sum.
+    """
+    matrix = matrix.tocsc()
+    sums = np.asarray(matrix.sum(axis=0)).ravel()
+    sums[sums == 0] = 1
+    matrix.data /= np.repeat(sums, np.diff(matrix.indptr))
+    return matrix
+
+
 def mean_none(values):
     """
     Calculates the mean of a list of values without taking into account the None
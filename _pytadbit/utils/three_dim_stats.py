@@ -4,9 +4,9 @@
 
 """
 
-from pytadbit.eqv_rms_drms import rmsdRMSD_wrapper
-from pytadbit.consistency import consistency_wrapper
+from pytadbit.eqv_rms_drms import rmsdRMSD_condensed
 from itertools import combinations
+from scipy.spatial import cKDTree
 import numpy as np
 from math import pi, sqrt, cos, sin, acos
 
@@ -284,21 +284,49 @@ def angle_between_3_points(point1, point2, point3):
 
 
 def calc_consistency(models, nloci, zeros, dcutoff=200):
-    combines = list(combinations(models, 2))
-    parts = [0 for _ in xrange(nloci)]
-    for pm in consistency_wrapper([models[m]['x'] for m in models],
-                                  [models[m]['y'] for m in models],
-                                  [models[m]['z'] for m in models],
-                                  zeros,
-                                  nloci, dcutoff, range(len(models)),
-                                  len(models)):
-        for i, p in enumerate(pm):
-            parts[i] += p
-    return [float(p)/len(combines) * 100 for p in parts]
+    """
+    :param models: dictionary of models
+    :param nloci: number of particles per model
+    :param zeros: list of True/False representing particles to skip
+    :param 200 dcutoff: distance in nanometer from which it is considered
+       that two particles are separated.
+
+    :returns: the consistency of each particle (see
+       :func:`calc_consistencies`)
+    """
+    coords = np.array([[models[m][axis][:nloci] for axis in ('x', 'y', 'z')]
+                       for m in models], dtype=float).transpose(0, 2, 1)
+    return calc_consistencies(coords, [dcutoff], zeros)[0].tolist()
+
+
+def calc_consistencies(coords, cutoffs, zeros=None):
+    """
+    Computes the consistency of each particle, as the percentage of pairs of
+    models in which the particle is at less than a given distance from its
+    equivalent, once the models superimposed (see :func:`superimpose`). Each
+    pair of models is superimposed only once, the distances between
+    equivalent particles being compared to all the cutoffs at the same time.
+
+    :param coords: array of coordinates, of shape (number of models, number of
+       particles, 3)
+    :param cutoffs: list of distance cutoffs (nm)
+    :param None zeros: list of True/False representing particles to skip
+       when superimposing models
+
+    :returns: an array of shape (number of cutoffs, number of particles) with
+       the consistency of each particle at each cutoff
+    """
+    cutoffs = np.array(cutoffs, dtype=float)[:, None]
+    counts = np.zeros((len(cutoffs), coords.shape[1]))
+    for i in xrange(len(coords) - 1):
+        aligned, reference = superimpose(coords[i + 1:], coords[i], zeros)
+        dists = np.sqrt(((aligned - reference)**2).sum(axis=2))
+        counts += (dists[:, None] < cutoffs).sum(axis=0)
+    return counts / (len(coords) * (len(coords) - 1) / 2) * 100
 
 
 def calc_eqv_rmsd(models, nloci, zeros, dcutoff=200, one=False, what='score',
-                  normed=True):
+                  normed=True, n_cpus=1):
     """
     Calculates the RMSD, dRMSD, the number of equivalent positions and a score
     combining these three measures. The measure are done between a group of
@@ -315,6 +343,7 @@ def calc_eqv_rmsd(models, nloci, zeros, dcutoff=200, one=False, what='score',
        'drmsd' or 'eqv'
     :param True normed: normalize result by maximum value (only applies to rmsd
        and drmsd)
+    :param 1 n_cpus: number of threads used to compare the models
 
     :returns: a score of each pairwise comparison according to:
 
@@ -326,24 +355,69 @@ def calc_eqv_rmsd(models, nloci, zeros, dcutoff=200, one=False, what='score',
        where :math:`eqvs_i` is the number of equivalent position for the ith
        pairwise model comparison.
        
+    """
+    if one:
+        what, normed = 'drmsd', False
+    coords = np.array([(models[m]['x'], models[m]['y'], models[m]['z'])
+                       for m in xrange(len(models))], dtype=float)
+    scores = eqv_rmsd_condensed(coords.transpose(0, 2, 1)[:, :nloci], zeros,
+                                dcutoff=dcutoff, what=what, normed=normed,
+                                n_cpus=n_cpus).tolist()
+    if one:
+        return scores[0]
+    result = {}
+    for (i, j), score in zip(combinations(xrange(len(models)), 2), scores):
+        result[(i, j)] = result[(j, i)] = score
+    return result
+
+
+def eqv_rmsd_condensed(coords, zeros, dcutoff=200, what='score', normed=True,
+                       n_cpus=1):
+    """
+    Same as :func:`calc_eqv_rmsd`, from an array of coordinates, and returning
+    the scores in the order of a condensed distance matrix (as used by
+    scipy.cluster.hierarchy.linkage): (0, 1), (0, 2) ... (0, n), (1, 2) ...
+
+    The pairwise comparisons are divided between several threads.
+
+    :param coords: array of shape (number of models, number of particles, 3)
+    :param zeros: list of True/False representing particles to skip
+    :param 200 dcutoff: distance in nanometer from which it is considered
+       that two particles are separated.
+    :param 'score' what: values to return. Can be one of 'score', 'rmsd',
+       'drmsd' or 'eqv'
+    :param True normed: normalize result by maximum value (only applies to rmsd
+       and drmsd)
+    :param 1 n_cpus: number of threads used to compare the models
+
+    :returns: an array with the score of each pairwise comparison
     """
     what = what.lower()
     if not what in ['score', 'rmsd', 'drmsd', 'eqv']:
         raise NotImplementedError("Only 'score', 'rmsd', 'drmsd' or 'eqv' " +
                                   "features are available\n")
+    coords = np.asarray(coords, dtype=float)
     # remove particles with zeros from calculation
-    x = []
-    y = []
-    z = []
-    for m in xrange(len(models)):
-        x.append([models[m]['x'][i] for i in xrange(nloci) if zeros[i]])
-        y.append([models[m]['y'][i] for i in xrange(nloci) if zeros[i]])
-        z.append([models[m]['z'][i] for i in xrange(nloci) if zeros[i]])
-    zeros = tuple([True for _ in xrange(len(x[0]))])
-    scores = rmsdRMSD_wrapper(x, y, z, zeros, len(zeros),
-                              dcutoff, range(len(models)), len(models),
-                              int(one), what, int(normed))
-    return scores
+    keep = np.array([bool(zeros[i]) for i in xrange(coords.shape[1])],
+                    dtype=bool)
+    coords = np.ascontiguousarray(coords[:, keep])
+    nmodels, size = coords.shape[:2]
+    npairs = nmodels * (nmodels - 1) / 2
+    eqvs   = np.empty(npairs)
+    rmsds  = np.empty(npairs)
+    drmsds = np.empty(npairs)
+    if not npairs:
+        return eqvs
+    rmsdRMSD_condensed(coords, (True, ) * size, size, nmodels, dcutoff,
+                       n_cpus, eqvs, rmsds, drmsds)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if what == 'eqv':
+            return eqvs
+        if what == 'rmsd':
+            return 1 - rmsds / rmsds.max() if normed else rmsds
+        if what == 'drmsd':
+            return 1 - drmsds / drmsds.max() if normed else drmsds
+        return eqvs * drmsds / rmsds * (rmsds.max() / drmsds.max())
 
 
 def dihedral(a, b, c, d):
@@ -374,9 +448,173 @@ def getAngle(v1v2, v2v3):
         )
 
 
+def particle_distances(coords, parts1, parts2):
+    """
+    Calculates the distances between pairs of particles in a set of models.
+
+    :param coords: array of coordinates, of shape (number of models, number of
+       particles, 3)
+    :param parts1: list of indexes of the first particles of each pair
+    :param parts2: list of indexes of the second particles of each pair
+
+    :returns: an array of distances, with one row per model and one column per
+       pair of particles
+    """
+    diff = coords[:, parts1] - coords[:, parts2]
+    return np.sqrt(diff[..., 0]**2 + diff[..., 1]**2 + diff[..., 2]**2)
+
+
+def angles_from_distances(a, b, c):
+    """
+    Calculates angles from the lengths of the sides of triangles, with the
+    theorem of Al-Kashi (see :func:`angle_between_3_points`).
+
+    :param a: array with the lengths of the sides BC
+    :param b: array with the lengths of the sides AC
+    :param c: array with the lengths of the sides AB
+
+    :returns: an array of angles ABC in radians (0 when the triangle can not
+       be formed)
+    """
+    cosang = np.asarray((a**2 - b**2 + c**2) / (2 * a * c))
+    return np.where(abs(cosang) > 1, 0., np.arccos(np.clip(cosang, -1, 1)))
+
+
+def dihedrals(a, b, c, d):
+    """
+    Calculates the dihedral angles between the planes formed by a, b, c and
+    by b, c, d (see :func:`dihedral`).
+
+    :param a: array of coordinates, of shape (number of angles, 3)
+    :param b: array of coordinates, of shape (number of angles, 3)
+    :param c: array of coordinates, of shape (number of angles, 3)
+    :param d: array of coordinates, of shape (number of angles, 3)
+
+    :returns: an array of signed angles in degrees
+    """
+    def _normed(dif):
+        return dif / np.sqrt((dif**2).sum(axis=-1))[..., None]
+    v1 = _normed(b - a)
+    v2 = _normed(b - c)
+    v3 = _normed(c - b)
+    v4 = _normed(c - d)
+    v1v2 = np.cross(v1, v2)
+    v2v3 = np.cross(v3, v4)
+    sign = np.where((v2 * np.cross(v1v2, v2v3)).sum(axis=-1) < 0, -1, 1)
+    angle = np.rad2deg(np.arccos((_normed(v1v2) * _normed(v2v3)).sum(axis=-1)))
+    return np.where(angle <= 90, sign * angle, -sign * (180 - angle))
+
+
+def superimpose(coords, reference, zeros=None):
+    """
+    Superimposes models onto a reference model, all at once (Kabsch
+    algorithm computed on stacked arrays). Models and reference are first
+    centered on their center of mass.
+
+    :param coords: array of coordinates, of shape (number of models, number of
+       particles, 3)
+    :param reference: array of coordinates of the reference model, of shape
+       (number of particles, 3)
+    :param None zeros: list of booleans, the particles set to False are not
+       used to compute centers of mass and rotations (they are moved with the
+       others though). By default all particles are used
+
+    :returns: the array of the coordinates of the superimposed models, and
+       the coordinates of the centered reference
+    """
+    keep = (np.ones(coords.shape[1], dtype=bool) if not zeros else
+            np.array([bool(zeros[i]) for i in xrange(coords.shape[1])]))
+    coords = coords - coords[:, keep].mean(axis=1)[:, None]
+    reference = reference - reference[keep].mean(axis=0)
+    # rotations minimizing the RMSD with the reference, without reflection
+    u, _, vt = np.linalg.svd(np.einsum('mki,kj->mij', coords[:, keep],
+                                       reference[keep]))
+    u[:, :, 2] *= np.sign(np.linalg.det(np.matmul(u, vt)))[:, None]
+    return np.matmul(coords, np.matmul(u, vt)), reference
+
+
+_SPHERES = {} # unit spheres, by number of points
+_CIRCLES = {} # cosine and sine of the angles of circles, by number of points
+
+
+def _sphere_template(nump):
+    """
+    :returns: the (cached) array of the points of a sphere of radius 1 (see
+       :func:`generate_sphere_points`)
+    """
+    if not nump in _SPHERES:
+        _SPHERES[nump] = np.array(generate_sphere_points(nump)).reshape(-1, 3)
+        _SPHERES[nump].flags.writeable = False
+    return _SPHERES[nump]
+
+
+def _circle_template(n):
+    """
+    :returns: the (cached) cosine and sine of the angles of the points of a
+       circle (see :func:`generate_circle_points`)
+    """
+    if not n in _CIRCLES:
+        angles = np.arange(int(n)) * (2 * pi / float(n))
+        _CIRCLES[n] = np.cos(angles), np.sin(angles)
+    return _CIRCLES[n]
+
+
+def _rotate_circle(x, y, z, u, v, w, n):
+    """
+    Same as :func:`generate_circle_points`, with cached angles.
+
+    :returns: an array with the coordinates of the points in the circle
+    """
+    cosang, sinang = _circle_template(n)
+    dst = u**2 + v**2 + w**2
+    sqrtdst = sqrt(dst)
+    uxvywz =  - u*x - v*y - w*z
+    dcosang = cosang * dst
+    return np.column_stack((
+        ((-u * uxvywz) * (1 - cosang) + x * dcosang +
+         sqrtdst * (- w*y + v*z) * sinang) / dst,
+        ((-v * uxvywz) * (1 - cosang) + y * dcosang +
+         sqrtdst * (+ w*x - u*z) * sinang) / dst,
+        ((-w * uxvywz) * (1 - cosang) + z * dcosang +
+         sqrtdst * (- v*x + u*y) * sinang) / dst))
+
+
+def _square_dist(point, dots):
+    """
+    :returns: the square distances between a point and an array of dots
+    """
+    return ((point[0] - dots[:, 0])**2 +
+            (point[1] - dots[:, 1])**2 +
+            (point[2] - dots[:, 2])**2)
+
+
+def _far_from_edge(dots, point1, point2, right_angle, radius):
+    """
+    Checks that dots around an edge are not too close from the next edge,
+    going from point1 to point2 (angle computed as in
+    :func:`angle_between_3_points`).
+    """
+    hyp = np.sqrt(_square_dist(point1, dots))
+    a = sqrt((point1[0] - point2[0])**2 +
+             (point1[1] - point2[1])**2 +
+             (point1[2] - point2[2])**2)
+    b = np.sqrt(_square_dist(point2, dots))
+    cosang = (a**2 - b**2 + hyp**2) / (2 * a * hyp)
+    ang = np.where(abs(cosang) > 1, 0., np.arccos(np.clip(cosang, -1, 1)))
+    return ~((ang < right_angle) & (np.sin(ang) * hyp < radius))
+
+
 def build_mesh(xis, yis, zis, nloci, nump, radius, superradius, include_edges):
     """
     Main function for the calculation of the accessibility of a model.
+
+    The dots around each particle and each edge are obtained by translating
+    (and rotating, for edges) cached templates of spheres and circles.
+
+    :returns: the coordinates of the particles and edge segments, the
+       coordinates of the dots in the mesh and in the super mesh (as arrays),
+       and a dictionary with the list of dots belonging to each particle and
+       edge segment
     """
     superradius = superradius or 1
     # number of dots in a circle is dependent the ones in a sphere
@@ -388,158 +626,135 @@ def build_mesh(xis, yis, zis, nloci, nump, radius, superradius, include_edges):
     # number of circles per sphere needed to get previous equality are
     # dependent of:
     fact = float(nump)/numc/(2*radius)
-    # starts big loop
+    xyz = np.column_stack((np.asarray(xis[:nloci], dtype=float),
+                           np.asarray(yis[:nloci], dtype=float),
+                           np.asarray(zis[:nloci], dtype=float)))
+    sphere = _sphere_template(nump)
+    # dots of the spheres around all particles, with the distances and
+    # corrections (uses intercept theorem) needed to place them outside
+    # torsion angles
+    spheres = sphere[None, :, :] * radius + xyz[:, None, :]
+    supers  = sphere[None, :, :] * superradius + xyz[:, None, :]
+    dif     = xyz[:-1] - xyz[1:]
+    adj     = np.sqrt(dif[:, 0]**2 + dif[:, 1]**2 + dif[:, 2]**2)
+    betweens = (fact * adj + 0.5).astype(int)
+    hyps    = np.sqrt(adj**2 + radius**2)
+    hyp1    = (hyps - hyps / (2 * (1 + betweens)))**2
+    hyp2    = np.empty_like(hyp1)
+    hyp2[1:] = (hyps[:-1] - hyps[:-1] / (2 * (1 + betweens[1:])))**2
+    # find vectors orthogonal to the axes between consecutive particles
+    orthoz  = -(dif[:, 0] + dif[:, 1]) / dif[:, 2]
+    normer  = np.sqrt(2. + orthoz**2)
+    orthox  = 1. / normer
+    orthoz /= normer
     points    = [] # stores the particle coordinates and,
                    # if include_edges is True, the edge segments
     subpoints = [] # store the coordinates of each dot in the mesh
     supersubpoints = [] # store the coordinates of each dot in the mesh
     positions = {} # a dict to get dots belonging to a given point
-    sphere    = generate_sphere_points(nump)
+    ndots     = 0
     i = 0
     for i in xrange(nloci - 1):
-        modelx   = xis[i]
-        modely   = yis[i]
-        modelz   = zis[i]
-        modelx1  = xis[i+1]
-        modely1  = yis[i+1]
-        modelz1  = zis[i+1]
-        if i < nloci - 2:
-            modelx2  = xis[i+2]
-            modely2  = yis[i+2]
-            modelz2  = zis[i+2]
-        if i:
-            modelx_1 = xis[i-1]
-            modely_1 = yis[i-1]
-            modelz_1 = zis[i-1]            
-        point = [modelx, modely, modelz]
-        points.append(point)
-        # get minimum length from next particle to display the sphere dot
-        adj1 = distance(point, [modelx1, modely1, modelz1])
-
-        # find a vector orthogonal to the axe between particle i and i+1
-        difx = modelx - modelx1
-        dify = modely - modely1
-        difz = modelz - modelz1
-        # orthox = 1.
-        # orthoy = 1.
-        orthoz = -(difx + dify) / difz
-        #normer = sqrt(orthox**2 + orthoy**2 + orthoz**2) / radius
-        normer = sqrt(2. + orthoz**2)# / radius
-        orthox = 1. / normer
-        orthoy = 1. / normer
-        orthoz /= normer
-        # define the number of circle to draw in this section
-        between = int(fact * adj1 + 0.5)
-        try:
-            stepx = difx / between
-            stepy = dify / between
-            stepz = difz / between
-        except ZeroDivisionError:
-            stepx = stepy = stepz = 0
-
-        hyp1 = sqrt(adj1**2 + radius**2)
-        # this is an attempt of correction for the integrity of dots
-        # uses intercept theorem
-        hyp1 = (hyp1 - hyp1 / (2 * (1 + between)))**2
-
-        # get minimum length from prev particle to display the sphere dot
+        point = xyz[i]
+        points.append(point[None, :])
+        # set sphere around each particle, only outside torsion angle
+        keep = _square_dist(xyz[i + 1], spheres[i]) > hyp1[i]
         if i:
-            adj2 = distance(point, [modelx_1, modely_1, modelz_1])
-            hyp2 = sqrt(adj2**2 + radius**2)
-            # this is an attempt of correction for the integrity of dots
-            hyp2 = (hyp2 - hyp2 / (2 * (1 + between)))**2
-
-        # set sphere around each particle
-        for xxx, yyy, zzz in sphere:
-            thing = [xxx * radius + modelx,
-                     yyy * radius + modely,
-                     zzz * radius + modelz]
-            # same for super mesh
-            superthing = [xxx * superradius + modelx,
-                          yyy * superradius + modely,
-                          zzz * superradius + modelz]
-            # only place mesh outside torsion angle
-            if fast_square_distance(modelx1, modely1, modelz1,
-                                    thing[0], thing[1], thing[2]) > hyp1:
-                if not i:
-                    subpoints.append(thing)
-                    supersubpoints.append(superthing)
-                elif fast_square_distance(modelx_1, modely_1, modelz_1,
-                                          thing[0], thing[1], thing[2]) > hyp2:
-                    subpoints.append(thing)
-                    supersubpoints.append(superthing)
-                else:
-                    continue
-                positions.setdefault(i, []).append(len(subpoints)-1)
-
-        def _add_circle(k, ptx, pty, ptz):
-            for spoint in generate_circle_points(
-                orthox, orthoy, orthoz, difx ,dify, difz,
-                # correction for integer of numc
-                numc + (1 if c_count%100 < remaining else 0)):
-                dot = [spoint[0] * radius + ptx,
-                       spoint[1] * radius + pty,
-                       spoint[2] * radius + ptz]
-                superdot = [spoint[0] * superradius + ptx,
-                            spoint[1] * superradius + pty,
-                            spoint[2] * superradius + ptz]
-                # check that dot in circle is not too close from next edge
-                if i < nloci - 2:
-                    hyp = distance((modelx1, modely1, modelz1), dot)
-                    ang = angle_between_3_points(dot,
-                                                 (modelx1, modely1, modelz1),
-                                                 (modelx2, modely2, modelz2))
-                    if ang < right_angle:
-                        if sin(ang) * hyp < radius:
-                            continue
-                # check that dot in circle is not too close from previous edge
-                if i:
-                    hyp = distance((modelx, modely, modelz), dot)
-                    ang = angle_between_3_points(dot,
-                                                 (modelx, modely, modelz),
-                                                 (modelx_1, modely_1, modelz_1))
-                    if ang < right_angle:
-                        if sin(ang) * hyp < radius:
-                            continue
-                # print 'here'
-                subpoints.append([dot[0], dot[1], dot[2]])
-                supersubpoints.append([superdot[0], superdot[1], superdot[2]])
-                positions.setdefault(i + float(k)/between, []).append(
-                    len(subpoints) - 1)
+            keep &= _square_dist(xyz[i - 1], spheres[i]) > hyp2[i]
+        if keep.any():
+            subpoints.append(spheres[i][keep])
+            supersubpoints.append(supers[i][keep])
+            positions[i] = range(ndots, ndots + len(subpoints[-1]))
+            ndots += len(subpoints[-1])
 
         # define slices
-        for k in xrange(between - 1, 0, -1):
-            point = [modelx - k * stepx, modely - k * stepy, modelz - k * stepz]
-            points.append(point)
-            pointx, pointy, pointz = point
-
-            if not include_edges:
-                continue
-            # define circles
-            _add_circle(k, pointx, pointy, pointz)
+        between = betweens[i]
+        if between < 2:
+            continue
+        slices = xrange(between - 1, 0, -1)
+        points.append(point - np.arange(between - 1, 0, -1)[:, None] *
+                      (dif[i] / between))
+        if not include_edges:
+            continue
+        # define circles (with correction for integer of numc)
+        circles = []
+        for k in slices:
+            circles.append(_rotate_circle(
+                orthox[i], orthox[i], orthoz[i], dif[i, 0], dif[i, 1],
+                dif[i, 2], numc + (1 if c_count%100 < remaining else 0)))
             c_count += 1
-
-    # add last point!!
-    point = [xis[i+1], yis[i+1], zis[i+1]]
-    points.append(point)
-    # and its sphere
-    adj = distance(point, [modelx, modely, modelz])
-    hyp2 = sqrt(adj**2 + radius**2)
-    hyp2 = (hyp2 - hyp2 / (2 * (1 + between)))**2
-    for xxx, yyy, zzz in sphere:
-        thing = [xxx * radius + modelx1,
-                 yyy * radius + modely1,
-                 zzz * radius + modelz1]
-        superthing = [xxx * superradius + modelx1,
-                      yyy * superradius + modely1,
-                      zzz * superradius + modelz1]
-        if fast_square_distance(modelx, modely, modelz,
-                                thing[0], thing[1], thing[2]) > hyp2:
-            subpoints.append(thing)
-            supersubpoints.append(superthing)
-        positions.setdefault(i+1, []).append(len(subpoints)-1)
-
-    return points, subpoints, supersubpoints, positions
-
+        sizes = [len(c) for c in circles]
+        circles = np.concatenate(circles)
+        centers = np.repeat(points[-1], sizes, axis=0)
+        dots = circles * radius + centers
+        keep = np.ones(len(dots), dtype=bool)
+        # check that dot in circle is not too close from next edge
+        if i < nloci - 2:
+            keep &= _far_from_edge(dots, xyz[i + 1], xyz[i + 2],
+                                   right_angle, radius)
+        # check that dot in circle is not too close from previous edge
+        if i:
+            keep &= _far_from_edge(dots, xyz[i], xyz[i - 1],
+                                   right_angle, radius)
+        subpoints.append(dots[keep])
+        supersubpoints.append((circles * superradius + centers)[keep])
+        for k, kept in zip(slices, np.split(keep, np.cumsum(sizes)[:-1])):
+            if kept.any():
+                positions[i + float(k)/between] = range(
+                    ndots, ndots + int(kept.sum()))
+                ndots += int(kept.sum())
+
+    # add last point!! and its sphere
+    points.append(xyz[i + 1][None, :])
+    keep = _square_dist(xyz[i], spheres[i + 1]) > hyp1[i]
+    subpoints.append(spheres[i + 1][keep])
+    supersubpoints.append(supers[i + 1][keep])
+    positions[i + 1] = (ndots + np.cumsum(keep) - 1).tolist()
+
+    return (np.concatenate(points), np.concatenate(subpoints),
+            np.concatenate(supersubpoints), positions)
+
+
+def _close_to_points(tree, points, dots, radius):
+    """
+    Checks, for each dot, if a point is at a distance lower than radius.
+    """
+    if not len(dots):
+        return np.zeros(0, dtype=bool)
+    _, idx = tree.query(dots, distance_upper_bound=abs(radius))
+    close = idx < len(points)
+    near = points[idx[close]] - dots[close]
+    close[close] = (near**2).sum(axis=1) < radius**2
+    return close
 
 
+def mesh_occlusion(points, dots, superdots, radius, superradius):
+    """
+    Checks which dots of a mesh (see :func:`build_mesh`) are occupied by the
+    strand of chromatin. The points of the strand (particles and edge
+    segments) are indexed in a KD-tree, so that each dot is only compared to
+    its closest point.
+
+    :param points: coordinates of the particles and edge segments
+    :param dots: coordinates of the dots of the mesh
+    :param superdots: coordinates of the dots of the super mesh
+    :param radius: radius of the object we want to fit in the model
+    :param superradius: radius of an object used to exclude outer surface of
+       the model (if None or 0, no dot is excluded)
+
+    :returns: two arrays of booleans, one marking the dots outside the model
+       (the ones whose superdot is not close to any point), the other marking
+       the dots inaccessible to an object of the given radius
+    """
+    points = np.array(points, dtype=float).reshape(-1, 3)
+    tree   = cKDTree(points)
+    if superradius:
+        outdot = ~_close_to_points(tree, points,
+                                   np.array(superdots, dtype=float).reshape(-1, 3),
+                                   superradius - 4)
+    else:
+        outdot = np.zeros(len(superdots), dtype=bool)
+    inaccessible = _close_to_points(tree, points,
+                                    np.array(dots, dtype=float).reshape(-1, 3),
+                                    radius - 2)
+    return outdot, inaccessible & ~outdot
@@ -1,5 +1,6 @@
 #include "Python.h"
 #include "align.h"
+#include "py_coords.h"
 
 
 /* The function doc string */
@@ -48,28 +49,24 @@ static PyObject* aligner3d_wrapper(PyObject* self, PyObject* args)
   }
 
 
-  for (i=0; i<size; i++){
+  for (i=0; i<size; i++)
     zeros[i]   = PyObject_IsTrue(PyTuple_GET_ITEM(py_zeros, i));
-    xyz1[i][0] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(py_xs1, i));
-    xyz1[i][1] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(py_ys1, i));
-    xyz1[i][2] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(py_zs1, i));
-    xyz2[i][0] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(py_xs2, i));
-    xyz2[i][1] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(py_ys2, i));
-    xyz2[i][2] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(py_zs2, i));
-  }
-
-  align(xyz2, xyz1, zeros, size);
 
-  // give it to me
   PyObject * py_result = NULL;
   PyObject * py_subresult = NULL;
-  py_result = PyList_New(3);
-  for (int j = 0; j < 3; ++j) {
-    py_subresult = PyList_New(size);
-    for (int i = 0; i < size; ++i) {
-      PyList_SetItem(py_subresult, i, PyFloat_FromDouble(xyz2[i][j]));
+  if (read_coords(py_xs1, py_ys1, py_zs1, size, xyz1) &&
+      read_coords(py_xs2, py_ys2, py_zs2, size, xyz2)) {
+    align(xyz2, xyz1, zeros, size);
+
+    // give it to me
+    py_result = PyList_New(3);
+    for (int j = 0; j < 3; ++j) {
+      py_subresult = PyList_New(size);
+      for (int i = 0; i < size; ++i) {
+	PyList_SetItem(py_subresult, i, PyFloat_FromDouble(xyz2[i][j]));
+      }
+      PyList_SetItem(py_result, j, py_subresult);
     }
-    PyList_SetItem(py_result, j, py_subresult);
   }
   for (int i=0; i<size; i++) {
     delete[] xyz1[i];
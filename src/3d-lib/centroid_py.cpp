@@ -1,5 +1,6 @@
 #include "Python.h"
 #include "3dStats.h"
+#include "py_coords.h"
 #include <iostream>
 // #include <string>
 // using namespace std;
@@ -72,10 +73,15 @@ static PyObject* centroid_wrapper(PyObject* self, PyObject* args)
   }
 
   for (j=0; j<nmodels; j++){
-    for (i=0; i<size; i++){
-      xyz[i][0] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(PyList_GET_ITEM(py_xs, j), i));
-      xyz[i][1] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(PyList_GET_ITEM(py_ys, j), i));
-      xyz[i][2] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(PyList_GET_ITEM(py_zs, j), i));
+    if (!read_coords(PyList_GET_ITEM(py_xs, j), PyList_GET_ITEM(py_ys, j),
+		     PyList_GET_ITEM(py_zs, j), size, xyz)) {
+      for (int i=0; i<size; i++) {
+	delete[] xyz[i];
+	delete[] avg[i];
+      }
+      delete[] xyz;
+      delete[] avg;
+      return NULL;
     }
     tmpStr.str("");
     tmpStr.clear();
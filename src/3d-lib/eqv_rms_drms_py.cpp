@@ -1,5 +1,7 @@
 #include "Python.h"
 #include "3dStats.h"
+#include "py_coords.h"
+#include <pthread.h>
 // #include <iostream>
 // using namespace std;
 
@@ -83,9 +85,22 @@ static PyObject* rmsdRMSD_wrapper(PyObject* self, PyObject* args)
     for (i=0; i<size; i++){
       xyzn[j][i] = new float[3];
       memset(xyzn[j][i], 0, 3*sizeof(float));
-      xyzn[j][i][0] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(PyList_GET_ITEM(py_xs, j ), i));
-      xyzn[j][i][1] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(PyList_GET_ITEM(py_ys, j ), i));
-      xyzn[j][i][2] = PyFloat_AS_DOUBLE(PyList_GET_ITEM(PyList_GET_ITEM(py_zs, j ), i));
+    }
+  }
+  for (j=0; j<nmodels; j++){
+    if (!read_coords(PyList_GET_ITEM(py_xs, j), PyList_GET_ITEM(py_ys, j),
+		     PyList_GET_ITEM(py_zs, j), size, xyzn[j])) {
+      for (int j=0; j<nmodels; j++){
+	for (int i=0; i<size; i++)
+	  delete[] xyzn[j][i];
+	delete[] xyzn[j];
+      }
+      delete[] xyzn;
+      delete[] nrmsds;
+      delete[] drmsds;
+      delete[] scores;
+      Py_DECREF(py_result);
+      return NULL;
     }
   }
   // cout << "START2" << endl << flush;
@@ -205,11 +220,228 @@ static PyObject* rmsdRMSD_wrapper(PyObject* self, PyObject* args)
   // give it to me
   return py_result;
 }
+
+
+/* The function doc string */
+PyDoc_STRVAR(rmsdRMSD_condensed__doc__,
+"Compares all the models of a group against each other (superposition, \n\
+number of equivalent positions, RMSD and dRMSD), using several threads.\n\
+   :param coords: C contiguous buffer of doubles (e.g. numpy array) with \n\
+      the coordinates of the models, of shape (nmodels, size, 3)\n\
+   :param zeros: list of True/False representing particles to skip\n\
+   :param size: number of particles per model\n\
+   :param nmodels: number of models\n\
+   :param dcutoff: distance cutoff to consider 2 particles as equivalent \n\
+      in position (nm)\n\
+   :param nthreads: number of threads to use\n\
+   :param eqvs: writable buffer of nmodels*(nmodels-1)/2 doubles, filled \n\
+      with the number of equivalent positions of each pair of models (in \n\
+      the order of a condensed distance matrix, as used by scipy)\n\
+   :param rmsds: same as eqvs, filled with the RMSDs\n\
+   :param drmsds: same as eqvs, filled with the dRMSDs\n\
+");
+
+/* arguments shared by the threads of one call (each call has its own task
+   queue, as the GIL is released during the computation) */
+typedef struct {
+  int taskQ_i;                    // next model to compare to the following ones
+  pthread_mutex_t lock;           // mutex to access task queue
+  const float *coords;
+  const int *zeros;
+  int size;
+  int nmodels;
+  float thres;
+  double *eqvs;
+  double *rmsds;
+  double *drmsds;
+} rmsdworker_arg;
+
+static void *rmsd_worker(void *arg)
+{
+  rmsdworker_arg *myargs = (rmsdworker_arg *) arg;
+  const int size = myargs->size;
+  const int nmodels = myargs->nmodels;
+  float rms;
+  float drms;
+  int   eqv;
+  long  k;
+  float **xyzA = new float*[size];
+  float **xyzB = new float*[size];
+  float *bufA = new float[size*3];
+  float *bufB = new float[size*3];
+
+  for (int i=0; i<size; i++){
+    xyzA[i] = bufA + 3*i;
+    xyzB[i] = bufB + 3*i;
+  }
+
+  while (1) {
+    pthread_mutex_lock(&myargs->lock);
+    if (myargs->taskQ_i > nmodels-2) {
+      // task queue is empty
+      pthread_mutex_unlock(&myargs->lock);
+      break;
+    }
+    // a task is a model 'j', to be compared to all the following ones
+    int j = myargs->taskQ_i;
+    myargs->taskQ_i++;
+    pthread_mutex_unlock(&myargs->lock);
+
+    // index of pair (j, j+1) in the condensed matrix
+    k = (long)j * nmodels - (long)j * (j+1) / 2;
+    for (int jj=j+1; jj<nmodels; jj++){
+      // superposition moves the coordinates: work on copies
+      memcpy(bufA, myargs->coords + (long)j  * size*3, size*3*sizeof(float));
+      memcpy(bufB, myargs->coords + (long)jj * size*3, size*3*sizeof(float));
+      rmsdRMSD(xyzA, xyzB, (int *) myargs->zeros, size, myargs->thres,
+	       eqv, rms, drms);
+      myargs->eqvs[k]   = eqv;
+      myargs->rmsds[k]  = rms;
+      myargs->drmsds[k] = drms;
+      k++;
+    }
+  }
+
+  delete[] xyzA;
+  delete[] xyzB;
+  delete[] bufA;
+  delete[] bufB;
+  return NULL;
+}
+
+static int get_double_buffer(PyObject *obj, Py_buffer *view, long len,
+			     int writable)
+{
+  int flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT;
+  if (writable)
+    flags |= PyBUF_WRITABLE;
+  if (PyObject_GetBuffer(obj, view, flags) < 0)
+    return 0;
+  if (view->itemsize != sizeof(double) || view->format == NULL ||
+      view->format[strlen(view->format)-1] != 'd' ||
+      view->len != len * (long)sizeof(double)) {
+    PyErr_SetString(PyExc_ValueError,
+		    "expected a contiguous buffer of doubles of the right size");
+    PyBuffer_Release(view);
+    return 0;
+  }
+  return 1;
+}
+
+static PyObject* rmsdRMSD_condensed(PyObject* self, PyObject* args)
+{
+  PyObject *py_coords;
+  PyObject *py_zeros;
+  PyObject *py_eqvs;
+  PyObject *py_rmsds;
+  PyObject *py_drmsds;
+  PyObject *seq;
+  int size;
+  int nmodels;
+  float thres;
+  int nthreads;
+
+  if (!PyArg_ParseTuple(args, "OOiifiOOO", &py_coords, &py_zeros, &size,
+			&nmodels, &thres, &nthreads, &py_eqvs, &py_rmsds,
+			&py_drmsds))
+    return NULL;
+
+  long npairs = (long)nmodels * (nmodels-1) / 2;
+  Py_buffer coords_view;
+  Py_buffer eqvs_view;
+  Py_buffer rmsds_view;
+  Py_buffer drmsds_view;
+  int zeros[size];
+
+  seq = PySequence_Fast(py_zeros, "zeros should be a sequence");
+  if (seq == NULL)
+    return NULL;
+  if (PySequence_Fast_GET_SIZE(seq) < size) {
+    PyErr_SetString(PyExc_ValueError, "less zeros than particles");
+    Py_DECREF(seq);
+    return NULL;
+  }
+  for (int i=0; i<size; i++)
+    zeros[i] = PyObject_IsTrue(PySequence_Fast_GET_ITEM(seq, i));
+  Py_DECREF(seq);
+
+  if (!get_double_buffer(py_coords, &coords_view, (long)nmodels*size*3, 0))
+    return NULL;
+  if (!get_double_buffer(py_eqvs, &eqvs_view, npairs, 1)) {
+    PyBuffer_Release(&coords_view);
+    return NULL;
+  }
+  if (!get_double_buffer(py_rmsds, &rmsds_view, npairs, 1)) {
+    PyBuffer_Release(&coords_view);
+    PyBuffer_Release(&eqvs_view);
+    return NULL;
+  }
+  if (!get_double_buffer(py_drmsds, &drmsds_view, npairs, 1)) {
+    PyBuffer_Release(&coords_view);
+    PyBuffer_Release(&eqvs_view);
+    PyBuffer_Release(&rmsds_view);
+    return NULL;
+  }
+
+  // single precision copy of the coordinates, as used by the aligner
+  float *coords = new float[(long)nmodels*size*3];
+  for (long i=0; i<(long)nmodels*size*3; i++)
+    coords[i] = ((double *) coords_view.buf)[i];
+
+  rmsdworker_arg arg;
+  arg.taskQ_i = 0;
+  arg.coords  = coords;
+  arg.zeros   = zeros;
+  arg.size    = size;
+  arg.nmodels = nmodels;
+  arg.thres   = thres;
+  arg.eqvs    = (double *) eqvs_view.buf;
+  arg.rmsds   = (double *) rmsds_view.buf;
+  arg.drmsds  = (double *) drmsds_view.buf;
+
+  if (nthreads < 1)
+    nthreads = 1;
+  if (nthreads > nmodels - 1)
+    nthreads = nmodels > 1 ? nmodels - 1 : 1;
+
+  Py_BEGIN_ALLOW_THREADS
+  pthread_mutex_init(&arg.lock, NULL);
+  if (nthreads == 1) {
+    rmsd_worker(&arg);
+  } else {
+    pthread_t *tid = new pthread_t[nthreads];
+    int started = 0;
+    for (int i=0; i<nthreads; i++) {
+      if (pthread_create(&(tid[i]), NULL, &rmsd_worker, &arg))
+	break;
+      started++;
+    }
+    // the threads started take all the tasks
+    if (!started)
+      rmsd_worker(&arg);
+    for (int i=0; i<started; i++)
+      pthread_join(tid[i], NULL);
+    delete[] tid;
+  }
+  pthread_mutex_destroy(&arg.lock);
+  Py_END_ALLOW_THREADS
+
+  delete[] coords;
+  PyBuffer_Release(&coords_view);
+  PyBuffer_Release(&eqvs_view);
+  PyBuffer_Release(&rmsds_view);
+  PyBuffer_Release(&drmsds_view);
+
+  Py_RETURN_NONE;
+}
+
  
 static PyMethodDef Eqv_rms_drmsMethods[] =
   {
     {"rmsdRMSD_wrapper", rmsdRMSD_wrapper, METH_VARARGS, 
     rmsdRMSD_wrapper__doc__},
+    {"rmsdRMSD_condensed", rmsdRMSD_condensed, METH_VARARGS, 
+    rmsdRMSD_condensed__doc__},
     {NULL, NULL, 0, NULL}
   };
 
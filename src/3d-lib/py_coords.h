@@ -0,0 +1,34 @@
+#ifndef PY_COORDS_H
+#define PY_COORDS_H
+
+#include "Python.h"
+
+/* Reads the x, y and z coordinates of the particles of a model, each given
+   as a sequence of numbers (list, tuple or numpy array), into an array of
+   size (x, y, z) triplets.
+   Returns 0 (with a Python exception set) on failure. */
+static int read_coords(PyObject *py_x, PyObject *py_y, PyObject *py_z,
+		       int size, float **xyz)
+{
+  PyObject *py_axes[3] = {py_x, py_y, py_z};
+  PyObject *seq;
+
+  for (int k = 0; k < 3; k++) {
+    seq = PySequence_Fast(py_axes[k], "coordinates should be a sequence");
+    if (seq == NULL)
+      return 0;
+    if (PySequence_Fast_GET_SIZE(seq) < size) {
+      PyErr_SetString(PyExc_ValueError, "less coordinates than particles");
+      Py_DECREF(seq);
+      return 0;
+    }
+    for (int i = 0; i < size; i++)
+      xyz[i][k] = PyFloat_AsDouble(PySequence_Fast_GET_ITEM(seq, i));
+    Py_DECREF(seq);
+    if (PyErr_Occurred())
+      return 0;
+  }
+  return 1;
+}
+
+#endif
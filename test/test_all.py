@@ -9,6 +9,7 @@ from pytadbit                             import Chromosome, load_chromosome
 from pytadbit                             import tadbit, batch_tadbit
 from pytadbit.tad_clustering.tad_cmo      import optimal_cmo
 from pytadbit.imp.structuralmodels        import load_structuralmodels
+from pytadbit.imp.ensemble_file           import merge_ensembles
 from pytadbit.imp.impmodel                import load_impmodel_from_cmm
 from pytadbit.eqv_rms_drms                import rmsdRMSD_wrapper
 from os                                   import system, path, chdir
@@ -16,6 +17,11 @@ from warnings                             import warn
 from distutils.spawn                      import find_executable
 from pytadbit.parsers.genome_parser       import parse_fasta
 from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from pytadbit.mapping.filter              import filter_reads
+from pytadbit.parsers.hic_parser          import load_hic_data_from_reads
+from pytadbit.parsers.binary_reads        import tsv_to_binary_reads
+from pytadbit.parsers.binary_reads        import binary_to_tsv_reads
 
 CHKTIME = False
 
@@ -371,6 +377,22 @@ class TestTadbit(unittest.TestCase):
                   'reference': '', 'lowfreq': -0.6, 'scale': 0.01}
         self.assertEqual([round(i, 4) for i in config.values()if not type(i) is str],
                          [round(i, 4) for i in wanted.values()if not type(i) is str])
+        # successive halving schedule (without generating models)
+        from pytadbit.imp.impoptimizer import IMPoptimizer
+        optim = IMPoptimizer(exp, 50, 70, n_models=18, n_keep=6)
+        calls = []
+        def evaluate(engine, points, n_models, n_keep, dcutoffs, corr, diag):
+            calls.append((len(points), n_models, n_keep))
+            for point in points:
+                yield point, 2, float(point[2]), None
+        optim._evaluate = evaluate
+        optim.run_adaptive_search(upfreq_range=(0, 0.8, 0.1),
+                                  lowfreq_range=[-0.6], maxdist_range=[500],
+                                  eta=3, refine=0, verbose=False)
+        self.assertEqual(calls, [(9, 2, 1), (3, 6, 2), (1, 18, 6)])
+        self.assertEqual(optim.get_best_parameters_dict()['upfreq'], 0.8)
+        self.assertRaisesRegexp(Exception, 'eta', optim.run_adaptive_search,
+                                eta=1.5)
         if CHKTIME:
             print '12', time() - t0
 
@@ -401,6 +423,21 @@ class TestTadbit(unittest.TestCase):
                                           'scale': 0.01,
                                           'upfreq': 1.0, 'lowfreq': -0.6})
         models.save_models('models.pick')
+        models.save_models('models.bin', binary=True)
+        binmodels = load_structuralmodels('models.bin')
+        # same models in both files are counted once
+        self.assertEqual((25, 0), merge_ensembles(['models.bin', 'models.pick'],
+                                                  'merged.bin'))
+        # discarded models of the inputs are not promoted to best models
+        models.define_best_models(10)
+        models.save_models('models10.bin', binary=True)
+        self.assertEqual((10, 15), merge_ensembles(
+            ['models10.bin', 'models10.bin'], 'merged.bin'))
+        models.define_best_models(25)
+        system('rm -f models.bin models10.bin merged.bin')
+        self.assertEqual([m['rand_init'] for m in models],
+                         [m['rand_init'] for m in binmodels])
+        self.assertTrue(abs(binmodels[3]['x'] - models[3]['x']).max() < 0.01)
 
         avg = models.average_model()
         nmd = len(models)
@@ -416,6 +453,7 @@ class TestTadbit(unittest.TestCase):
         model = min([(k, dev[(k, nmd)] )
                      for k in range(nmd)], key=lambda x: x[1])[0]
         self.assertEqual(centroid['rand_init'], models[model]['rand_init'])
+        self.assertTrue(models.centroid_model(models=[5, 6, 7]) in [5, 6, 7])
         if CHKTIME:
             print '13', time() - t0
 
@@ -431,6 +469,9 @@ class TestTadbit(unittest.TestCase):
             models.cluster_models(method='mcl', fact=0.9, verbose=False,
                                   dcutoff=200)
             self.assertTrue(2 <= len(models.clusters.keys()) <= 3)
+        models.cluster_models(method='mcl-native', fact=0.9, verbose=False,
+                              dcutoff=200)
+        self.assertTrue(2 <= len(models.clusters.keys()) <= 3)
         models.cluster_models(method='ward', verbose=False, dcutoff=200)
         self.assertTrue(2 <= len(models.clusters.keys()) <= 3)
         if CHKTIME:
@@ -523,6 +564,8 @@ class TestTadbit(unittest.TestCase):
         # write cmm
         models.write_cmm('.', model_num=2)
         model = load_impmodel_from_cmm('model.%s.cmm' % models[2]['rand_init'])
+        self.assertTrue(' x="%s" ' % float(models[2]['x'][0]) in
+                        open('model.%s.cmm' % models[2]['rand_init']).read())
         # clean
         system('rm -f model.*')
         # stats
@@ -535,6 +578,10 @@ class TestTadbit(unittest.TestCase):
                                      model.longest_axe()) / 100,
                                     0) <= 22)
         self.assertEqual([16], model.inaccessible_particles(1000))
+        # models replaced after loading are found by vectorized analyses
+        models._StructuralModels__models[2] = model
+        self.assertEqual(round(model.distance(8, 20), 3), round(
+            models.median_3d_dist(8, 20, models=[2], plot=False), 3))
 
         acc, num, acc_area, tot_area, bypt = model.accessible_surface(
             150, superradius=200, nump=150)
@@ -587,6 +634,224 @@ class TestTadbit(unittest.TestCase):
             print '17', time() - t0
 
 
+    def test_19_binary_reads(self):
+        """
+        filtering and binning of reads in tab separated and binary formats
+        """
+        if CHKTIME:
+            t0 = time()
+
+        out = open('lala.tsv', 'w')
+        out.write('## Chromosome lengths (order matters):\n')
+        out.write('# CRM chrA\t20000\n# CRM chrB\t10000\n')
+        for i in xrange(400):
+            cr1, cr2 = ('chrA', 'chrB')[i % 2], ('chrA', 'chrB')[i % 3 == 0]
+            ps1, ps2 = (i * 37) % 9000 + 200, (i * 53) % 9000 + 200
+            out.write('read%03d\t%s\t%d\t%d\t40\t%d\t%d\t' % (
+                i, cr1, ps1, i % 2, ps1 / 500 * 500, ps1 / 500 * 500 + 500))
+            out.write('%s\t%d\t%d\t40\t%d\t%d\n' % (
+                cr2, ps2, i % 5 == 0, ps2 / 500 * 500, ps2 / 500 * 500 + 500))
+        out.close()
+        tsv_to_binary_reads('lala.tsv', 'lala.bin')
+        binary_to_tsv_reads('lala.bin', 'lala2.tsv')
+        self.assertEqual(open('lala.tsv').read(), open('lala2.tsv').read())
+        self.assertEqual(count_re_fragments('lala.tsv'),
+                         count_re_fragments('lala.bin'))
+        masked_tsv = filter_reads('lala.tsv', over_represented=0.1,
+                                  verbose=False)
+        masked_bin = filter_reads('lala.bin', over_represented=0.1,
+                                  verbose=False)
+        for k in masked_tsv:
+            self.assertEqual(masked_tsv[k]['reads'], masked_bin[k]['reads'])
+        self.assertEqual(dict(load_hic_data_from_reads('lala.tsv', 1000)),
+                         dict(load_hic_data_from_reads('lala.bin', 1000)))
+        system('rm -f lala.tsv lala2.tsv lala.bin')
+        if CHKTIME:
+            print '19', time() - t0
+
+
+    def test_20_distributed_modelling(self):
+        """
+        models generated through a queue of jobs
+        """
+        if CHKTIME:
+            t0 = time()
+
+        try:
+            __import__('IMP')
+        except ImportError:
+            warn('IMP not found, skipping test\n')
+            return
+        from pytadbit.imp.imp_modelling import generate_3d_models
+        from pytadbit.imp.model_queue   import queue_3d_models
+        from pytadbit.imp.model_queue   import model_queue_worker
+        from pytadbit.imp.model_queue   import wait_model_queue
+        from pytadbit.imp.model_queue   import model_queue_status
+        from pytadbit.imp.model_queue   import collect_queued_models
+        from pytadbit.imp.model_queue   import _claim_job, _requeue_lost_jobs
+        from os                         import utime, listdir, rename
+        test_chr = Chromosome(name='Test Chromosome', max_tad_size=260000)
+        test_chr.add_experiment('exp1', 20000, tad_def=exp4,
+                                hic_data=PATH + '/20Kb/chrT/chrT_A.tsv',
+                                silent=True)
+        exp = test_chr.experiments[0]
+        exp.filter_columns(silent=True)
+        exp.normalize_hic(silent=True, factor=None)
+        zscores, values, _ = exp._sub_experiment_zscore(51, 71)
+        config = {'kforce': 5, 'maxdist': 500, 'scale': 0.01,
+                  'upfreq': 1.0, 'lowfreq': -0.6}
+        system('rm -rf lala')
+        queue_3d_models('lala', zscores, 20000, 21, n_models=12,
+                        chunk_size=5, config=config, first=0)
+        # a job claimed long after being queued is not taken back
+        for job in listdir('lala/todo'):
+            utime(path.join('lala/todo', job), (0, 0))
+        job, running = _claim_job('lala')
+        _requeue_lost_jobs('lala', 300)
+        self.assertEqual(model_queue_status('lala'), (2, 1, 0))
+        rename(running, path.join('lala/todo', job))
+        self.assertEqual(model_queue_worker('lala', n_cpus=2), 3)
+        wait_model_queue('lala', poll=1)
+        models = collect_queued_models('lala', n_keep=6, keep_all=True)
+        direct = generate_3d_models(zscores, 20000, 21, n_models=12, n_keep=6,
+                                    n_cpus=2, keep_all=True, first=0,
+                                    config=dict(config))
+        self.assertEqual([m['rand_init'] for m in models],
+                         [m['rand_init'] for m in direct])
+        system('rm -rf lala')
+        if CHKTIME:
+            print '20', time() - t0
+
+
+    def test_21_read_ahead_gzip(self):
+        """
+        gzipped files read through a helper process
+        """
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.parsers.gzopen import ReadAheadGzipFile
+        from gzip import open as gz_open
+        lines = ['a\n', 'bcdefghij\n', 'xyz']
+        out = gz_open('lala.gz', 'wb')
+        out.write(''.join(lines))
+        out.close()
+        # last line without newline, and lines longer than blocks
+        for block_size in (3, 4, 1024):
+            self.assertEqual(list(ReadAheadGzipFile(
+                'lala.gz', block_size=block_size)), lines)
+        system('rm -f lala.gz')
+        if CHKTIME:
+            print '21', time() - t0
+
+
+    def test_22_checkpoints(self):
+        """
+        stages of a pipeline skipped when already done
+        """
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.utils.checkpoints import Checkpoints
+        system('rm -rf lala')
+        calls = []
+        def stage(infile, outfile, factor=1):
+            calls.append(factor)
+            out = open(outfile, 'w')
+            out.write(open(infile).read() * factor)
+            out.close()
+            return len(calls)
+        check = Checkpoints('lala')
+        infile  = path.join(check.workdir, 'in.txt')
+        outfile = path.join(check.workdir, 'out.txt')
+        open(infile, 'w').write('abc\n')
+        run = lambda chk: chk.run('stage', stage, args=(infile, outfile),
+                                  kwargs={'factor': 2}, inputs=[infile],
+                                  outputs=[outfile], store_result=True,
+                                  verbose=False)
+        self.assertEqual(run(check), 1)
+        # skipped, from a new object reading the journal
+        check = Checkpoints('lala')
+        self.assertTrue(check.is_done('stage', check.stage_key(
+            'stage', [infile], {'factor': 2})))
+        self.assertFalse(check.is_done('stage', check.stage_key(
+            'stage', [infile], {'factor': 3})))
+        self.assertEqual(run(check), 1)
+        self.assertEqual(calls, [2])
+        # run again if an output or an input changed
+        open(outfile, 'w').write('abc\n')
+        self.assertEqual(run(check), 2)
+        open(infile, 'w').write('abcd\n')
+        self.assertEqual(run(check), 3)
+        self.assertEqual(run(Checkpoints('lala')), 3)
+        self.assertEqual(open(outfile).read(), 'abcd\n' * 2)
+        self.assertEqual(check.stats().split('\n')[1].split()[0], 'stage')
+        system('rm -rf lala')
+        if CHKTIME:
+            print '22', time() - t0
+
+    def test_23_restraint_table(self):
+        """
+        table of restraints same as the one built pair by pair
+        """
+        if CHKTIME:
+            t0 = time()
+        try:
+            __import__('IMP')
+        except ImportError:
+            warn('IMP not found, skipping test\n')
+            return
+        from random import Random
+        import pytadbit.imp.imp_modelling as imp_m
+        # rows 4 and 7 missing, some cells missing, and values around the
+        # thresholds (also for the extra particles at each side)
+        rnd = Random(1)
+        zscores = {}
+        for x in range(0, 11):
+            if x in (4, 7):
+                continue
+            zscores[str(x)] = dict((str(y), rnd.uniform(-1.5, 1.5))
+                                   for y in range(x + 1, 11)
+                                   if rnd.random() > 0.3)
+        zscores['1']['2'] = zscores['5']['6'] = 1.
+        loci = range(1, 10)
+        config = {'upfreq': 0.3, 'lowfreq': -0.4, 'kforce': 5}
+        imp_m.PDIST = zscores
+        imp_m.CONFIG = config
+        imp_m.SLOPE, imp_m.INTERCEPT = -300., 200.
+        imp_m.NSLOPE, imp_m.NINTERCEPT = -100., 150.
+        class Particle(object):
+            def __init__(self, name):
+                self.name = name
+            def get_name(self):
+                return self.name
+            def get_value(self, _):
+                return 25.
+        particles = [Particle(str(l)) for l in loci]
+        class Particles(object):
+            def get_particle(self, i):
+                return particles[i]
+        model = {'rk': None, 'ps': Particles()}
+        names = dict((n, i) for i, n in enumerate(imp_m.RESTRAINT_TYPES))
+        by_pair = {}
+        for i in range(len(loci)):
+            for j in range(i + 1, len(loci)):
+                typ, dist, kforce = imp_m.addHarmonicPair(
+                    model, particles[i], particles[j], str(loci[i]),
+                    str(loci[j]), j, dry=True)
+                if typ != 'no':
+                    by_pair[i, j] = (names[typ[-1]], round(dist, 6),
+                                     round(kforce, 6))
+        table = imp_m.restraint_table(zscores, loci, config, 25.,
+                                      imp_m.SLOPE, imp_m.INTERCEPT,
+                                      imp_m.NSLOPE, imp_m.NINTERCEPT)
+        self.assertEqual(by_pair, dict(
+            ((i, j), (t, round(d, 6), round(k, 6)))
+            for i, j, t, d, k in zip(*[v.tolist() for v in table])))
+        self.assertEqual(set(t for t, _, _ in by_pair.values()),
+                         set(range(len(imp_m.RESTRAINT_TYPES))))
+        if CHKTIME:
+            print '23', time() - t0
+
+
 if __name__ == "__main__":
     unittest.main()
     